@@ -6,6 +6,7 @@ entry_points = {
     'console_scripts': [
         'nti_mailer_qp_console = nti.mailer.queue:run_console',
         'nti_mailer_qp_process = nti.mailer.queue:run_process',
+        'nti_mailer_preinline = nti.mailer.preinline:main',
         'nti_qp = nti.mailer.queue:run_console' # backwards compatibility
     ],
 }
@@ -73,6 +74,7 @@ setup(
         #'pyramid < 2.0',
         'pyramid_mailer',
         'six',
+        'transaction',
         'ZODB',
         'zc.displayname',
         'zope.annotation',
@@ -89,6 +91,9 @@ setup(
     ],
     extras_require={
         'test': TESTS_REQUIRE,
+        'benchmarks': TESTS_REQUIRE + [
+            'pyperf',
+        ],
         'docs': [
             'Sphinx',
             'repoze.sphinx.autointerface',
@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Creating and queueing many messages from the same templates, and
+the render jobs that let the queue processor render a message
+instead (see :mod:`nti.mailer._deferred`).
+
+The functions meant to be called are also available from
+:mod:`nti.mailer._default_template_mailer`, which provides
+:class:`nti.mailer.interfaces.ITemplatedMailer`, and which this
+module builds on.
+"""
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+from pyramid.threadlocal import get_current_request
+
+from pyramid_mailer.message import Message
+
+from zope import component
+
+from nti.mailer.interfaces import IVERP
+
+from nti.mailer._compat import _marker
+from nti.mailer._compat import is_nonstr_iter
+from nti.mailer._deferred import JOB_VERSION
+from nti.mailer._deferred import JobRequest
+from nti.mailer._deferred import decode_job
+from nti.mailer._deferred import encode_job
+from nti.mailer._deferred import preferred_languages
+from nti.mailer._deferred import request_attrs
+from nti.mailer._merge import MergeTemplate
+
+from nti.mailer.delivery import RENDER_JOB_HEADER
+
+from nti.mailer import _verp as default_verp
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _html_text_email_factory(base_template,
+                             subject,
+                             request,
+                             template_args,
+                             reply_to,
+                             attachments,
+                             package,
+                             text_template_extension,
+                             context,
+                             level,
+                             merge_fields=None,
+                             utility_args=None):
+    """
+    Do the work that is the same for every message rendered from
+    *base_template*, returning a function of a recipient and its
+    template arguments that creates its message (or returns None if
+    the recipient has no valid address).
+
+    With *merge_fields*, that includes rendering the templates (see
+    :class:`nti.mailer._merge.MergeTemplate`). If *utility_args* are
+    given, they are used instead of asking the
+    :class:`~.IMailerTemplateArgsUtility` utilities.
+    """
+    # pylint:disable=too-many-positional-arguments,too-many-locals
+    if not subject:
+        raise ValueError("A subject is required")
+    request = request if request is not None else get_current_request()
+    shared_args = dict(template_args or {})
+    context = _find_context(context, request, shared_args)
+    shared_args.setdefault('context', context)
+
+    subject = _translate_subject(subject, context, request)
+
+    renderers, preinlined = _find_renderers(base_template, text_template_extension,
+                                            package, getattr(request, 'registry', None),
+                                            level=level + 1)
+    if utility_args is None:
+        utility_args = _template_args_from_utilities(request)
+
+    def render(args, inline=css_inline_cache):
+        html_body, text_body = [
+            _render_with(helper,
+                         _make_template_args(request, context,
+                                             extension, text_template_extension,
+                                             args,
+                                             utility_args=utility_args),
+                         request)
+            for helper, extension in renderers
+        ]
+        if not preinlined:
+            html_body = inline(html_body)
+        if isinstance(text_body, bytes):
+            text_body = text_body.decode('utf-8', 'replace')
+        return html_body, text_body
+
+    if merge_fields:
+        bodies = _merged_bodies(merge_fields, shared_args, render)
+    else:
+        bodies = _rendered_bodies(shared_args, render)
+
+    def create(recipient, recipient_args):
+        recipients = _as_recipient_list(recipient)
+        if not recipients:
+            logger.info("Not creating email for recipient without a valid address: %r",
+                        recipient)
+            return None
+        html_body, text_body = bodies(recipient_args)
+        message = Message(subject=subject,
+                          recipients=recipients,
+                          body=text_body,
+                          html=html_body,
+                          attachments=attachments)
+        if reply_to:
+            message.extra_headers['Reply-To'] = reply_to
+        return message
+
+    return create
+
+
+def _find_context(context, request, template_args):
+    """
+    The *context* if given, otherwise that of the *request* or the
+    *template_args*.
+    """
+    if context is _marker and request is not None:
+        context = getattr(request, 'context', _marker)
+    if context is _marker:
+        context = template_args.get('context', None)
+    return context
+
+
+def _find_renderers(base_template, text_template_extension, package, registry, level):
+    """
+    Return the renderer helpers and extensions of the HTML and text
+    templates, falling back from *package* to the default, and whether
+    they are preinlined.
+    """
+    try:
+        templates, preinlined = _resolve_templates(base_template, text_template_extension,
+                                                   package, registry, level=level + 1)
+    except ValueError:
+        if package is None:
+            raise
+        logger.warning(
+            "Failed to find template %r for package %s; trying default",
+            base_template, package
+        )
+        templates, preinlined = _resolve_templates(base_template, text_template_extension,
+                                                   None, registry, level=level + 1)
+    renderers = [(_renderer_helper(spec, pkg, registry), extension)
+                 for spec, pkg, extension in templates]
+    return renderers, preinlined
+
+
+def _rendered_bodies(shared_args, render):
+    """
+    Return a function of a recipient's template arguments that
+    renders the bodies of its message with *render*.
+    """
+    def bodies(recipient_args):
+        args = shared_args
+        if recipient_args:
+            args = dict(shared_args)
+            args.update(recipient_args)
+        return render(args)
+    return bodies
+
+
+def _merged_bodies(merge_fields, shared_args, render):
+    """
+    Like :func:`_rendered_bodies`, but *render* just once, and
+    substitute each recipient's values for the *merge_fields*.
+    """
+    merge = MergeTemplate(merge_fields)
+    merge_args = {name.split('.')[0] for name in merge_fields}
+    defaults = {name: shared_args[name] for name in merge_args if name in shared_args}
+    args = dict(shared_args)
+    args.update(merge.placeholders())
+    # Each rendering is different, so there's no use caching it.
+    merge.compile(*render(args, inline=css_inline_cache.transform))
+
+    def bodies(recipient_args):
+        unknown = set(recipient_args or ()) - merge_args
+        if unknown:
+            raise ValueError("Only merge fields can differ between recipients",
+                             sorted(unknown))
+        values = dict(defaults)
+        values.update(recipient_args or ())
+        return merge.fill(values)
+    return bodies
+
+
+def create_html_text_emails(base_template,
+                            recipients_and_args,
+                            subject='',
+                            request=None,
+                            template_args=None,
+                            reply_to=None,
+                            attachments=(),
+                            package=None,
+                            text_template_extension='.txt',
+                            context=_marker,
+                            merge_fields=None,
+                            _level=3):
+    """
+    Create a :class:`pyramid_mailer.message.Message` for each recipient
+    by rendering the same pair of templates, as for
+    :func:`~.create_simple_html_text_email`.
+
+    *recipients_and_args* is an iterable of ``(recipient,
+    template_args)`` pairs, where the *recipient* is anything accepted
+    in the *recipients* of :func:`~.create_simple_html_text_email` and
+    the (optional) *template_args* are added to the shared
+    *template_args* for that recipient only. It is consumed lazily.
+
+    Finding the templates, translating the subject and getting the
+    arguments of the :class:`~.IMailerTemplateArgsUtility` utilities
+    happen once, when this is called; each message is only rendered
+    as it is needed, so that any number of recipients can be handled
+    in constant memory.
+
+    :keyword dict merge_fields: If given, use mail merge: the
+        templates are rendered (and their CSS inlined) just once, and
+        each recipient's message is made by substituting its values
+        for these template arguments, which are the only ones that may
+        differ between recipients. This maps the name of each such
+        argument (or a dotted path into one, like
+        ``'profile.realname'``) to its type, ``'text'`` or ``'url'``,
+        which determines how its values are checked and escaped.
+        Arguments not given for a recipient come from
+        *template_args*. See :mod:`nti.mailer._merge` for what
+        templates can do with them.
+
+    :return: An iterator of messages, skipping recipients without a valid
+        address.
+
+    .. versionadded:: 1.0.1
+    """
+    # pylint:disable=too-many-positional-arguments
+    create = _html_text_email_factory(base_template, subject, request, template_args,
+                                      reply_to, attachments, package,
+                                      text_template_extension, context,
+                                      level=_level + 1,
+                                      merge_fields=merge_fields)
+    messages = (create(recipient, args) for recipient, args in recipients_and_args)
+    return (message for message in messages if message is not None)
+
+
+def queue_html_text_emails(base_template,
+                           recipients_and_args,
+                           subject='',
+                           request=None,
+                           template_args=None,
+                           reply_to=None,
+                           attachments=(),
+                           package=None,
+                           text_template_extension='.txt',
+                           context=_marker,
+                           priority=None,
+                           merge_fields=None,
+                           _level=3):
+    """
+    Transactionally queue a message for each recipient, as created by
+    :func:`create_html_text_emails`, sending each as soon as it is
+    created. Besides the work shared by creating them, the sender and
+    the delivery for *priority* (see
+    :func:`~.queue_simple_html_text_email`) are only found once; the
+    (VERP) sender address is still computed for each recipient.
+    *merge_fields* is as for :func:`create_html_text_emails`.
+
+    :return: The number of messages queued.
+
+    .. versionadded:: 1.0.1
+    """
+    # pylint:disable=too-many-positional-arguments,too-many-locals
+    create = _html_text_email_factory(base_template, subject, request, template_args,
+                                      reply_to, attachments, package,
+                                      text_template_extension, context,
+                                      level=_level + 1,
+                                      merge_fields=merge_fields)
+    request = request if request is not None else get_current_request()
+    delivery, pyramidmailer = _find_delivery(priority)
+    sender = None
+    count = 0
+    for recipient, args in recipients_and_args:
+        message = create(recipient, args)
+        if message is None:
+            continue
+        if sender is None:
+            # Decide on the realname once, too; only the VERP
+            # address differs between recipients.
+            verp = component.queryUtility(IVERP, default=default_verp)
+            sender = verp.realname_from_recipients(_default_sender(), (), request)
+        message.sender = sender
+        _deliver(message,
+                 recipient if is_nonstr_iter(recipient) else [recipient],
+                 request, priority, base_template,
+                 delivery, pyramidmailer)
+        count += 1
+    return count
+
+
+def _render_job_args(base_template, subject, request, template_args, reply_to,
+                     package, text_template_extension, context, level):
+    """
+    Return the parts of a render job (see :mod:`nti.mailer._deferred`)
+    that don't depend on the recipients, doing the things that need
+    the request now: the subject is translated, the
+    :class:`~.IMailerTemplateArgsUtility` utilities are asked for
+    their arguments, and the request's preferred languages are saved.
+    """
+    # pylint:disable=too-many-positional-arguments
+    request = request if request is not None else get_current_request()
+    template_args = template_args or {}
+    context = _find_context(context, request, template_args)
+
+    spec, package = _get_renderer_spec_and_package(base_template, '',
+                                                   package=package,
+                                                   level=level + 1)
+    if ':' not in spec:
+        spec = package.__name__ + ':' + spec
+
+    return {
+        'version': JOB_VERSION,
+        'template': spec,
+        'text_template_extension': text_template_extension,
+        'subject': _translate_subject(subject, context, request),
+        'reply_to': reply_to,
+        'template_args': template_args,
+        'utility_args': _template_args_from_utilities(request),
+        'request': request_attrs(request),
+        'languages': preferred_languages(request),
+    }
+
+
+def _job_email_factory(job, attachments=()):
+    """
+    Like :func:`_html_text_email_factory`, for the templates of
+    *job*, a dictionary made by :func:`_render_job_args`.
+    """
+    return _html_text_email_factory(job['template'],
+                                    job['subject'],
+                                    JobRequest(job['request'], job['languages']),
+                                    job['template_args'],
+                                    job['reply_to'],
+                                    attachments,
+                                    None,
+                                    job['text_template_extension'],
+                                    _marker,
+                                    level=2,
+                                    utility_args=job['utility_args'])
+
+
+def _create_render_job(base_template,
+                       subject='',
+                       request=None,
+                       recipients=(),
+                       template_args=None,
+                       reply_to=None,
+                       attachments=(),
+                       package=None,
+                       cc=(),
+                       bcc=(),
+                       text_template_extension='.txt',
+                       context=_marker,
+                       _level=3):
+    """
+    Like :func:`~.create_simple_html_text_email`, but return a message
+    holding a job to render it later (see :mod:`nti.mailer._deferred`).
+
+    The things that depend on the request are done now (see
+    :func:`_render_job_args`).
+    """
+    # pylint:disable=too-many-positional-arguments
+    if attachments:
+        raise ValueError("Messages with attachments can't be deferred")
+    recipients = _as_recipient_list(recipients)
+    if not recipients:
+        logger.info("Refusing to attempt to send email with no recipients")
+        return None
+    if not subject:
+        logger.info("Refusing to attempt to send email with no subject")
+        return None
+
+    job = _render_job_args(base_template, subject, request, template_args, reply_to,
+                           package, text_template_extension, context, level=_level)
+    job['recipients'] = recipients
+    job['cc'] = _as_recipient_list(cc)
+    job['bcc'] = _as_recipient_list(bcc)
+    message = Message(subject=job['subject'],
+                      recipients=recipients,
+                      body=encode_job(job),
+                      cc=job['cc'],
+                      bcc=job['bcc'])
+    message.extra_headers[RENDER_JOB_HEADER] = str(JOB_VERSION)
+    return message
+
+
+def render_job(job_message):
+    """
+    Render the message described by the job that
+    ``queue_simple_html_text_email(deferred=True)`` queued as
+    *job_message* (an :class:`email.message.Message`), returning the
+    :class:`email.message.Message` to send in its place.
+
+    This is done by :class:`nti.mailer._processor.MailQueueProcessor`, so
+    the process running it must have the templates and the
+    components needed to render them (such as renderer factories and
+    translation domains) registered (see the ``--render-setup``
+    option of ``nti_mailer_qp_process``). The message keeps the
+    sender, recipients, ``Message-Id`` and ``Date`` of the job.
+
+    .. versionadded:: 1.0.1
+    """
+    job = _decode_job_message(job_message)
+    message = _job_email_factory(job)(job['recipients'], None)
+    if message is None:
+        raise ValueError("Render job has no valid recipients")
+    message.cc = job['cc']
+    message.bcc = job['bcc']
+    message.sender = job_message['From']
+    result = message.to_message()
+    for name in 'Message-Id', 'Date':
+        if job_message[name] is not None:
+            del result[name]
+            result[name] = job_message[name]
+    return result
+
+
+def job_recipients(job_message):
+    """
+    The addresses to send the message described by the job queued as
+    *job_message* to.
+
+    Jobs are queued with no recipients, in the envelope or the headers,
+    so that a queue processor that doesn't know to render them (and
+    would send the job itself) can't send them to anyone.
+
+    .. versionadded:: 1.0.1
+    """
+    job = _decode_job_message(job_message)
+    return tuple(dict.fromkeys(job['recipients'] + job['cc'] + job['bcc']))
+
+
+def _decode_job_message(job_message):
+    return decode_job(job_message.get_payload(decode=True).decode('ascii'))
+
+
+# That module needs this one too; importing it last lets either be
+# imported first.
+from nti.mailer._default_template_mailer import _as_recipient_list
+from nti.mailer._default_template_mailer import _default_sender
+from nti.mailer._default_template_mailer import _deliver
+from nti.mailer._default_template_mailer import _find_delivery
+from nti.mailer._default_template_mailer import _get_renderer_spec_and_package
+from nti.mailer._default_template_mailer import _make_template_args
+from nti.mailer._default_template_mailer import _render_with
+from nti.mailer._default_template_mailer import _renderer_helper
+from nti.mailer._default_template_mailer import _resolve_templates
+from nti.mailer._default_template_mailer import _template_args_from_utilities
+from nti.mailer._default_template_mailer import _translate_subject
+from nti.mailer._default_template_mailer import css_inline_cache
@@ -20,6 +20,9 @@ else: # pragma: no cover
             return False
         return hasattr(v, '__iter__')
 
+#: The default for arguments where None means something.
+_marker = object()
+
 __all__ = (
     'parseaddr',
     'formataddr',
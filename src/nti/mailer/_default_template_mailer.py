@@ -10,22 +10,34 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import os
+import time
+import inspect
+import weakref
 import warnings
 
-from premailer import transform
+from pyramid.interfaces import IRendererFactory
 
+from pyramid.path import AssetResolver
 from pyramid.path import caller_package
 
-from pyramid.renderers import render
-from pyramid.renderers import get_renderer
+from pyramid.renderers import RendererHelper
+
+from pyramid.settings import asbool
 
 from pyramid.threadlocal import get_current_request
+from pyramid.threadlocal import get_current_registry
+from pyramid.threadlocal import manager as pyramid_threadlocals
+
+from pyramid.util import hide_attrs
 
 from pyramid_mailer.message import Message
 
 
 from zope import component
 from zope import interface
+from zope.component.hooks import getSite
+from zope.component.hooks import setSite
 
 from zope.dottedname import resolve as dottedname
 # Because zope.i18n is a package, importing a name defined in its
@@ -42,8 +54,21 @@ from nti.mailer.interfaces import ITemplatedMailer
 from nti.mailer.interfaces import IEmailAddressable
 from nti.mailer.interfaces import IPrincipalEmailValidation
 from nti.mailer.interfaces import IMailerTemplateArgsUtility
+from nti.mailer.interfaces import IVolatileMailerTemplateArgsUtility
+from nti.mailer.interfaces import IBackgroundRenderPool
 
+from nti.mailer._compat import _marker
 from nti.mailer._compat import is_nonstr_iter
+from nti.mailer._premailer import TransformCache
+
+from nti.mailer.preinline import inlined_name
+
+from nti.mailer.delivery import DEFAULT_PRIORITY
+from nti.mailer.delivery import NotifyingQueuedMailDelivery
+from nti.mailer.delivery import PRIORITY_HEADER
+from nti.mailer.delivery import QUEUED_AT_HEADER
+from nti.mailer.delivery import RENDER_JOB_HEADER
+from nti.mailer.delivery import TEMPLATE_HEADER
 
 from nti.mailer import _verp as default_verp
 
@@ -64,6 +89,11 @@ class _DefaultMailerPolicy(object):
 
 default_mailer_policy = _DefaultMailerPolicy()
 
+#: The :class:`nti.mailer._premailer.TransformCache` used to inline the
+#: CSS of the HTML messages we create. Its ``hits`` and ``misses``
+#: tell how well it is working.
+css_inline_cache = TransformCache()
+
 
 def _get_renderer_spec_and_package(base_template,
                                    extension,
@@ -84,6 +114,126 @@ def _get_renderer_spec_and_package(base_template,
     return base_template + extension, package
 
 
+#: The attribute of the registry holding its cache of renderers.
+_RENDERER_CACHE_ATTR = '_nti_mailer_renderer_cache'
+
+
+def _reload_templates(registry):
+    settings = getattr(registry, 'settings', None) or {}
+    return asbool(settings.get('pyramid.reload_templates',
+                               settings.get('reload_templates', False)))
+
+
+def _renderer_helper(spec, package, registry=None):
+    """
+    Return the :class:`pyramid.renderers.RendererHelper` for the
+    template *spec* in *package*, which holds the compiled renderer.
+
+    Helpers are cached in the *registry* (the current one by default)
+    they use, so that sending many messages from the same templates
+    finds and compiles them once. Changing the renderer factory
+    registered for the template's extension invalidates them. When templates are being reloaded
+    (``pyramid.reload_templates``), we don't cache, so that changes
+    to the templates are noticed.
+    """
+    if registry is None:
+        registry = get_current_registry()
+    if _reload_templates(registry):
+        return RendererHelper(name=spec, package=package, registry=registry)
+
+    cache = getattr(registry, _RENDERER_CACHE_ATTR, None)
+    if cache is None:
+        cache = {}
+        setattr(registry, _RENDERER_CACHE_ATTR, cache)
+    key = (spec, getattr(package, '__name__', package))
+    # Cached helpers are only good for as long as the renderer
+    # factory that made them is registered.
+    factory = registry.queryUtility(IRendererFactory, name=os.path.splitext(spec)[1])
+    cached_factory, helper = cache.get(key, (None, None))
+    if helper is None or cached_factory is not factory:
+        helper = RendererHelper(name=spec, package=package, registry=registry)
+        # Find (and compile) the template now, raising ValueError if
+        # we can't, so that only working helpers are cached.
+        helper.renderer # pylint:disable=pointless-statement
+        cache[key] = (factory, helper)
+    return helper
+
+
+def _preinlined_spec(spec, package, registry=None):
+    """
+    If the HTML template *spec* in *package* has a pre-inlined variant
+    (see :mod:`nti.mailer.preinline`) that's at least as new as it is,
+    return the spec of the variant; otherwise, return None.
+
+    Like renderers, the answer is cached in the *registry* unless
+    templates are being reloaded.
+    """
+    if registry is None:
+        registry = get_current_registry()
+    reload_templates = _reload_templates(registry)
+    cache = getattr(registry, _RENDERER_CACHE_ATTR, None)
+    if cache is None and not reload_templates:
+        cache = {}
+        setattr(registry, _RENDERER_CACHE_ATTR, cache)
+    key = ('preinlined', spec, getattr(package, '__name__', package))
+    if not reload_templates and key in cache:
+        return cache[key]
+
+    variant = inlined_name(spec)
+    resolver = AssetResolver(package)
+    try:
+        source_mtime = os.path.getmtime(resolver.resolve(spec).abspath())
+        variant_mtime = os.path.getmtime(resolver.resolve(variant).abspath())
+    except (OSError, ValueError, ImportError):
+        variant = None
+    else:
+        if variant_mtime < source_mtime:
+            logger.warning("Ignoring out of date pre-inlined template %s", variant)
+            variant = None
+    if not reload_templates:
+        cache[key] = variant
+    return variant
+
+
+def _clear_renderer_cache(registry=None):
+    """
+    Forget the renderers cached by :func:`_renderer_helper` in
+    *registry* (by default, the current one).
+    """
+    if registry is None:
+        registry = get_current_registry()
+    if getattr(registry, _RENDERER_CACHE_ATTR, None) is not None:
+        setattr(registry, _RENDERER_CACHE_ATTR, None)
+
+
+def _render_with(helper, value, request):
+    with hide_attrs(request, 'response'):
+        return helper.render(value, None, request=request)
+
+
+def _render(spec, value, request, package):
+    # Like :func:`pyramid.renderers.render`, but using a cached renderer.
+    helper = _renderer_helper(spec, package, getattr(request, 'registry', None))
+    return _render_with(helper, value, request)
+
+
+def _resolve_templates(base_template, text_template_extension, package, registry, level):
+    """
+    Find the HTML and text templates named by *base_template*.
+
+    :return: A list of ``(spec, package, extension)`` for each
+        template, and whether the HTML template is pre-inlined.
+    """
+    html = _get_renderer_spec_and_package(base_template, '.pt',
+                                          package=package, level=level)
+    text = _get_renderer_spec_and_package(base_template, text_template_extension,
+                                          package=package, level=level)
+    preinlined = _preinlined_spec(html[0], html[1], registry)
+    if preinlined is not None:
+        html = (preinlined, html[1])
+    return [html + ('.pt',), text + (text_template_extension,)], preinlined is not None
+
+
 def _get_renderer(base_template,
                   extension,
                   package=None,
@@ -103,7 +253,7 @@ def _get_renderer(base_template,
                                                        package=package,
                                                        level=level + 1)
 
-    return get_renderer(template, package=package)
+    return _renderer_helper(template, package).renderer
 
 
 def do_html_text_templates_exist(base_template,
@@ -149,14 +299,14 @@ def _as_recipient_list(recipients):
 
 as_recipient_list = _as_recipient_list
 
-_marker = object()
-
 def _make_template_args(
         request,
         context,
         extension,
         text_template_extension,
-        existing_template_args
+        existing_template_args,
+        *,
+        utility_args=None
 ):
     # Mako gets bitchy if 'context' comes in as an argument, but
     # that's what Chameleon wants. To simplify things, we handle that
@@ -179,11 +329,106 @@ def _make_template_args(
     if the_context_name == 'nti_context' and 'context' in existing_template_args:
         result[the_context_name] = existing_template_args['context']
         del result['context']
-    for args_utility in component.getAllUtilitiesRegisteredFor(IMailerTemplateArgsUtility):
-        result.update(args_utility.get_template_args(request))
+    if utility_args is None:
+        utility_args = _template_args_from_utilities(request)
+    result.update(utility_args)
+    return result
+
+
+#: For the utility registrations of each site manager, their
+#: generation, the :class:`~.IMailerTemplateArgsUtility` utilities
+#: registered in it, and which of those are volatile.
+_args_utilities_cache = weakref.WeakKeyDictionary()
+
+#: For each request, a dictionary mapping the utility registrations of
+#: each site manager used during it to their generation, the args each
+#: of the utilities gave (None for those that must be asked every
+#: time), and, if none must be, the combined args.
+_request_args_cache = weakref.WeakKeyDictionary()
+
+
+def _template_args_utilities(site_manager):
+    """
+    Return the utility registrations of *site_manager* (the key of our
+    caches), their generation (None if we can't tell), the
+    :class:`~.IMailerTemplateArgsUtility` utilities, and whether each
+    is volatile.
+    """
+    registrations = getattr(site_manager, 'utilities', None)
+    # Incremented whenever a registration changes, in it or its bases.
+    # (Re-initializing a site manager replaces its registrations.)
+    generation = getattr(registrations, '_generation', None)
+    if generation is not None:
+        cached = _args_utilities_cache.get(registrations)
+        if cached is not None and cached[0] == generation:
+            return (registrations,) + cached
+    utilities = tuple(site_manager.getAllUtilitiesRegisteredFor(IMailerTemplateArgsUtility))
+    # pylint:disable=no-value-for-parameter
+    volatile = tuple(IVolatileMailerTemplateArgsUtility.providedBy(utility)
+                     for utility in utilities)
+    if generation is not None:
+        _args_utilities_cache[registrations] = (generation, utilities, volatile)
+    return registrations, generation, utilities, volatile
+
+
+def _combine_utility_args(utilities, cached_args, request):
+    result = {}
+    for utility, args in zip(utilities, cached_args):
+        result.update(args if args is not None else utility.get_template_args(request))
     return result
 
 
+def _template_args_from_utilities(request):
+    """
+    Combine the args of the :class:`~.IMailerTemplateArgsUtility` utilities
+    of the current site manager.
+
+    Both the utilities and the args they give are cached: the
+    utilities until the registrations change, and their args (except
+    those of :class:`~.IVolatileMailerTemplateArgsUtility` utilities)
+    for as long as the *request* exists.
+    """
+    registrations, generation, utilities, volatile = \
+        _template_args_utilities(component.getSiteManager())
+    request_cache = None
+    if request is not None and generation is not None:
+        try:
+            request_cache = _request_args_cache.setdefault(request, {})
+        except TypeError: # Can't be weakly referenced
+            pass
+    if request_cache is None:
+        return _combine_utility_args(utilities, [None] * len(utilities), request)
+
+    cached = request_cache.get(registrations)
+    if cached is None or cached[0] != generation:
+        cached_args = [None if is_volatile else utility.get_template_args(request)
+                       for utility, is_volatile in zip(utilities, volatile)]
+        combined = None
+        if not any(volatile):
+            combined = _combine_utility_args(utilities, cached_args, request)
+        cached = request_cache[registrations] = (generation, cached_args, combined)
+    if cached[2] is not None:
+        return dict(cached[2])
+    return _combine_utility_args(utilities, cached[1], request)
+
+
+def _translate_subject(subject, context, request):
+    try:
+        return translate(subject, context=context if context is not None else request)
+    except TypeError as ex:
+        if (
+                context is not None
+                and len(ex.args) >= 3
+                and ex.args[2] == IUserPreferredLanguages
+        ):
+            # We tried to use the *context* argument, but there is no adapter for it.
+            # fallback to using the request.
+            logger.info("Failed to find adapter to translate the subject %r: %s",
+                        subject, ex)
+            return translate(subject, context=request)
+        raise # pragma: no cover
+
+
 def create_simple_html_text_email(base_template,
                                   subject='',
                                   request=None,
@@ -223,6 +468,10 @@ def create_simple_html_text_email(base_template,
         value of ``request.context`` will be used. As a last resort, ``template_args['context']
         will be used. (If both *context* or ``request.context`` and a template argument value
         are given, they should be the same object.)
+    .. versionchanged:: 1.0.1
+        If the HTML template has an up to date pre-inlined variant
+        (see :mod:`nti.mailer.preinline`), render that instead, and
+        don't inline its CSS.
     """
     # XXX: Simplify!
     # pylint:disable=too-complex,too-many-locals,too-many-branches,too-many-positional-arguments
@@ -274,41 +523,34 @@ def create_simple_html_text_email(base_template,
     # based on the Accept headers.
     #
     # (Determining the context is all subject to change.)
-    try:
-        subject = translate(subject, context=context if context is not None else request)
-    except TypeError as ex:
-        if (
-                context is not None
-                and len(ex.args) >= 3
-                and ex.args[2] == IUserPreferredLanguages
-        ):
-            # We tried to use the *context* argument, but there is no adapter for it.
-            # fallback to using the request.
-            logger.info("Failed to find adapter to translate the subject %r: %s",
-                        subject, ex)
-            subject = translate(subject, context=request)
-        else: # pragma: no cover
-            raise
+    subject = _translate_subject(subject, context, request)
+
+    # Find our caller's package here, where *_level* counts the
+    # frames correctly; there are more of them in ``do_render``.
+    _, caller_pkg = _get_renderer_spec_and_package(base_template, '', level=_level)
+
+    # The same for both templates.
+    utility_args = _template_args_from_utilities(request)
 
     def do_render(pkg):
         # XXX: Factor this out to a testable function.
-        # The primary difficulty is the assumed `level` parameter.
-        specs_and_packages = [_get_renderer_spec_and_package(base_template,
-                                                             extension,
-                                                             package=pkg,
-                                                             level=_level + 1) + (extension,)
-                              for extension in ('.pt', text_template_extension)]
-
-        return [render(spec,
-                       _make_template_args(request, context,
-                                           extension, text_template_extension,
-                                           template_args),
-                       request=request,
-                       package=pkg)
-                for spec, pkg, extension in specs_and_packages]
+        specs_and_packages, preinlined = _resolve_templates(base_template,
+                                                            text_template_extension,
+                                                            pkg if pkg is not None else caller_pkg,
+                                                            getattr(request, 'registry', None),
+                                                            level=_level + 1)
+
+        return [_render(spec,
+                        _make_template_args(request, context,
+                                            extension, text_template_extension,
+                                            template_args,
+                                            utility_args=utility_args),
+                        request=request,
+                        package=pkg)
+                for spec, pkg, extension in specs_and_packages] + [preinlined]
 
     try:
-        html_body, text_body = do_render(package)
+        html_body, text_body, preinlined = do_render(package)
     except ValueError: # pragma: no cover
         # This is just to handle the case where the
         # site specifies a package, but wants to use
@@ -323,13 +565,18 @@ def create_simple_html_text_email(base_template,
             "Failed to find template %r for package %s; trying default",
             base_template, package
         )
-        html_body, text_body = do_render(None)
+        html_body, text_body, preinlined = do_render(None)
 
     # Email clients do not handle CSS well unless it's inlined.
     # This can be expensive (~.4s per email) if users interactively
     # trigger large numbers of emails. In that case, the email is
-    # probably better off created with inlined styles.
-    html_body = transform(html_body)
+    # probably better off created with inlined styles. Messages
+    # from the same template often render identically, though,
+    # so we only do it once for each distinct body. Better yet,
+    # templates can be inlined ahead of time (nti.mailer.preinline),
+    # and then we don't do it at all.
+    if not preinlined:
+        html_body = css_inline_cache(html_body)
 
     # PageTemplates (Chameleon and Z3c.pt) produce Unicode strings.
     # Under python2, at least, the text templates (Chameleon alone) produces byte objects,
@@ -384,8 +631,30 @@ def queue_simple_html_text_email(*args, **kwargs):
         that if you use Mako, the usual ``context`` argument is
         renamed to ``nti_context``, as ``context`` is a reserved word
         in Mako.
-
-    :return: The :class:`pyramid_mailer.message.Message` we sent.
+    :keyword str priority:
+        If given, the name of the :class:`~.IMailDelivery` utility to
+        queue the message with (see
+        :class:`nti.mailer.delivery.NotifyingQueuedMailDelivery`).
+        If there is no such utility, the default is used.
+
+    :keyword bool deferred:
+        If true, don't render the message now. Instead, queue a job
+        describing it, which the queue processor renders just before
+        sending it (see :func:`nti.mailer._batch.render_job`). The template arguments
+        must be JSON serializable, and attachments aren't allowed.
+
+    :keyword bool background:
+        If true, and an :class:`~.IBackgroundRenderPool` utility is
+        registered, return right away, and let the pool render and
+        queue the message once the current transaction commits (see
+        :mod:`nti.mailer.background`). If there's no pool, or it is
+        full, the message is rendered now, as usual.
+
+    :return: The :class:`pyramid_mailer.message.Message` we sent,
+        or None if it will be sent in the background.
+
+    .. versionchanged:: 1.0.1
+       Add the *priority*, *deferred* and *background* arguments.
     """
 
     kwargs = dict(kwargs)
@@ -394,6 +663,15 @@ def queue_simple_html_text_email(*args, **kwargs):
     message_factory = kwargs.pop('message_factory', create_simple_html_text_email)
     if message_factory is not create_simple_html_text_email:
         warnings.warn("The message_factory argument is deprecated.", stacklevel=2)
+    priority = kwargs.pop('priority', None)
+    background = kwargs.pop('background', False)
+    if kwargs.pop('deferred', False):
+        message_factory = _create_render_job
+    elif background and message_factory is create_simple_html_text_email:
+        pool = component.queryUtility(IBackgroundRenderPool)
+        if pool is not None \
+           and pool.submit_after_commit(_BackgroundSend(args, kwargs, priority)):
+            return None
     message = message_factory(*args, **kwargs)
     # There are cases where this will be none (bounced email handling, missing
     # subject - error?). In at least the bounced email case, we want to avoid
@@ -402,7 +680,51 @@ def queue_simple_html_text_email(*args, **kwargs):
         return None
     return _send_mail(message,
                       recipients=kwargs.get('recipients', ()),
-                      request=kwargs.get('request'))
+                      request=kwargs.get('request'),
+                      priority=priority,
+                      template=args[0] if args else kwargs.get('base_template'))
+
+
+class _BackgroundSend(object):
+    """
+    Renders and queues a message in a worker of an
+    :class:`~.IBackgroundRenderPool`, as
+    ``queue_simple_html_text_email(*args, **kwargs)`` would have done
+    in the thread that created us.
+
+    The worker has neither that thread's request, site, or caller, so
+    we remember them.
+    """
+
+    def __init__(self, args, kwargs, priority):
+        arguments = inspect.signature(create_simple_html_text_email).bind(*args, **kwargs)
+        arguments = arguments.arguments
+        level = arguments.pop('_level')
+        _, arguments['package'] = _get_renderer_spec_and_package(arguments['base_template'],
+                                                                 '',
+                                                                 arguments.get('package'),
+                                                                 level=level)
+        if arguments.get('request') is None:
+            arguments['request'] = get_current_request()
+        arguments['priority'] = priority
+        self.arguments = arguments
+        self.threadlocals = dict(pyramid_threadlocals.get())
+        self.site = getSite()
+
+    def __call__(self):
+        pyramid_threadlocals.push(self.threadlocals)
+        old_site = getSite()
+        setSite(self.site)
+        try:
+            queue_simple_html_text_email(**self.arguments)
+        finally:
+            setSite(old_site)
+            pyramid_threadlocals.pop()
+
+    def __repr__(self):
+        return '<%s %r to %r>' % (type(self).__name__,
+                                  self.arguments['base_template'],
+                                  self.arguments.get('recipients'))
 
 
 def _compute_from(*args, **kwargs):
@@ -410,25 +732,26 @@ def _compute_from(*args, **kwargs):
     return verp.verp_from_recipients(*args, **kwargs)
 
 
-def _get_from_address(pyramid_mail_message, recipients, request):
-    """
-    Get a valid `From`/`Sender`/`Return-Path` address. This field is required and
-    must be from a verified email address (e.g. @nextthought.com).
-    """
-    fromaddr = getattr(pyramid_mail_message, 'sender', None)
-
-    if not fromaddr:
-        # Can we get a site policy for the current site?
-        # It would be the unnamed IComponents
-        policy = component.queryUtility(IMailerPolicy, default=default_mailer_policy)
-        fromaddr = policy.get_default_sender()
+def _default_sender():
+    # Can we get a site policy for the current site?
+    # It would be the unnamed IComponents
+    policy = component.queryUtility(IMailerPolicy, default=default_mailer_policy)
+    fromaddr = policy.get_default_sender()
     if not fromaddr:
         pyramidmailer = component.queryUtility(IMailer)
         fromaddr = getattr(pyramidmailer, 'default_sender', None)
 
     if not fromaddr:
         raise RuntimeError("No one to send mail from")
+    return fromaddr
+
 
+def _get_from_address(pyramid_mail_message, recipients, request):
+    """
+    Get a valid `From`/`Sender`/`Return-Path` address. This field is required and
+    must be from a verified email address (e.g. @nextthought.com).
+    """
+    fromaddr = getattr(pyramid_mail_message, 'sender', None) or _default_sender()
     result = _compute_from(fromaddr,
                            recipients,
                            request if request is not None else get_current_request())
@@ -460,10 +783,19 @@ def _pyramid_message_to_message(pyramid_mail_message, recipients, request):
     return message
 
 
-def _send_mail(pyramid_mail_message=None, recipients=(), request=None):
+def _send_mail(pyramid_mail_message=None, recipients=(), request=None, priority=None,
+               template=None):
     """
     Given a :class:`pyramid_mailer.message.Message`, transactionally deliver
-    it to the queue.
+    it to the queue (the one for *priority*, if there is one).
+
+    If the delivery is a
+    :class:`nti.mailer.delivery.NotifyingQueuedMailDelivery`, the
+    message is stamped with the time it was queued, the *template*
+    it came from, and its *priority* (see
+    :data:`nti.mailer.delivery.TRACKING_HEADERS`), so that the queue
+    processor can tell how long it waited; the queue processor removes
+    these headers before sending it.
 
     :return: The :class:`pyramid_mailer.message.Message` we sent.
     """
@@ -476,7 +808,38 @@ def _send_mail(pyramid_mail_message=None, recipients=(), request=None):
     # interfaces. It's easy to change the pyramid_mail message into a email
     # message
     assert pyramid_mail_message is not None
+    return _deliver(pyramid_mail_message, recipients, request, priority, template,
+                    *_find_delivery(priority))
+
+
+def _find_delivery(priority=None):
+    """
+    Return the :class:`~.IMailDelivery` for *priority* (or None), and
+    the :class:`~.IMailer` to fall back to.
+    """
     pyramidmailer = component.queryUtility(IMailer)
+    delivery = None
+    if priority:
+        delivery = component.queryUtility(IMailDelivery, name=priority)
+        if delivery is None:
+            logger.debug("No delivery for priority %r; using the default", priority)
+    delivery = delivery \
+            or component.queryUtility(IMailDelivery) \
+            or getattr(pyramidmailer, 'queue_delivery', None)
+    return delivery, pyramidmailer
+
+
+def _deliver(pyramid_mail_message, recipients, request, priority, template,
+             delivery, pyramidmailer):
+    # pylint:disable=too-many-positional-arguments
+    extra_headers = getattr(pyramid_mail_message, 'extra_headers', None)
+    # Only our queue processor knows to remove these headers, so
+    # only add them when we're queuing for it.
+    if extra_headers is not None and isinstance(delivery, NotifyingQueuedMailDelivery):
+        extra_headers[QUEUED_AT_HEADER] = '%.6f' % time.time()
+        extra_headers[PRIORITY_HEADER] = priority or DEFAULT_PRIORITY
+        if template:
+            extra_headers[TEMPLATE_HEADER] = template
 
     # XXX: We'd like to call this only on the one branch
     # that actually needs it, but sadly it has a side-effect of
@@ -487,16 +850,38 @@ def _send_mail(pyramid_mail_message=None, recipients=(), request=None):
         pyramid_mail_message, recipients, request
     )
 
-    delivery = component.queryUtility(IMailDelivery) \
-            or getattr(pyramidmailer, 'queue_delivery', None)
+    is_job = extra_headers is not None and RENDER_JOB_HEADER in extra_headers
+    if is_job:
+        # Fail closed: the recipients are only in the job, where
+        # only a queue processor that renders it will find them.
+        for name in 'To', 'Cc', 'Bcc':
+            del message[name]
+
     if delivery:
         delivery.send(pyramid_mail_message.sender,
-                      pyramid_mail_message.send_to,
+                      () if is_job else pyramid_mail_message.send_to,
                       message)
+    elif is_job:
+        raise RuntimeError("Render jobs can only be queued with an IMailDelivery")
     elif pyramidmailer and pyramid_mail_message:
         pyramidmailer.send_to_queue(pyramid_mail_message)
     else:
         raise RuntimeError("No way to deliver message")
     return pyramid_mail_message
 
+
+# That module builds on this one; importing it last lets either be
+# imported first.
+from nti.mailer._batch import _create_render_job # pylint:disable=cyclic-import
+from nti.mailer._batch import create_html_text_emails
+from nti.mailer._batch import job_recipients
+from nti.mailer._batch import queue_html_text_emails
+from nti.mailer._batch import render_job
+
+# Part of ITemplatedMailer, or long imported from here.
+create_html_text_emails = create_html_text_emails
+job_recipients = job_recipients
+queue_html_text_emails = queue_html_text_emails
+render_job = render_job
+
 interface.moduleProvides(ITemplatedMailer)
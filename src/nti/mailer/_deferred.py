@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+The format of the render jobs queued by
+``queue_simple_html_text_email(deferred=True)`` and rendered by the
+queue processor.
+
+A job is a JSON object, sent as the body of a queued message marked
+with :data:`nti.mailer.delivery.RENDER_JOB_HEADER`. That message has
+no recipients, so a queue processor that doesn't render jobs can't
+deliver it; the recipients are in the job. It holds
+everything needed to render the message without the request that
+queued it: the absolute asset spec of the templates, their arguments
+(which must be JSON serializable), the arguments the
+:class:`~nti.mailer.interfaces.IMailerTemplateArgsUtility` utilities
+gave for the request, the few attributes of the request templates
+commonly use, and the languages the request preferred.
+
+In the templates, JSON objects can be used like the objects they
+came from, by attribute as well as by key.
+"""
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+import json
+
+from zope import interface
+from zope.i18n.interfaces import IUserPreferredLanguages
+from zope.publisher.interfaces.browser import IBrowserRequest
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The version of the job format we write and can read.
+JOB_VERSION = 1
+
+#: The request attributes that are saved with a job.
+JOB_REQUEST_ATTRS = ('application_url', 'host_url')
+
+
+class JobArgs(dict):
+    """
+    A JSON object from a job, whose keys are also attributes.
+    """
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+def encode_job(job):
+    """
+    Return the text of *job*, a dictionary.
+
+    :raises TypeError: If it holds something JSON can't represent.
+    """
+    try:
+        return json.dumps(job, sort_keys=True, ensure_ascii=True)
+    except TypeError as ex:
+        raise TypeError("Deferred messages need JSON serializable template arguments: %s"
+                        % ex) from ex
+
+
+def decode_job(text):
+    """
+    Return the job encoded in *text*.
+
+    :raises ValueError: If it isn't a job we can render.
+    """
+    job = json.loads(text, object_hook=JobArgs)
+    if not isinstance(job, dict) or job.get('version') != JOB_VERSION:
+        raise ValueError("Not a version %d render job" % JOB_VERSION)
+    return job
+
+
+def request_attrs(request):
+    """
+    The attributes of *request* to save with a job.
+    """
+    result = {}
+    for name in JOB_REQUEST_ATTRS:
+        value = getattr(request, name, None)
+        if isinstance(value, str):
+            result[name] = value
+    return result
+
+
+def preferred_languages(request):
+    """
+    The languages *request* prefers, if we can tell, to save with a job.
+    """
+    # pylint:disable=too-many-function-args
+    languages = IUserPreferredLanguages(request, None)
+    if languages is None:
+        return []
+    return list(languages.getPreferredLanguages())
+
+
+@interface.implementer(IBrowserRequest, IUserPreferredLanguages)
+class JobRequest(object):
+    """
+    Stands in for the request that queued a job when rendering it,
+    with the attributes we saved from it, and preferring the same
+    languages.
+
+    It provides ``IBrowserRequest`` only so that page template
+    renderers accept it; it has none of a browser request's methods.
+    """
+
+    response = None
+    context = None
+
+    def __init__(self, attrs, languages):
+        self.__dict__.update(attrs)
+        self.annotations = {}
+        self._languages = list(languages)
+
+    def getPreferredLanguages(self):
+        return self._languages
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+An event-driven directory watcher for Linux using inotify.
+
+This has the same interface as the gevent stat watchers used by
+:class:`nti.mailer.queue.MailerWatcher` (``path``, ``active``,
+``start``, ``stop``, ``close``), so it can be used in their place.
+It is implemented with :mod:`ctypes`, and is only available if the C
+library provides ``inotify_init1``; use :func:`inotify_available` to
+find out.
+
+"""
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+import os
+import sys
+import errno
+import struct
+import ctypes
+import ctypes.util
+
+import gevent
+
+logger = __import__('logging').getLogger(__name__)
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0o2000000)
+
+#: The events that mean a new file has arrived: maildir writers
+#: rename complete files into ``new/``, but we also accept files
+#: written in place.
+IN_ARRIVED = IN_CLOSE_WRITE | IN_MOVED_TO
+
+_EVENT = struct.Struct('iIII')
+
+_libc = None
+
+
+def _get_libc():
+    global _libc # pylint:disable=global-statement
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        # Raises AttributeError if not supported.
+        libc.inotify_init1.argtypes = (ctypes.c_int,)
+        libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        _libc = libc
+    return _libc
+
+
+def inotify_available():
+    """
+    Can we create :class:`InotifyWatcher` objects?
+    """
+    if not sys.platform.startswith('linux'): # pragma: no cover
+        return False
+    try:
+        _get_libc()
+    except (OSError, AttributeError): # pragma: no cover
+        return False
+    return True
+
+
+def _check(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+class InotifyWatcher(object):
+    """
+    Watches the directory *path* for files arriving in it (events
+    in *mask*), calling the callback given to :meth:`start` with no
+    arguments from the gevent hub whenever some do.
+
+    The names of the files that arrived are available in :attr:`names`
+    during the callback. Names beginning with a dot are ignored, as
+    maildir readers are supposed to do. If the kernel's event queue
+    overflows, we may not know the names, but still call the callback.
+
+    Construction raises :exc:`OSError` if the watch cannot be set up.
+    """
+
+    #: The names that arrived since the last callback.
+    names = ()
+
+    def __init__(self, path, mask=IN_ARRIVED):
+        self.path = path
+        libc = _get_libc()
+        self._fd = _check(libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        try:
+            _check(libc.inotify_add_watch(self._fd, os.fsencode(path), mask))
+        except OSError:
+            os.close(self._fd)
+            raise
+        self._io = gevent.get_hub().loop.io(self._fd, 1)
+        self._callback = None
+
+    @property
+    def active(self):
+        return self._io is not None and self._io.active
+
+    def start(self, callback):
+        self._callback = callback
+        self._io.start(self._readable)
+
+    def stop(self):
+        if self._io is not None:
+            self._io.stop()
+
+    def close(self):
+        if self._io is not None:
+            self._io.stop()
+            self._io.close()
+            self._io = None
+            os.close(self._fd)
+            self._fd = -1
+
+    def _read_events(self):
+        names = []
+        overflowed = False
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            except OSError as ex: # pragma: no cover
+                if ex.errno == errno.EINTR:
+                    continue
+                raise
+            offset = 0
+            while offset < len(data):
+                _wd, mask, _cookie, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & IN_Q_OVERFLOW: # pragma: no cover
+                    logger.warning("Overflow watching %s; events lost", self.path)
+                    overflowed = True
+                elif name and not mask & IN_IGNORED and not name.startswith(b'.'):
+                    names.append(os.fsdecode(name))
+            if not data: # pragma: no cover
+                break
+        return names, overflowed
+
+    def _readable(self):
+        names, overflowed = self._read_events()
+        if not names and not overflowed:
+            return
+        self.names = tuple(names)
+        try:
+            self._callback()
+        finally:
+            self.names = ()
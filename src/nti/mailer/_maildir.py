@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Maildir extensions used by the queue processors in :mod:`nti.mailer.queue`.
+
+"""
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+import os
+import time
+import errno
+import socket
+
+from repoze.sendmail.maildir import Maildir
+from repoze.sendmail.queue import MAX_SEND_TIME
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The directory, in the top level of the maildir, holding a
+#: subdirectory for each worker's claimed messages.
+LEASE_DIR_NAME = 'lease'
+
+_HEARTBEAT_NAME = '.heartbeat'
+
+#: The directory, in the top level of the maildir, holding
+#: messages that could not be sent (itself a maildir).
+FAILED_DIR_NAME = 'failed'
+
+# Separates a message's name from its retry state:
+# ``<name>:retry=<attempts>,<not before>``.
+_RETRY_MARKER = ':retry='
+
+
+def default_worker_id():
+    """
+    An identifier for the current process, unique among all
+    processes sharing a maildir: ``hostname.pid``.
+    """
+    return '%s.%d' % (socket.gethostname(), os.getpid())
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError: # pragma: no cover
+        # It exists, it's just not ours.
+        pass
+    return True
+
+
+def _listdir(path):
+    try:
+        return [name for name in os.listdir(path) if not name.startswith('.')]
+    except FileNotFoundError:
+        return []
+
+
+def retry_state(filename):
+    """
+    The number of failed attempts to send the message *filename*,
+    and the time (as from :func:`time.time`) before which it should
+    not be tried again, as recorded in its name by :func:`retry_filename`.
+    """
+    _, marker, state = os.path.basename(filename).partition(_RETRY_MARKER)
+    if marker:
+        attempts, _, not_before = state.partition(',')
+        try:
+            return int(attempts), int(not_before)
+        except ValueError:
+            pass
+    return 0, 0
+
+
+def maildir_path(filename):
+    """
+    The path of the maildir holding the message *filename*, which is
+    in its ``new/`` or ``cur/`` directory, or in a
+    :class:`ClaimingMaildir` lease directory.
+    """
+    head = os.path.dirname(os.path.dirname(filename))
+    if os.path.basename(head) == LEASE_DIR_NAME:
+        head = os.path.dirname(head)
+    return head
+
+
+def claimable_messages(maildir, accept=None):
+    """
+    Iterate the messages of *maildir*, like ``iter(maildir)``, but
+    skipping those (given as the path they have before being claimed)
+    for which *accept* returns false. A maildir that claims messages
+    as they are iterated (like :class:`ClaimingMaildir`) doesn't claim
+    those.
+    """
+    claimable = getattr(maildir, 'claimable', None)
+    if claimable is not None:
+        return claimable(accept)
+    messages = iter(maildir)
+    return messages if accept is None else (m for m in messages if accept(m))
+
+
+def retry_filename(filename, attempts, not_before):
+    """
+    Return the name *filename* should be renamed to (in the same
+    directory) to record its retry state.
+    """
+    head, tail = os.path.split(filename)
+    tail = tail.partition(_RETRY_MARKER)[0]
+    return os.path.join(head, '%s%s%d,%d' % (tail, _RETRY_MARKER, attempts, not_before))
+
+
+class ClaimingMaildir(Maildir):
+    """
+    A maildir that several processes can work through at the same time
+    without sending any message twice.
+
+    Iterating claims messages one at a time, oldest first, by renaming
+    them from ``new/`` (or ``cur/``) into this worker's lease directory,
+    ``lease/<worker_id>/``. The rename is atomic, so exactly one worker
+    gets each message; the paths we yield are those in our lease
+    directory, where repoze's queue processor claims, sends and removes
+    them as usual. Messages that aren't sent stay in our lease directory
+    and are tried again the next time we iterate.
+
+    Each iteration also looks for the lease directories of workers that
+    have gone away and moves their messages back into ``new/`` for
+    anyone to claim. A worker on this host is gone if its process no
+    longer exists; workers on other hosts are gone if they haven't
+    iterated in *lease_timeout* seconds. (While iterating, we show
+    we're still here at most every *heartbeat_interval* seconds, so
+    a long pass over the queue doesn't lose our lease.) A message that
+    a dead worker may have been in the middle of sending is left alone
+    until repoze's ``MAX_SEND_TIME`` passes, just as repoze would do.
+    """
+
+    _hostname = staticmethod(socket.gethostname)
+
+    def __init__(self, path, worker_id=None, create=False, lease_timeout=3600,
+                 heartbeat_interval=60):
+        # pylint:disable=too-many-positional-arguments,too-many-arguments
+        super().__init__(path, create=create)
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.lease_root = os.path.join(path, LEASE_DIR_NAME)
+        self.lease_path = os.path.join(self.lease_root, self.worker_id)
+        self._last_heartbeat = None
+        os.makedirs(self.lease_path, exist_ok=True)
+
+    def _heartbeat(self):
+        heartbeat = os.path.join(self.lease_path, _HEARTBEAT_NAME)
+        with open(heartbeat, 'ab'):
+            pass
+        os.utime(heartbeat, None)
+        self._last_heartbeat = time.time()
+
+    def _keep_alive(self):
+        if time.time() - self._last_heartbeat >= self.heartbeat_interval:
+            self._heartbeat()
+
+    def _lease_is_stale(self, worker_id, lease_path):
+        host, _, pid = worker_id.rpartition('.')
+        if host == self._hostname() and pid.isdigit():
+            return not _pid_alive(int(pid))
+        try:
+            age = time.time() - os.path.getmtime(os.path.join(lease_path, _HEARTBEAT_NAME))
+        except OSError:
+            age = time.time() - os.path.getmtime(lease_path)
+        return age > self.lease_timeout
+
+    def _may_be_sending(self, lease_path, name):
+        try:
+            age = time.time() - os.path.getmtime(os.path.join(lease_path, '.sending-' + name))
+        except OSError:
+            return False
+        return age <= MAX_SEND_TIME
+
+    def recover_stale_leases(self):
+        """
+        Move messages claimed by workers that have gone away back
+        into ``new/``.
+
+        :return: The number of messages recovered.
+        """
+        recovered = 0
+        for worker_id in _listdir(self.lease_root):
+            lease_path = os.path.join(self.lease_root, worker_id)
+            if worker_id == self.worker_id or not self._lease_is_stale(worker_id, lease_path):
+                continue
+            count = self._recover_lease(lease_path)
+            if count:
+                logger.warning("Recovered %d messages claimed by %s", count, worker_id)
+            recovered += count
+        return recovered
+
+    def _recover_lease(self, lease_path):
+        count = 0
+        new = os.path.join(self.path, 'new')
+        for name in _listdir(lease_path):
+            if self._may_be_sending(lease_path, name):
+                continue
+            try:
+                os.rename(os.path.join(lease_path, name), os.path.join(new, name))
+            except FileNotFoundError: # pragma: no cover
+                # Another worker recovered it first.
+                continue
+            count += 1
+        self._remove_lease(lease_path)
+        return count
+
+    def _remove_lease(self, lease_path):
+        try:
+            for name in os.listdir(lease_path):
+                self._clean_up_mark(lease_path, name)
+            os.rmdir(lease_path)
+        except OSError as ex:
+            # Still in use, or some other worker cleaned it up.
+            if ex.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT): # pragma: no cover
+                raise
+
+    def _clean_up_mark(self, lease_path, name):
+        # Keep only the marks of messages that may still be being
+        # sent. Keep the record of rejected messages, as repoze does,
+        # but where a reader won't find it.
+        path = os.path.join(lease_path, name)
+        if name.startswith('.rejected-'):
+            os.rename(path, os.path.join(self.path, 'cur', name))
+            return
+        if name.startswith('.sending-'):
+            if not os.path.exists(os.path.join(lease_path, name[len('.sending-'):])):
+                os.unlink(path)
+            return
+        if name.startswith('.'):
+            os.unlink(path)
+
+    def _claim(self, filename):
+        target = os.path.join(self.lease_path, os.path.basename(filename))
+        try:
+            os.rename(filename, target)
+        except FileNotFoundError:
+            # Somebody else got it.
+            return None
+        return target
+
+    def __iter__(self):
+        return self.claimable()
+
+    def claimable(self, accept=None):
+        """
+        Iterate, claiming only the messages for which *accept* (if
+        given) returns true; see :func:`claimable_messages`.
+        """
+        self._heartbeat()
+        self.recover_stale_leases()
+
+        # Anything we claimed before and didn't get sent.
+        for name in _listdir(self.lease_path):
+            filename = os.path.join(self.lease_path, name)
+            if accept is None or accept(filename):
+                self._keep_alive()
+                yield filename
+
+        # Sort by modification time so earlier messages are sent before
+        # later messages, as the superclass does.
+        candidates = []
+        for subdir in 'new', 'cur':
+            subdir = os.path.join(self.path, subdir)
+            for name in _listdir(subdir):
+                filename = os.path.join(subdir, name)
+                try:
+                    candidates.append((os.path.getmtime(filename), filename))
+                except FileNotFoundError:
+                    continue
+        candidates.sort()
+        for _, filename in candidates:
+            if accept is not None and not accept(filename):
+                continue
+            claimed = self._claim(filename)
+            if claimed is not None:
+                self._keep_alive()
+                yield claimed
+
+
+class _Lane(object):
+    """
+    One maildir being drained by a :class:`PriorityMaildir`.
+    """
+
+    def __init__(self, maildir, accept=None):
+        self.maildir = maildir
+        self.accept = accept
+        self.seen = set()
+        self._messages = None
+        self._stamp = None
+
+    def _directory_stamp(self):
+        stamp = []
+        for subdir in 'new', 'cur':
+            try:
+                stamp.append(os.stat(os.path.join(self.maildir.path, subdir)).st_mtime_ns)
+            except OSError: # pragma: no cover
+                stamp.append(None)
+        return stamp
+
+    def next(self):
+        """
+        Return the next message we haven't yet returned, or None.
+
+        Once we've returned everything, we only look again if the
+        directory has changed, so this is cheap to call often.
+        """
+        while True:
+            if self._messages is not None:
+                for filename in self._messages:
+                    if filename not in self.seen:
+                        self.seen.add(filename)
+                        return filename
+                self._messages = None
+            stamp = self._directory_stamp()
+            if stamp == self._stamp:
+                return None
+            self._stamp = stamp
+            self._messages = claimable_messages(self.maildir, self.accept)
+
+
+class PriorityMaildir(object):
+    """
+    Presents several maildirs, the *lanes*, highest priority first,
+    as one, for :class:`repoze.sendmail.queue.QueueProcessor`.
+
+    If *weights* is not given, the order is strict: before each
+    message, we look for one in each higher priority lane, so mail
+    arriving there while we work through a long backlog in a lower
+    one doesn't wait behind it. If *weights* is given (one positive
+    integer for each lane), each round takes up to that many messages
+    from each lane in turn, so that lower priority lanes make some
+    progress however busy the higher ones are.
+
+    Iterating returns each message at most once. Our :attr:`path` is
+    that of the first lane.
+    """
+
+    def __init__(self, lanes, weights=None):
+        self.lanes = tuple(lanes)
+        if weights is not None:
+            weights = tuple(weights)
+            if len(weights) != len(self.lanes) or min(weights) < 1:
+                raise ValueError("Need a positive weight for each lane", weights)
+        self.weights = weights
+        self.path = self.lanes[0].path
+
+    def __iter__(self):
+        return self.claimable()
+
+    def claimable(self, accept=None):
+        """
+        Iterate the messages of each lane for which *accept* (if
+        given) returns true; see :func:`claimable_messages`.
+        """
+        lanes = [_Lane(maildir, accept) for maildir in self.lanes]
+        if self.weights is None:
+            return self._strict(lanes)
+        return self._weighted(lanes)
+
+    @staticmethod
+    def _strict(lanes):
+        while True:
+            for lane in lanes:
+                filename = lane.next()
+                if filename is not None:
+                    yield filename
+                    break
+            else:
+                return
+
+    def _weighted(self, lanes):
+        while True:
+            progressed = False
+            for lane, weight in zip(lanes, self.weights):
+                for _ in range(weight):
+                    filename = lane.next()
+                    if filename is None:
+                        break
+                    progressed = True
+                    yield filename
+            if not progressed:
+                return
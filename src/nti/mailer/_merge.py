@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Mail merge: rendering templates once for many recipients.
+
+When the messages for many recipients differ only in a few values,
+such as their name and a link, rendering the templates and inlining
+their CSS for each of them is wasted work. Instead, a
+:class:`MergeTemplate` renders them once with placeholders in place
+of those values, and then each recipient's message is made by
+substituting (and escaping) the recipient's values for the
+placeholders.
+
+Each merge field is named by the template argument holding it, or
+by a dotted path into one, such as ``profile.realname`` (which a page
+template would use as ``options/profile/realname``). Each has a type:
+
+``text``
+    Plain text. It is HTML escaped in the HTML part.
+``url``
+    Like text, but it must be an ``http``, ``https`` or ``mailto``
+    URL, or a relative one.
+
+When the templates are rendered, each field is a unique string
+(and the objects on the way to it have only the attributes leading to
+fields), so templates can interpolate fields into text or
+attribute values, but can't otherwise use them: since their values
+aren't known yet, they can't be tested (``tal:condition``), iterated,
+compared, transformed or used in CSS.
+"""
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+import re
+import os
+from html import escape
+from urllib.parse import urlsplit
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The type of merge fields holding plain text.
+TEXT = 'text'
+#: The type of merge fields holding URLs.
+URL = 'url'
+
+_URL_SCHEMES = ('http', 'https', 'mailto', '')
+
+
+def _check_url(value):
+    if urlsplit(value).scheme.lower() not in _URL_SCHEMES:
+        raise ValueError("Not an allowed URL for a merge field", value)
+    return value
+
+
+_CHECKS = {
+    TEXT: None,
+    URL: _check_url,
+}
+
+
+class _Namespace(object):
+    """
+    Stands in for an argument that leads to merge fields when
+    rendering, with an attribute (and item) for each step towards them.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._children = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._children:
+            raise AttributeError(name)
+        return self._children[name]
+
+    def __getitem__(self, name):
+        return self._children[name]
+
+    def __repr__(self):
+        return '<merge fields in %s>' % self._name
+
+
+class MergeTemplate(object):
+    """
+    The parts of rendered templates, with the places to put the
+    values of the merge fields.
+
+    Render the templates with the :meth:`placeholders` among their
+    arguments, pass the results to :meth:`compile`, and then
+    :meth:`fill` them with each recipient's values.
+
+    :param dict fields: Maps the name of each merge field to its type.
+    """
+
+    def __init__(self, fields):
+        for name, kind in fields.items():
+            if kind not in _CHECKS:
+                raise ValueError("Unknown type for merge field", name, kind)
+        self.fields = dict(fields)
+        self._paths = [tuple(name.split('.')) for name in self.fields]
+        self._checks = [_CHECKS[kind] for kind in self.fields.values()]
+        # The tokens are unguessable, so that nothing but our
+        # placeholders produce them.
+        self._prefix = 'nti-merge-' + os.urandom(8).hex() + '-'
+        self._pattern = re.compile(re.escape(self._prefix) + r'(\d+)-')
+        self._parts = None
+
+    def placeholders(self):
+        """
+        The template arguments to render with.
+        """
+        result = {}
+        for index, path in enumerate(self._paths):
+            container = result
+            for i, name in enumerate(path[:-1]):
+                node = container.get(name)
+                if node is None:
+                    node = container[name] = _Namespace('.'.join(path[:i + 1]))
+                elif not isinstance(node, _Namespace):
+                    raise ValueError("Merge field inside another", '.'.join(path))
+                # Private, so that templates can't confuse it with a
+                # merge field of the same name.
+                container = node._children # pylint:disable=protected-access
+            if path[-1] in container:
+                raise ValueError("Merge field inside another", '.'.join(path))
+            container[path[-1]] = '%s%d-' % (self._prefix, index)
+        return result
+
+    def compile(self, *rendered):
+        """
+        Remember the *rendered* templates (texts rendered with
+        :meth:`placeholders`, in order).
+        """
+        self._parts = [self._pattern.split(text) for text in rendered]
+
+    @staticmethod
+    def _resolve(values, path, check):
+        value = values[path[0]]
+        for name in path[1:]:
+            try:
+                value = getattr(value, name)
+            except AttributeError:
+                value = value[name]
+        value = str(value)
+        return check(value) if check is not None else value
+
+    def fill(self, values, escaped=(0,)):
+        """
+        Return the rendered templates with the merge field values from
+        *values* (a mapping holding each argument with fields) in place
+        of the placeholders. The templates whose indices are in *escaped*
+        are HTML; values are escaped for them.
+        """
+        if self._parts is None:
+            raise ValueError("Not compiled")
+        resolved = [self._resolve(values, path, check)
+                    for path, check in zip(self._paths, self._checks)]
+        html = [escape(value) for value in resolved]
+        return [self._substitute(parts, html if i in escaped else resolved)
+                for i, parts in enumerate(self._parts)]
+
+    @staticmethod
+    def _substitute(parts, substitutes):
+        # Odd parts are the indices of fields.
+        return ''.join(part if not j % 2 else substitutes[int(part)]
+                       for j, part in enumerate(parts))
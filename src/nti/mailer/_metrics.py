@@ -0,0 +1,523 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A minimal, dependency-free implementation of Prometheus metrics
+and the text exposition format, and the metrics the queue processor
+keeps with it (:class:`QueueMetrics`).
+
+Only what the queue processor needs is here: counters, gauges
+(set directly or computed when scraped), histograms and summaries,
+with optional labels, collected in a :class:`MetricsRegistry` and served
+over HTTP by a :class:`MetricsServer`.
+
+"""
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+import os
+import math
+import time
+import threading
+import contextlib
+from collections import deque
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The content type of :meth:`MetricsRegistry.exposition`.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+#: The default histogram buckets, in seconds, as used by the
+#: Prometheus client libraries.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value):
+    value = float(value)
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if math.isnan(value):
+        return 'NaN'
+    return repr(value)
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape_label_value(value))
+                             for name, value in labels)
+
+
+class _Metric(object):
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("Expected labels %s, got %s" % (self.labelnames, sorted(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key):
+        return tuple(zip(self.labelnames, key))
+
+    def samples(self):
+        """
+        Yield ``(name, labels, value)`` for each sample, where *labels*
+        is a sequence of ``(name, value)`` pairs.
+        """
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name, self._labels(key), value
+
+
+class Counter(_Metric):
+    """
+    A value that only goes up.
+    """
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """
+    A value that can go up and down.
+
+    If *function* is given, it is called each time we are collected.
+    Without labels, it returns the value; with them, it returns an
+    iterable of ``(labels, value)`` pairs, where *labels* is a
+    dictionary.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.function is None:
+            yield from super().samples()
+            return
+        try:
+            result = self.function()
+        except Exception: # pylint:disable=broad-except
+            logger.exception("Failed to collect %s", self.name)
+            return
+        if not self.labelnames:
+            if result is not None:
+                yield self.name, (), result
+            return
+        for labels, value in result:
+            yield self.name, self._labels(self._key(labels)), value
+
+
+class Histogram(_Metric):
+    """
+    Counts observations (such as durations, in seconds) in
+    cumulative *buckets*.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = counts, total + value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """
+        Observe how long the body of the ``with`` statement takes.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        counts, _ = self._values.get(self._key(labels)) or ((), 0)
+        return sum(counts)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total))
+                            for key, (counts, total) in self._values.items())
+        for key, (counts, total) in values:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield (self.name + '_bucket',
+                       labels + (('le', _format_value(bound)),),
+                       cumulative)
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, cumulative
+
+
+class Summary(_Metric):
+    """
+    Reports *quantiles* of the most recent *max_samples* observations
+    (for each set of labels), along with the count and sum of all of them.
+    """
+
+    kind = 'summary'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 quantiles=(0.5, 0.9, 0.99), max_samples=1024):
+        # pylint:disable=too-many-positional-arguments
+        super().__init__(name, documentation, labelnames)
+        self.quantiles = tuple(quantiles)
+        self.max_samples = max_samples
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            window, count, total = self._values.get(key) or (deque(maxlen=self.max_samples),
+                                                             0, 0)
+            window.append(value)
+            self._values[key] = window, count + 1, total + value
+
+    def quantile(self, q, **labels):
+        """
+        The *q* quantile of the recent observations, or None if
+        there are none.
+        """
+        with self._lock:
+            window, _, _ = self._values.get(self._key(labels)) or ((), 0, 0)
+            return self._quantile(sorted(window), q)
+
+    @staticmethod
+    def _quantile(ordered, q):
+        if not ordered:
+            return None
+        # Nearest rank.
+        return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (sorted(window), count, total))
+                            for key, (window, count, total) in self._values.items())
+        for key, (ordered, count, total) in values:
+            labels = self._labels(key)
+            for q in self.quantiles:
+                yield (self.name,
+                       labels + (('quantile', _format_value(q)),),
+                       self._quantile(ordered, q))
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, count
+
+
+class MetricsRegistry(object):
+    """
+    A collection of metrics, in the order they were created.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self._add(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def summary(self, name, documentation, labelnames=(),
+                quantiles=(0.5, 0.9, 0.99), max_samples=1024):
+        # pylint:disable=too-many-positional-arguments
+        return self._add(Summary(name, documentation, labelnames, quantiles, max_samples))
+
+    def exposition(self):
+        """
+        Return all our metrics in the Prometheus text format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (
+                metric.name,
+                metric.documentation.replace('\\', r'\\').replace('\n', r'\n')))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    server_version = 'nti.mailer'
+
+    def log_message(self, format, *args): # pylint:disable=redefined-builtin
+        logger.debug(format, *args)
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        data = self.server.registry.exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class MetricsServer(object):
+    """
+    Serves the metrics in *registry* at ``/metrics`` on *host* and
+    *port* (by default, an unused port on localhost) from a daemon
+    thread, so it works no matter what the main thread is doing.
+
+    Use an instance as a context manager, or call :meth:`start` and
+    :meth:`stop`.
+    """
+
+    def __init__(self, registry, host='127.0.0.1', port=0):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d/metrics' % (self.host, self.port)
+
+    def start(self):
+        """
+        Start serving. Raises :exc:`OSError` if we can't listen
+        on the port.
+        """
+        server = ThreadingHTTPServer((self.host, self.port), _Handler)
+        server.daemon_threads = True
+        server.registry = self.registry
+        self.port = server.server_address[1]
+        self._server = server
+        self._thread = threading.Thread(target=server.serve_forever,
+                                        name='MetricsServer',
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, t, v, tb):
+        self.stop()
+
+
+def _scan_maildir_subdir(path):
+    """
+    Return the number of messages in the maildir subdirectory *path*
+    and the modification time of the oldest (or None).
+    """
+    count = 0
+    oldest = None
+    try:
+        entries = os.scandir(path)
+    except OSError:
+        return count, oldest
+    with entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                mtime = entry.stat().st_mtime
+            except OSError: # pragma: no cover
+                # Sent while we looked.
+                continue
+            count += 1
+            if oldest is None or mtime < oldest:
+                oldest = mtime
+    return count, oldest
+
+
+class QueueMetrics(object): # pylint:disable=too-many-instance-attributes
+    """
+    The metrics kept by the queue processor, in Prometheus form.
+
+    Give an instance to the mailer (:class:`nti.mailer._ses.SESMailer`)
+    and to the queue processor (:class:`nti.mailer.queue.MailerWatcher`
+    or :class:`nti.mailer.queue.LoopingMailerProcess`) as their
+    *metrics*, and serve
+    :attr:`registry` with :meth:`serve`. The queue's depth and the age
+    of its oldest message are measured each time the metrics are
+    collected, for the lanes of the processor given to :meth:`track`.
+
+    Each metric is an attribute, for callers to record in.
+
+    .. versionadded:: 1.0.1
+    """
+
+    # Hook for testing.
+    _time = staticmethod(time.time)
+
+    def __init__(self, registry=None):
+        self.registry = registry = registry if registry is not None else MetricsRegistry()
+        self._process = None
+        # The scan made for queue_messages, kept (by the collecting
+        # thread) for oldest_message_age, which is collected next.
+        self._scanned = threading.local()
+        self.queue_messages = registry.gauge(
+            'nti_mailer_queue_messages',
+            'Messages waiting in the queue, by lane and maildir subdirectory.',
+            ('lane', 'state'), self._collect_queue_messages)
+        self.oldest_message_age = registry.gauge(
+            'nti_mailer_queue_oldest_message_age_seconds',
+            'Age of the oldest message waiting in each lane of the queue.',
+            ('lane',), self._collect_oldest_message_age)
+        self.messages_sent = registry.counter(
+            'nti_mailer_messages_sent_total',
+            'Messages sent.')
+        self.messages_failed = registry.counter(
+            'nti_mailer_messages_failed_total',
+            'Attempts to send a message that failed, by error.',
+            ('error',))
+        self.ses_request_duration = registry.histogram(
+            'nti_mailer_ses_request_seconds',
+            'Time taken by SES SendRawEmail calls.')
+        self.throttled = registry.counter(
+            'nti_mailer_ses_throttled_total',
+            'Sends that SES throttled.')
+        self.drain_duration = registry.histogram(
+            'nti_mailer_queue_drain_seconds',
+            'Time taken by each pass over the queue.',
+            buckets=(0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600))
+        self.delivery_latency = registry.summary(
+            'nti_mailer_delivery_latency_seconds',
+            'Time from queuing a message to SES accepting it, by template and priority.',
+            ('template', 'priority'))
+        self.delivery_latency_by_priority = registry.histogram(
+            'nti_mailer_delivery_latency_by_priority_seconds',
+            'Time from queuing a message to SES accepting it, by priority.',
+            ('priority',),
+            buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900, 3600))
+        self.debounce_deferrals = registry.counter(
+            'nti_mailer_debounce_deferrals_total',
+            'Times processing the queue was deferred because it ran recently.')
+        self.debounce_pending = registry.gauge(
+            'nti_mailer_debounce_pending',
+            'Deferrals waiting for the debounce interval to end (debouncer_count).',
+            function=self._collect_debounce_pending)
+
+    def delivered(self, latency, template, priority):
+        """
+        Record that a message from *template* queued with *priority*
+        was sent *latency* seconds after it was queued.
+        """
+        self.delivery_latency.observe(latency, template=template, priority=priority)
+        self.delivery_latency_by_priority.observe(latency, priority=priority)
+
+    def track(self, process):
+        """
+        Measure the queue processed by *process*.
+        """
+        self._process = process
+
+    def _scan(self):
+        process = self._process
+        if process is None:
+            return ()
+        return [(lane, state, _scan_maildir_subdir(os.path.join(path, state)))
+                for lane, path in zip(process.lanes, process.lane_paths)
+                for state in ('new', 'cur')]
+
+    def _collect_queue_messages(self):
+        scan = self._scanned.scan = self._scan()
+        return [({'lane': lane, 'state': state}, count)
+                for lane, state, (count, _) in scan]
+
+    def _collect_oldest_message_age(self):
+        scan = getattr(self._scanned, 'scan', None)
+        self._scanned.scan = None
+        if scan is None:
+            scan = self._scan()
+        oldest = {}
+        for lane, _, (_, mtime) in scan:
+            if mtime is not None:
+                oldest[lane] = min(mtime, oldest.get(lane, mtime))
+            else:
+                oldest.setdefault(lane, None)
+        now = self._time()
+        return [({'lane': lane}, max(0, now - mtime) if mtime is not None else 0)
+                for lane, mtime in oldest.items()]
+
+    def _collect_debounce_pending(self):
+        if self._process is None:
+            return None
+        return getattr(self._process, 'debouncer_count', 0)
+
+    def serve(self, host='127.0.0.1', port=0):
+        """
+        Start serving our metrics over HTTP.
+
+        :return: The started :class:`MetricsServer`.
+        :raises OSError: If we can't listen on *port*.
+        """
+        return MetricsServer(self.registry, host, port).start()
+
+
+def serve_metrics(metrics, host, port, ports=1):
+    """
+    Serve *metrics* on the first of *ports* ports, starting at
+    *port*, that is free, so that each of several workers gets its own.
+    """
+    for candidate in range(port, port + max(1, ports)):
+        try:
+            server = metrics.serve(host, candidate)
+        except OSError as ex:
+            logger.debug("Can't serve metrics on port %d: %s", candidate, ex)
+            continue
+        logger.info("Serving metrics at %s", server.url)
+        return server
+    logger.error("No free port for metrics in %d-%d", port, port + ports - 1)
+    return None
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Caching for the CSS inlining done by :func:`premailer.transform`.
+
+"""
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+import sys
+import hashlib
+import threading
+from collections import OrderedDict
+
+from premailer import transform
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class TransformCache(object):
+    """
+    A callable that inlines CSS like *transform* (by default,
+    :func:`premailer.transform`), remembering the results for the most
+    recently used inputs.
+
+    Many messages are rendered from the same template into the same
+    HTML, and inlining is expensive, so we look up each input by a
+    digest of its text and only transform it if we haven't seen it
+    recently. We keep at most *max_entries* results, using at most
+    *max_bytes* of memory (as measured by :func:`sys.getsizeof`),
+    discarding the least recently used first; results bigger than that
+    aren't kept at all.
+
+    :attr:`hits` and :attr:`misses` count how often we could and
+    couldn't use a remembered result.
+
+    This is thread safe. If several threads need the same result at
+    once, each may compute it.
+    """
+
+    def __init__(self, transform=transform, max_entries=256, max_bytes=32 * 1024 * 1024):
+        # pylint:disable=redefined-outer-name
+        self.transform = transform
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        #: The approximate memory used by our results.
+        self.nbytes = 0
+        self._results = OrderedDict() # digest -> (result, size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._results)
+
+    @staticmethod
+    def _digest(html):
+        if isinstance(html, str):
+            html = html.encode('utf-8', 'surrogatepass')
+        return hashlib.blake2b(html, digest_size=20).digest()
+
+    def __call__(self, html):
+        key = self._digest(html)
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        result = self.transform(html)
+        size = sys.getsizeof(result)
+        if self.max_entries > 0 and size <= self.max_bytes:
+            with self._lock:
+                if key not in self._results:
+                    self._results[key] = (result, size)
+                    self.nbytes += size
+                    self._evict()
+        return result
+
+    def _evict(self):
+        results = self._results
+        while len(results) > self.max_entries or self.nbytes > self.max_bytes:
+            _, (_, size) = results.popitem(last=False)
+            self.nbytes -= size
+
+    def clear(self):
+        """
+        Forget all our results, and reset the counters.
+        """
+        with self._lock:
+            self._results.clear()
+            self.nbytes = self.hits = self.misses = 0
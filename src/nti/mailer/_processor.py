@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A queue processor that sends several messages at the same time,
+retrying those that fail.
+
+"""
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+import io
+import os
+import time
+import threading
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+from botocore.exceptions import ClientError
+
+from repoze.sendmail.encoding import encode_message
+
+from repoze.sendmail.maildir import Maildir
+
+from repoze.sendmail.queue import QueueProcessor
+
+from nti.mailer.delivery import DEFAULT_PRIORITY
+from nti.mailer.delivery import PRIORITY_HEADER
+from nti.mailer.delivery import QUEUED_AT_HEADER
+from nti.mailer.delivery import RENDER_JOB_HEADER
+from nti.mailer.delivery import TEMPLATE_HEADER
+from nti.mailer.delivery import TRACKING_HEADERS
+
+from nti.mailer.interfaces import IRawMessageMailer
+
+from nti.mailer._batch import job_recipients
+from nti.mailer._batch import render_job
+
+from nti.mailer._maildir import FAILED_DIR_NAME
+from nti.mailer._maildir import claimable_messages
+from nti.mailer._maildir import retry_filename
+from nti.mailer._maildir import retry_state
+from nti.mailer._maildir import maildir_path
+
+from nti.mailer._ses import _error_class
+from nti.mailer._ses import _is_server_error
+from nti.mailer._ses import _is_throttling_error
+
+logger = __import__('logging').getLogger(__name__)
+
+
+#: The error codes SES uses for problems with the message itself,
+#: which no amount of retrying will fix.
+_PERMANENT_ERROR_CODES = frozenset((
+    'MessageRejected',
+    'MailFromDomainNotVerifiedException',
+    'ConfigurationSetDoesNotExistException',
+    'InvalidParameterValue',
+))
+
+def _is_permanent_error(ex):
+    """
+    Should we give up on a message whose sending raised *ex*?
+    """
+    if isinstance(ex, _UnparseableMessage):
+        return True
+    if not isinstance(ex, ClientError):
+        return False
+    return ex.response.get('Error', {}).get('Code') in _PERMANENT_ERROR_CODES
+
+
+class _UnparseableMessage(Exception):
+    """
+    Recorded when a queued message can't be parsed.
+    """
+
+
+class _OutcomeRecordingMailer(object):
+    """
+    Wraps a mailer for :class:`MailQueueProcessor`, recording the
+    exception raised by ``send`` in *outcome* before letting the
+    superclass handle it.
+    """
+
+    def __init__(self, mailer, outcome):
+        self.mailer = mailer
+        self.outcome = outcome
+
+    def __getattr__(self, name):
+        return getattr(self.mailer, name)
+
+    def send(self, fromaddr, toaddrs, message):
+        try:
+            self.mailer.send(fromaddr, toaddrs, message)
+        except Exception as ex:
+            self.outcome.error = ex
+            raise
+        self.outcome.sent = True
+
+
+#: The headers the queue processor removes before sending (lower case).
+_UNSENT_HEADERS = frozenset((
+    'x-actually-from',
+    'x-actually-to',
+    'bcc',
+) + tuple(name.lower() for name in TRACKING_HEADERS))
+
+
+def _split_raw_message(data):
+    """
+    Split the bytes of a message into the header block and the
+    rest (beginning with the blank line that ends the headers).
+    """
+    # Whichever comes first: a message with CRLF line endings may
+    # have bare newlines in its body, and vice versa.
+    found = [(index, len(separator) // 2)
+             for separator in (b'\n\n', b'\r\n\r\n')
+             for index in (data.find(separator),)
+             if index != -1]
+    if not found:
+        return data, b''
+    index, length = min(found)
+    return data[:index + length], data[index + length:]
+
+
+def _strip_raw_headers(headers, names):
+    """
+    Remove the header fields named in *names* (lower case) from the
+    bytes of a header block, including their continuation lines.
+    """
+    result = []
+    keep = True
+    for line in headers.splitlines(True):
+        if line[:1] not in (b' ', b'\t'):
+            name = line.split(b':', 1)[0].strip().decode('ascii').lower()
+            keep = name not in names
+        if keep:
+            result.append(line)
+    return b''.join(result)
+
+
+class MailQueueProcessor(QueueProcessor):
+    """
+    A :class:`repoze.sendmail.queue.QueueProcessor` that can send
+    several messages at the same time.
+
+    Each message is still claimed, sent and unlinked by the
+    superclass's ``_send_message``, so the protocol that keeps two
+    processors from sending the same message is unchanged; we just
+    run up to *concurrency* of those at once.
+
+    We use native threads, not greenlets, because the mailer does
+    blocking I/O (boto3 is not cooperative unless the process has
+    been monkey-patched, which we don't do), and because the queue
+    is frequently processed from inside a callback running in the
+    gevent hub, where we are not allowed to block. The mailer must
+    therefore be thread safe if *concurrency* is greater than one.
+
+    If the mailer has a ``quota_available`` method (like
+    :class:`~nti.mailer._ses.SESMailer`), we ask it before claiming
+    each message, and stop (setting :attr:`paused`) if it returns
+    false. The remaining messages are left in the queue.
+
+    If the mailer has a ``prepare`` method (like
+    :class:`~nti.mailer._ses.SESMailer`), we call it before claiming
+    any messages. If it raises an exception, we don't send anything
+    (and set :attr:`paused` and :attr:`not_ready`), so that the
+    failure doesn't count against any message.
+
+    If the mailer provides
+    :class:`~nti.mailer.interfaces.IRawMessageMailer` (like
+    :class:`~nti.mailer._ses.SESMailer`), we don't parse and re-encode
+    each message before handing it over. Instead, we read the queued bytes, parse
+    only the headers to find the sender and recipients, remove the
+    headers that mustn't be sent (including ``Bcc``), and pass the rest
+    on unchanged. :mod:`repoze.sendmail` encodes messages before
+    queuing them, so this is what the mailer would have sent anyway.
+
+    When sending a message fails, we record the failure in the
+    message's name (see :func:`nti.mailer._maildir.retry_filename`)
+    and don't try it again for *retry_delay* seconds, doubling each
+    time up to *max_retry_delay*. After *max_attempts* failures, or a
+    failure that retrying can't fix (such as SES rejecting the message,
+    or our being unable to parse it), we move it to the ``failed``
+    maildir inside the maildir (such as the priority lane) it was
+    queued in. Being throttled doesn't count as a
+    failure. :attr:`next_retry` tells when the earliest message we
+    skipped or postponed may be tried again.
+
+    The headers that :func:`nti.mailer.interfaces.ITemplatedMailer.queue_simple_html_text_email`
+    adds to track messages (:data:`nti.mailer.delivery.TRACKING_HEADERS`)
+    are removed before sending.
+
+    Messages it queued with *deferred* are jobs that we render (with
+    :attr:`render_job`) just before sending them, to the recipients
+    the job gives (see :func:`~nti.mailer._batch.job_recipients`).
+    If that fails, we retry it as if sending failed.
+
+    If *metrics* (a :class:`nti.mailer._metrics.QueueMetrics`) is
+    given, we count the messages we send and fail to send in it,
+    and, using those headers, record how long each message took from
+    being queued to being sent.
+
+    .. versionadded:: 1.0.1
+    """
+
+    #: Set to true if we stopped early because the send
+    #: quota was exhausted, or the mailer couldn't get ready to send.
+    paused = False
+
+    #: Set to true if we stopped because the mailer couldn't get
+    #: ready to send.
+    not_ready = False
+
+    #: When (as from :func:`time.time`) the earliest message we
+    #: postponed may be retried, or None.
+    next_retry = None
+
+    #: Called with each queued render job (an :class:`email.message.Message`
+    #: marked with :data:`~nti.mailer.delivery.RENDER_JOB_HEADER`) to
+    #: get the message to send in its place.
+    render_job = staticmethod(render_job)
+
+    # Hook for testing.
+    _time = staticmethod(time.time)
+
+    def __init__(self, mailer, queue_path, Maildir=Maildir, # pylint:disable=redefined-outer-name
+                 ignore_transient=False, concurrency=1,
+                 max_attempts=10, retry_delay=60, max_retry_delay=3600,
+                 metrics=None):
+        # pylint:disable=too-many-positional-arguments,too-many-arguments
+        self.metrics = metrics
+        self.raw_messages = IRawMessageMailer.providedBy(mailer) # pylint:disable=no-value-for-parameter
+        self._outcome = threading.local()
+        mailer = _OutcomeRecordingMailer(mailer, self._outcome)
+        super().__init__(mailer, queue_path, Maildir=Maildir, ignore_transient=ignore_transient)
+        self.concurrency = max(1, concurrency)
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._lock = threading.Lock()
+
+    def _retry_at(self, not_before):
+        with self._lock:
+            if self.next_retry is None or not_before < self.next_retry:
+                self.next_retry = not_before
+
+    def _send_message(self, filename):
+        outcome = self._outcome
+        outcome.error = None
+        outcome.sent = False
+        outcome.tracking = None
+        super()._send_message(filename)
+        error = outcome.error
+        sent = outcome.sent
+        tracking = outcome.tracking
+        outcome.error = outcome.tracking = None
+        if self.metrics is not None:
+            self._record_outcome(sent, error, tracking)
+        if error is not None and os.path.exists(filename):
+            self._send_failed(filename, error)
+
+    def _record_outcome(self, sent, error, tracking):
+        metrics = self.metrics
+        if error is not None:
+            metrics.messages_failed.inc(error=_error_class(error))
+        elif sent:
+            metrics.messages_sent.inc()
+            if tracking is not None:
+                queued_at, template, priority = tracking
+                metrics.delivered(max(0, self._time() - queued_at), template, priority)
+
+    def _send_failed(self, filename, error):
+        # The superclass only removes its mark that the message is
+        # being sent when sending succeeds; until it's removed (or
+        # MAX_SEND_TIME passes) nobody will try the message again.
+        head, tail = os.path.split(filename)
+        try:
+            os.unlink(os.path.join(head, '.sending-' + tail))
+        except FileNotFoundError:
+            pass
+        if _is_throttling_error(error) and not _is_server_error(error):
+            # Not the message's fault. Try again soon, without
+            # counting it as an attempt.
+            self._retry_at(int(self._time() + self.retry_delay))
+            return
+        attempts, _ = retry_state(filename)
+        attempts += 1
+        if attempts >= self.max_attempts or _is_permanent_error(error):
+            self._move_to_failed(filename, attempts, error)
+            return
+
+        delay = min(self.max_retry_delay, self.retry_delay * 2 ** (attempts - 1))
+        not_before = int(self._time() + delay)
+        if os.path.basename(head) == 'new':
+            # Keep it out of the way of anyone watching for new mail.
+            head = os.path.join(os.path.dirname(head), 'cur')
+        target = retry_filename(os.path.join(head, tail), attempts, not_before)
+        try:
+            os.rename(filename, target)
+        except FileNotFoundError: # pragma: no cover
+            # Somebody else dealt with it.
+            return
+        logger.warning("Failed to send %s (attempt %d); retrying in %d seconds",
+                       tail, attempts, delay)
+        self._retry_at(not_before)
+
+    def _move_to_failed(self, filename, attempts, error):
+        # In the message's own lane, not necessarily the first.
+        failed = os.path.join(maildir_path(filename), FAILED_DIR_NAME)
+        Maildir(failed, create=True)
+        target = os.path.join(failed, 'new', os.path.basename(filename))
+        try:
+            os.rename(filename, target)
+        except FileNotFoundError: # pragma: no cover
+            return
+        logger.error("Giving up on sending %s after %d attempts (%s); moved to %s",
+                     os.path.basename(filename), attempts, error, target)
+
+    def _parseMessage(self, fp):
+        try:
+            return self._parse_message(fp)
+        except Exception as ex:
+            if self._outcome.error is None:
+                # We'll never be able to send this.
+                self._outcome.error = _UnparseableMessage(ex)
+            raise
+
+    def _parse_message(self, fp):
+        if self.raw_messages:
+            # The superclass opens the file in text mode, but we
+            # haven't read anything yet.
+            data = fp.buffer.read()
+            if data.isascii():
+                headers, body = _split_raw_message(data)
+                fromaddr, toaddrs, message = super()._parseMessage(
+                    io.StringIO(headers.decode('ascii')))
+                if message[RENDER_JOB_HEADER] is None:
+                    self._take_tracking_headers(message)
+                    return fromaddr, toaddrs, _strip_raw_headers(headers, _UNSENT_HEADERS) + body
+                fp = io.StringIO(data.decode('ascii'))
+            else:
+                # Not something we queued; let the email package
+                # deal with it.
+                fp = io.StringIO(data.decode('utf-8', 'replace')) # pragma: no cover
+
+        fromaddr, toaddrs, message = super()._parseMessage(fp)
+        self._take_tracking_headers(message)
+        if message[RENDER_JOB_HEADER] is not None:
+            toaddrs, message = self._render_job(message)
+            if self.raw_messages:
+                message = encode_message(message)
+        return fromaddr, toaddrs, message
+
+    def _render_job(self, job):
+        try:
+            return job_recipients(job), self.render_job(job)
+        except Exception as ex:
+            # Unlike a message we can't parse, this may work later
+            # (for example, once we're configured properly), so
+            # it's retried like a failure to send.
+            logger.exception("Failed to render job")
+            self._outcome.error = ex
+            raise
+
+    def _take_tracking_headers(self, message):
+        """
+        Remove the tracking headers from *message*, remembering
+        what they say for :meth:`_send_message`.
+        """
+        queued_at = message[QUEUED_AT_HEADER]
+        template = message[TEMPLATE_HEADER]
+        priority = message[PRIORITY_HEADER]
+        for name in TRACKING_HEADERS:
+            del message[name]
+        try:
+            queued_at = float(queued_at)
+        except (TypeError, ValueError):
+            # Not queued by us, or by an older version.
+            return
+        self._outcome.tracking = (queued_at,
+                                  str(template or 'unknown'),
+                                  str(priority or DEFAULT_PRIORITY))
+
+    def _claimable_messages(self):
+        quota_available = getattr(self.mailer, 'quota_available', None)
+        now = self._time()
+
+        # Decide before claiming, so that we don't hold on to (in
+        # our lease directory) messages we aren't going to send.
+        def should_send(filename):
+            if self.paused:
+                return False
+            _, not_before = retry_state(filename)
+            if not_before > now:
+                self._retry_at(not_before)
+                return False
+            if quota_available is not None and not quota_available():
+                logger.warning("Send quota exhausted; leaving remaining messages in the queue")
+                self.paused = True
+                return False
+            return True
+
+        return claimable_messages(self.maildir, should_send)
+
+    def send_messages(self):
+        prepare = getattr(self.mailer, 'prepare', None)
+        if prepare is not None:
+            try:
+                prepare()
+            except Exception: # pylint:disable=broad-except
+                logger.exception("Mailer not ready to send; leaving messages in the queue")
+                self.paused = self.not_ready = True
+                return
+
+        if self.concurrency == 1:
+            for filename in self._claimable_messages():
+                self._send_message(filename)
+            return
+
+        with ThreadPoolExecutor(self.concurrency,
+                                thread_name_prefix='nti.mailer.queue') as executor:
+            # Don't claim the whole directory up front; keep
+            # only a few messages waiting for each worker.
+            pending = set()
+            for filename in self._claimable_messages():
+                if len(pending) >= self.concurrency * 2:
+                    _, pending = wait(pending, return_when=FIRST_COMPLETED)
+                pending.add(executor.submit(self._send_message, filename))
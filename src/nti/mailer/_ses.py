@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A mailer that sends using the Amazon SES ``SendRawEmail`` API, and
+how to tell what its errors mean.
+
+"""
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+import contextlib
+from email.message import Message
+
+from zope import interface
+from zope.cachedescriptors.property import Lazy
+
+import boto3
+
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError
+from botocore.exceptions import ClientError
+
+from repoze.sendmail.encoding import encode_message
+
+from nti.mailer.interfaces import IRawMessageMailer
+
+from nti.mailer._throttle import AIMDController
+from nti.mailer._throttle import ConcurrencyLimiter
+from nti.mailer._throttle import TokenBucket
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _error_class(ex):
+    """
+    A short name for the kind of error *ex* is: the SES error code
+    for a :class:`botocore.exceptions.ClientError`, otherwise the
+    name of its class.
+    """
+    if isinstance(ex, ClientError):
+        code = ex.response.get('Error', {}).get('Code')
+        if code:
+            return code
+    return type(ex).__name__
+
+
+@interface.implementer(IRawMessageMailer)
+class SESMailer(object):
+    """
+    Sends mail using the SES ``SendRawEmail`` API.
+
+    If *max_send_rate* is given, sending is limited to that many
+    messages per second, where, as with SES, each destination address
+    counts as a separate message. The special value ``'auto'`` asks
+    SES for the account's maximum send rate when we :meth:`prepare`
+    (or, failing that, the first time it is needed). By default, or
+    if the rate is not positive (SES reports -1 for no limit), there
+    is no limit.
+
+    If *adaptive* is true, the send rate (if limited) and the number
+    of concurrent sends (at most *max_concurrency*) are adjusted by an
+    :class:`nti.mailer._throttle.AIMDController`: they back off when
+    SES throttles us or has a server error, and recover as sends
+    succeed.
+
+    If a :class:`nti.mailer._throttle.SendQuota` is given as
+    *quota*, it is kept up to date by the sends we make, and refreshed
+    from SES as needed by :meth:`quota_available`. Because the
+    quota is meant to be shared across many sends, it may be given to
+    more than one instance.
+
+    The boto3 client is created when first needed and kept until
+    :meth:`close`; it is safe to share between threads. Its connection
+    pool holds *max_pool_connections* connections (by default, enough
+    for *max_concurrency* concurrent sends), kept alive between
+    uses. *connect_timeout*, *read_timeout*, *retry_mode* and
+    *max_attempts* are passed to :class:`botocore.config.Config` if given.
+    *endpoint_url*, if given, is where we send requests instead of
+    the region's SES endpoint (for example, a
+    :class:`nti.mailer.testing.FakeSESServer`).
+
+    If *metrics* (a :class:`nti.mailer._metrics.QueueMetrics`) is
+    given, we record how long each call to SES takes, and how often
+    we are throttled, in it.
+
+    .. versionchanged:: 1.0.1
+       Add the *max_send_rate*, *adaptive*, *max_concurrency* and
+       *quota* arguments, and the keyword-only client configuration arguments.
+    """
+
+    #: The size of botocore's connection pool if we don't need more.
+    _DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+    #: The value of *max_send_rate* that means to ask SES.
+    DISCOVER_SEND_RATE = 'auto'
+
+    def __init__(self, region='us-east-1', max_send_rate=None,
+                 adaptive=False, max_concurrency=1, quota=None,
+                 *,
+                 max_pool_connections=None,
+                 connect_timeout=None,
+                 read_timeout=None,
+                 retry_mode=None,
+                 max_attempts=None,
+                 endpoint_url=None,
+                 metrics=None):
+        # pylint:disable=too-many-positional-arguments,too-many-arguments
+        self.region = region
+        self.max_send_rate = max_send_rate
+        self.adaptive = adaptive
+        self.max_concurrency = max_concurrency
+        self.quota = quota
+        self.max_pool_connections = (
+            max_pool_connections
+            or max(max_concurrency, self._DEFAULT_MAX_POOL_CONNECTIONS)
+        )
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retry_mode = retry_mode
+        self.max_attempts = max_attempts
+        self.endpoint_url = endpoint_url
+        self.metrics = metrics
+
+    @property
+    def _ses_config(self):
+        kwargs = {}
+        if self.connect_timeout is not None:
+            kwargs['connect_timeout'] = self.connect_timeout
+        if self.read_timeout is not None:
+            kwargs['read_timeout'] = self.read_timeout
+        retries = {}
+        if self.retry_mode is not None:
+            retries['mode'] = self.retry_mode
+        if self.max_attempts is not None:
+            retries['total_max_attempts'] = self.max_attempts
+        if retries:
+            kwargs['retries'] = retries
+        return Config(region_name=self.region,
+                      max_pool_connections=self.max_pool_connections,
+                      tcp_keepalive=True,
+                      **kwargs)
+
+    @Lazy
+    def client(self):
+        client = boto3.client('ses', config=self._ses_config,
+                              endpoint_url=self.endpoint_url)
+        assert client
+        return client
+
+    @Lazy
+    def rate_limiter(self):
+        """
+        The :class:`nti.mailer._throttle.TokenBucket` limiting our
+        sending, or None.
+        """
+        rate = self.max_send_rate
+        if rate is None:
+            return None
+        if rate == self.DISCOVER_SEND_RATE:
+            # pylint:disable=no-member
+            rate = self.client.get_send_quota()['MaxSendRate']
+            logger.info("Using SES maximum send rate of %s/s", rate)
+        rate = float(rate)
+        if rate <= 0:
+            # As SES uses -1 for an account without a limit.
+            logger.info("No positive maximum send rate (%s); not limiting", rate)
+            return None
+        return TokenBucket(rate)
+
+    @Lazy
+    def concurrency_limiter(self):
+        """
+        The :class:`nti.mailer._throttle.ConcurrencyLimiter` for
+        adaptive sending, or None.
+        """
+        if not self.adaptive:
+            return None
+        return ConcurrencyLimiter(self.max_concurrency)
+
+    @Lazy
+    def adaptive_controller(self):
+        """
+        The :class:`nti.mailer._throttle.AIMDController` for
+        adaptive sending, or None.
+        """
+        if not self.adaptive:
+            return None
+        return AIMDController(self.rate_limiter, self.concurrency_limiter)
+
+    def prepare(self):
+        """
+        Get ready to send, doing what could fail for reasons that
+        have nothing to do with the messages we are about to send:
+        asking SES for our maximum send rate, if we need to.
+
+        :raises botocore.exceptions.BotoCoreError: Or
+            :class:`~botocore.exceptions.ClientError`, if we can't
+            reach SES. Call this again later.
+        """
+        getattr(self, 'rate_limiter')
+
+    def quota_available(self):
+        """
+        Can we send more mail without exceeding the 24-hour quota?
+
+        If we're not tracking a quota, this is always true.
+        """
+        quota = self.quota
+        if quota is None:
+            return True
+        if quota.needs_refresh():
+            try:
+                quota.update(self.client.get_send_quota()) # pylint:disable=no-member
+            except (BotoCoreError, ClientError):
+                logger.exception("Failed to refresh the SES send quota")
+        return not quota.exhausted
+
+    def close(self):
+        """
+        Close the client and its connections, if we've created it.
+        """
+        client = self.__dict__.pop('client', None)
+        if client is not None:
+            client.close()
+
+    def send(self, fromaddr, toaddrs, message):
+        """
+        Send *message*, either a :class:`email.message.Message` or the
+        bytes of one that is ready to send (see
+        :class:`nti.mailer.interfaces.IRawMessageMailer`).
+        """
+        if isinstance(message, Message):
+            message = encode_message(message)
+        elif not isinstance(message, bytes):  # pragma: no cover
+            raise ValueError('Message must be instance of email.message.Message or bytes')
+
+        # Send the mail using SES, transforming SESError and known
+        # subclasses into something the SMTP-based queue processor
+        # knows how to deal with. NOTE: now that we're here, we have
+        # the opportunity to de-VERP the fromaddr found in the
+        # message, but still use the VERP form in the fromaddr we pass
+        # to SES. In this way we can handle bounces with the recipient
+        # none-the-wiser. See also :mod:`nti.app.bulkemail.process`
+        # NOTE: Each recipient (To, CC, BCC) counts as a distinct
+        # message for purposes of the quota limits. There are a
+        # maximum of 50 dests per address.
+        # (http://docs.aws.amazon.com/ses/latest/APIReference/API_SendRawEmail.html)
+        #
+        # NOTE: It is recommended to send an email to individuals:
+        # http://docs.aws.amazon.com/ses/latest/DeveloperGuide/sending-email.html
+        # "When you send an email to multiple recipients (recipients
+        # are "To", "CC", and "BCC" addresses) and the call to Amazon
+        # SES fails, the entire email is rejected and none of the
+        # recipients will receive the intended email. We therefore
+        # recommend that you send an email to one recipient at a time."
+
+        # QQQ: The docs for SendRawEmail say that destinations is not required,
+        # so how does that interact with what's in the message body?
+        # Boto will accept either a string, a list of strings, or None
+        with self.concurrency_limiter or contextlib.nullcontext():
+            limiter = self.rate_limiter
+            if limiter is not None:
+                limiter.acquire(_count_destinations(toaddrs))
+            try:
+                self._send_raw_email(fromaddr, toaddrs, message)
+            except ClientError as ex:
+                self._send_failed(ex)
+                raise
+            self._sent(toaddrs)
+
+    def _send_raw_email(self, fromaddr, toaddrs, message):
+        metrics = self.metrics
+        with (metrics.ses_request_duration.time() if metrics is not None
+              else contextlib.nullcontext()):
+            # pylint:disable=no-member
+            self.client.send_raw_email(RawMessage={'Data': message},
+                                       Source=fromaddr,
+                                       Destinations=toaddrs)
+
+    def _send_failed(self, ex):
+        """
+        Update the quota, metrics and adaptive controller for the
+        failed send that raised *ex*.
+        """
+        if _is_quota_exceeded_error(ex):
+            if self.quota is not None:
+                self.quota.mark_exhausted()
+            return
+        if not _is_throttling_error(ex):
+            return
+        if self.metrics is not None and not _is_server_error(ex):
+            self.metrics.throttled.inc()
+        if self.adaptive_controller is not None:
+            self.adaptive_controller.throttled()
+
+    def _sent(self, toaddrs):
+        """
+        Update the quota and adaptive controller for a successful send
+        to *toaddrs*.
+        """
+        if self.adaptive_controller is not None:
+            self.adaptive_controller.succeeded()
+        if self.quota is not None:
+            self.quota.record(_count_destinations(toaddrs))
+
+
+#: The error codes SES uses when we are sending too fast.
+_THROTTLING_ERROR_CODES = frozenset((
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+))
+
+def _is_throttling_error(ex):
+    """
+    Is the :class:`botocore.exceptions.ClientError` *ex* a sign that
+    we should slow down?
+    """
+    if not isinstance(ex, ClientError):
+        return False
+    response = ex.response
+    status = response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+    return (
+        response.get('Error', {}).get('Code') in _THROTTLING_ERROR_CODES
+        or status >= 500
+    )
+
+
+def _is_server_error(ex):
+    if not isinstance(ex, ClientError):
+        return False
+    return (ex.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0) >= 500
+
+
+def _is_quota_exceeded_error(ex):
+    """
+    Is the :class:`botocore.exceptions.ClientError` *ex* telling us
+    we've used up the 24-hour quota? SES reports this using the same
+    error code as going too fast, but no amount of slowing down will help.
+    """
+    error = ex.response.get('Error', {})
+    return (
+        error.get('Code') in _THROTTLING_ERROR_CODES
+        and 'quota exceeded' in error.get('Message', '').lower()
+    )
+
+
+def _count_destinations(toaddrs):
+    # SES charges each destination as one message against
+    # the send rate; boto will also accept a single string.
+    if isinstance(toaddrs, str):
+        return 1
+    return len(toaddrs) or 1
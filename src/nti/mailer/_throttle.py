@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Helpers for staying within the sending limits of Amazon SES.
+
+These are used by :class:`nti.mailer._ses.SESMailer`; they have no
+knowledge of SES themselves.
+
+"""
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+import time
+import threading
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket.
+
+    Tokens accumulate at *rate* per second, up to *capacity* (by
+    default, one second's worth). Callers :meth:`acquire` the number
+    of tokens they need, sleeping if there aren't enough.
+
+    A caller that finds the bucket empty doesn't wait for the tokens
+    to come back and then race other callers for them; instead, it
+    goes into debt and sleeps for exactly as long as it takes to pay
+    it off. Concurrent callers thus line up behind each other, and a
+    backlog drains at a steady *rate* instead of in bursts.
+    """
+
+    # Hooks for testing.
+    _clock = staticmethod(time.monotonic)
+    _sleep = staticmethod(time.sleep)
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError("Rate must be positive", rate)
+        self._rate = float(rate)
+        self.capacity = float(capacity) if capacity else max(self._rate, 1.0)
+        self._tokens = self.capacity
+        self._last = self._clock()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate):
+        with self._lock:
+            # Credit what accumulated at the old rate.
+            self._refill()
+            self._rate = float(rate)
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self._rate)
+        self._last = now
+
+    def reserve(self, tokens=1):
+        """
+        Take *tokens* from the bucket, returning the number of seconds
+        the caller must wait before it may use them.
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= tokens
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self._rate
+
+    def acquire(self, tokens=1):
+        """
+        Take *tokens* from the bucket, sleeping until they may be used.
+
+        :return: The number of seconds we slept.
+        """
+        delay = self.reserve(tokens)
+        if delay > 0:
+            logger.debug("Rate limited; waiting %.3fs for %s tokens", delay, tokens)
+            self._sleep(delay)
+        return delay
+
+    def __repr__(self):
+        return '<%s rate=%s capacity=%s>' % (type(self).__name__, self.rate, self.capacity)
+
+
+class ConcurrencyLimiter(object):
+    """
+    A semaphore whose *limit* can be changed while it is in use.
+
+    Lowering the limit doesn't interrupt anyone already holding
+    a slot; it just keeps new callers waiting until enough of them
+    have finished.
+    """
+
+    def __init__(self, limit):
+        self._limit = max(1, int(limit))
+        self.active = 0
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        return self._limit
+
+    @limit.setter
+    def limit(self, limit):
+        with self._cond:
+            self._limit = max(1, int(limit))
+            self._cond.notify_all()
+
+    def acquire(self):
+        with self._cond:
+            while self.active >= self._limit:
+                self._cond.wait()
+            self.active += 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, t, v, tb):
+        self.release()
+
+
+class AIMDController(object):
+    """
+    Adjusts the rate of a :class:`TokenBucket` and the limit of a
+    :class:`ConcurrencyLimiter` using additive-increase,
+    multiplicative-decrease, the way TCP finds the capacity of
+    a link.
+
+    Each :meth:`throttled` call multiplies both by *decrease_factor*
+    (never going below *min_rate* or a single sender). Each
+    :meth:`succeeded` call adds a fraction of *rate_step* and of one
+    sender, such that a full second's worth of successes at the
+    current rate raises the rate by *rate_step*, and one success per
+    sender raises the concurrency by one. Neither goes above the
+    values they had when we were created.
+
+    When we are throttled, the requests already in flight are likely
+    to be throttled too; we ignore further throttling for *cooldown*
+    seconds after a decrease so that one overload doesn't collapse
+    us to the minimum.
+
+    Either *bucket* or *limiter* may be None.
+    """
+
+    _clock = staticmethod(time.monotonic)
+
+    def __init__(self, bucket=None, limiter=None,
+                 decrease_factor=0.5,
+                 rate_step=1.0,
+                 min_rate=1.0,
+                 cooldown=1.0):
+        # pylint:disable=too-many-positional-arguments
+        self.bucket = bucket
+        self.limiter = limiter
+        self.max_rate = bucket.rate if bucket is not None else None
+        self.max_concurrency = limiter.limit if limiter is not None else None
+        self.decrease_factor = decrease_factor
+        self.rate_step = rate_step
+        self.min_rate = min(min_rate, self.max_rate) if bucket is not None else min_rate
+        self.cooldown = cooldown
+        # The limiter's limit is integral; we accumulate fractional
+        # increases here.
+        self._concurrency = self.max_concurrency
+        self._last_decrease = None
+        self._lock = threading.Lock()
+        self.throttle_count = 0
+
+    @property
+    def rate(self):
+        return self.bucket.rate if self.bucket is not None else None
+
+    @property
+    def concurrency(self):
+        return self.limiter.limit if self.limiter is not None else None
+
+    def succeeded(self):
+        with self._lock:
+            if self.bucket is not None and self.bucket.rate < self.max_rate:
+                self.bucket.rate = min(self.max_rate,
+                                       self.bucket.rate + self.rate_step / self.bucket.rate)
+                if self.bucket.rate == self.max_rate:
+                    logger.info("Send rate recovered to %.2f/s", self.bucket.rate)
+            if self.limiter is not None and self._concurrency < self.max_concurrency:
+                self._concurrency = min(self.max_concurrency,
+                                        self._concurrency + 1.0 / self.limiter.limit)
+                if int(self._concurrency) != self.limiter.limit:
+                    self.limiter.limit = int(self._concurrency)
+                    logger.info("Send concurrency increased to %d", self.limiter.limit)
+
+    def throttled(self):
+        with self._lock:
+            self.throttle_count += 1
+            now = self._clock()
+            if self._last_decrease is not None and now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            if self.bucket is not None:
+                self.bucket.rate = max(self.min_rate, self.bucket.rate * self.decrease_factor)
+            if self.limiter is not None:
+                self._concurrency = max(1.0, self._concurrency * self.decrease_factor)
+                self.limiter.limit = int(self._concurrency)
+            logger.warning("Throttled by SES; send rate now %s/s, concurrency now %s",
+                           self.rate, self.concurrency)
+
+
+class SendQuota(object):
+    """
+    Tracks our use of the SES 24-hour sending quota.
+
+    Our knowledge comes from the ``GetSendQuota`` responses given to
+    :meth:`update`, plus the destinations we :meth:`record` sending
+    ourselves in between. SES measures a rolling window, so sending
+    capacity comes back gradually; once we think the quota is used up,
+    only a fresh response can tell us otherwise. Callers should
+    :meth:`update` whenever :meth:`needs_refresh` says to.
+
+    We consider the quota :attr:`exhausted` when no more than
+    *reserve* destinations remain.
+    """
+
+    _clock = staticmethod(time.monotonic)
+
+    def __init__(self, refresh_interval=300, reserve=0):
+        self.refresh_interval = refresh_interval
+        self.reserve = reserve
+        self.max_24_hour_send = None
+        self.sent_last_24_hours = 0
+        self._updated_at = None
+        self._lock = threading.Lock()
+
+    def needs_refresh(self):
+        return (
+            self._updated_at is None
+            or self._clock() - self._updated_at >= self.refresh_interval
+        )
+
+    def update(self, response):
+        """
+        Update from a ``GetSendQuota`` *response*.
+        """
+        with self._lock:
+            self.max_24_hour_send = response['Max24HourSend']
+            self.sent_last_24_hours = response['SentLast24Hours']
+            self._updated_at = self._clock()
+        logger.info("SES quota: sent %d of %d in the last 24 hours",
+                    self.sent_last_24_hours, self.max_24_hour_send)
+
+    def record(self, count):
+        """
+        Note that we have sent to *count* destinations.
+        """
+        with self._lock:
+            self.sent_last_24_hours += count
+
+    def mark_exhausted(self):
+        """
+        Note that SES told us we are out of quota.
+        """
+        with self._lock:
+            if self.max_24_hour_send is not None and self.max_24_hour_send >= 0:
+                self.sent_last_24_hours = max(self.sent_last_24_hours,
+                                              self.max_24_hour_send)
+            else:
+                # We didn't know the quota, or thought it unlimited.
+                # Either way, SES knows better; make sure we ask again.
+                self.max_24_hour_send = self.sent_last_24_hours
+            self._updated_at = self._clock()
+
+    def expire(self):
+        """
+        Make :meth:`needs_refresh` true, whatever the *refresh_interval*.
+        """
+        with self._lock:
+            self._updated_at = None
+
+    @property
+    def remaining(self):
+        """
+        The number of destinations we may still send to, or None
+        if the quota is unknown or unlimited.
+        """
+        if self.max_24_hour_send is None or self.max_24_hour_send < 0:
+            return None
+        return max(0, self.max_24_hour_send - self.sent_last_24_hours)
+
+    @property
+    def exhausted(self):
+        remaining = self.remaining
+        return remaining is not None and remaining <= self.reserve
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Rendering mail in the background, after the transaction that queued
+it commits.
+
+Rendering templates and inlining their CSS takes long enough that
+web workers shouldn't wait for it. Register a
+:class:`BackgroundRenderPool` as the
+:class:`~nti.mailer.interfaces.IBackgroundRenderPool` utility and pass
+``background=True`` to ``queue_simple_html_text_email``, and the
+message is rendered and queued by one of the pool's workers once the
+request's transaction commits (and not at all if it aborts).
+
+The workers are threads, which are greenlets if gevent has
+monkey-patched the process.
+
+Because the work happens after the transaction is over, the template
+arguments and recipients must still be usable then: pass plain data,
+or objects like
+:class:`~nti.mailer.interfaces.EmailAddressablePrincipal`, not
+persistent objects whose connection will have been closed.
+"""
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from zope import interface
+
+import transaction
+
+from nti.mailer.interfaces import IBackgroundRenderPool
+
+logger = __import__('logging').getLogger(__name__)
+
+__all__ = (
+    'BackgroundRenderPool',
+)
+
+
+@interface.implementer(IBackgroundRenderPool)
+class BackgroundRenderPool(object):
+    """
+    A pool of *workers* threads doing work submitted with
+    :meth:`submit_after_commit`.
+
+    To keep memory (and the delay before mail is queued) bounded,
+    at most *max_pending* pieces of work can be outstanding, counting
+    those waiting for their transaction to commit. When that many
+    are, :meth:`submit_after_commit` waits up to *wait* seconds for
+    one to finish (so that busy callers slow down), and then gives up,
+    leaving the caller to do the work itself.
+
+    Errors doing the work are logged, and counted in :attr:`errors`.
+
+    Each piece of work is done in its own transaction of
+    *transaction_manager* (by default, the thread-local one), which is
+    committed if it succeeds.
+    """
+
+    #: The number of pieces of work that failed.
+    errors = 0
+
+    def __init__(self, workers=2, max_pending=100, wait=1.0, transaction_manager=None):
+        # pylint:disable=too-many-positional-arguments
+        self.workers = workers
+        self.max_pending = max_pending
+        self.wait = wait
+        self.transaction_manager = transaction_manager or transaction.manager
+        self._executor = ThreadPoolExecutor(workers,
+                                            thread_name_prefix='nti.mailer.background')
+        self._cond = threading.Condition()
+        self._pending = 0
+        self._closed = False
+
+    @property
+    def pending(self):
+        """
+        The number of pieces of work submitted and not yet done or
+        abandoned.
+        """
+        return self._pending
+
+    def _reserve(self):
+        with self._cond:
+            if not self._cond.wait_for(
+                    lambda: self._closed or self._pending < self.max_pending,
+                    self.wait):
+                return False
+            if self._closed:
+                return False
+            self._pending += 1
+            return True
+
+    def _release(self, failed=False):
+        with self._cond:
+            self._pending -= 1
+            if failed:
+                self.errors += 1
+            self._cond.notify_all()
+
+    def submit_after_commit(self, function):
+        if not self._reserve():
+            logger.debug("Background render pool full or closed; not submitting %r", function)
+            return False
+
+        released = []
+
+        def release():
+            # A commit that fails calls both hooks.
+            if not released:
+                released.append(True)
+                self._release()
+
+        def after_commit(committed):
+            if not committed:
+                release()
+                return
+            try:
+                self._executor.submit(self._run, function)
+            except RuntimeError: # Shut down while we were waiting for the commit
+                logger.error("Background render pool closed; dropping %r", function)
+                release()
+
+        def after_abort():
+            release()
+
+        txn = self.transaction_manager.get()
+        txn.addAfterCommitHook(after_commit)
+        txn.addAfterAbortHook(after_abort)
+        return True
+
+    def _run(self, function):
+        failed = False
+        try:
+            with self.transaction_manager:
+                function()
+        except Exception: # pylint:disable=broad-except
+            failed = True
+            logger.exception("Failed to do %r in the background", function)
+        finally:
+            self._release(failed)
+
+    def flush(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending, timeout)
+
+    def close(self, timeout=None):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        result = self.flush(timeout)
+        # If we ran out of time, don't wait for the stragglers.
+        self._executor.shutdown(wait=result, cancel_futures=not result)
+        return result
@@ -0,0 +1,5 @@
+"""
+Benchmarks for :mod:`nti.mailer`.
+
+These use :mod:`pyperf`; install the ``benchmarks`` extra to run them.
+"""
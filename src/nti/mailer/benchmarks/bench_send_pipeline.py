@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for each stage of creating, queuing and sending a
+templated email, from rendering the templates to draining the queue
+through :class:`nti.mailer._ses.SESMailer`.
+
+Run with::
+
+    python -m nti.mailer.benchmarks.bench_send_pipeline -o before.json
+
+and compare two runs (for example, before and after a change) with::
+
+    python -m pyperf compare_to before.json after.json
+
+Use ``-b NAME`` (repeatable) to run only some of the benchmarks; the
+usual :mod:`pyperf` options (``--fast``, ``--rigorous``, ...) apply.
+
+Sending to SES is replaced by a client that answers immediately
+(or, for the ``latency`` variants, after a fixed delay), so the queue
+benchmarks measure our overhead, not the network's. The ``http``
+variant instead talks to a :class:`nti.mailer.testing.FakeSESServer`,
+and so includes botocore and HTTP.
+"""
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+import os
+import time
+import shutil
+import tempfile
+import itertools
+import multiprocessing
+from email.message import Message as _EmailMessage
+
+import pyperf
+
+from premailer import transform
+
+from pyramid.interfaces import IRendererFactory
+from pyramid.testing import setUp as psetUp
+
+from pyramid_mailer.message import Message
+
+from repoze.sendmail.encoding import encode_message
+from repoze.sendmail.maildir import Maildir
+
+from zope import component
+from zope import interface
+from zope.publisher.interfaces.browser import IBrowserRequest
+
+from nti.app.pyramid_zope import z3c_zpt
+
+from nti.mailer._default_template_mailer import _make_template_args
+from nti.mailer._default_template_mailer import _pyramid_message_to_message
+from nti.mailer._default_template_mailer import _render
+from nti.mailer._default_template_mailer import create_html_text_emails
+from nti.mailer._default_template_mailer import css_inline_cache
+from nti.mailer._default_template_mailer import create_simple_html_text_email
+from nti.mailer._verp import principal_ids_from_verp
+from nti.mailer._verp import verp_from_recipients
+from nti.mailer.interfaces import EmailAddressablePrincipal
+from nti.mailer.interfaces import IMailerPolicy
+from nti.mailer.interfaces import IMailerTemplateArgsUtility
+from nti.mailer.parallel import ProcessPoolRenderer
+from nti.mailer.queue import MailQueueProcessor
+from nti.mailer.queue import SESMailer
+from nti.mailer.testing import FakeSESServer
+
+logger = __import__('logging').getLogger(__name__)
+
+TEMPLATE = 'tests/templates/test_new_user_created'
+PACKAGE = 'nti.mailer'
+SENDER = 'NextThought <no-reply@nextthought.com>'
+
+#: How many messages each queue benchmark sends.
+QUEUE_SIZE = 100
+#: How many recipients each batch creation benchmark creates messages for.
+BATCH_SIZE = 100
+#: How long the fake SES takes to answer in the ``latency`` variants.
+SES_LATENCY = 0.005
+
+
+@interface.implementer(IMailerPolicy)
+class _MailerPolicy(object):
+
+    def get_default_sender(self):
+        return SENDER
+
+    def get_signer_secret(self):
+        return 'benchmark secret'
+
+
+@interface.implementer(IMailerTemplateArgsUtility)
+class _TemplateArgs(object):
+
+    def __init__(self, **args):
+        self.args = args
+
+    def get_template_args(self, _request):
+        return self.args
+
+
+@interface.implementer(IBrowserRequest)
+class _Request(object):
+    response = None
+    application_url = 'https://example.com'
+    context = None
+
+    def __init__(self):
+        self.annotations = {}
+
+
+class _User(object):
+    username = 'benchmark.user'
+
+
+class _Profile(object):
+    realname = 'Benchmark User'
+
+
+class _FakeSESClient(object):
+    """
+    Just enough of a boto3 SES client for :class:`SESMailer`.
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+
+    def send_raw_email(self, **_kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        return {'MessageId': 'benchmark'}
+
+    def close(self):
+        pass
+
+
+def _principal(principal_id, email):
+    prin = EmailAddressablePrincipal.__new__(EmailAddressablePrincipal)
+    prin.id = principal_id
+    prin.email = email
+    return prin
+
+
+def _set_up_components():
+    config = psetUp(registry=component.getGlobalSiteManager(), hook_zca=True)
+    config.setup_registry()
+    config.include('pyramid_chameleon')
+    config.include('pyramid_mako')
+    # Our .pt templates are z3c.pt templates, as in nti.app.pyramid_zope.
+    component.provideUtility(z3c_zpt.renderer_factory, IRendererFactory, name='.pt')
+    component.provideUtility(_MailerPolicy())
+    # Sites typically have a few of these.
+    for i in range(3):
+        component.provideUtility(_TemplateArgs(**{'arg%d' % i: i}),
+                                 IMailerTemplateArgsUtility,
+                                 name=str(i))
+
+
+def _template_args():
+    user = _User()
+    return {
+        'user': user,
+        'profile': _Profile(),
+        'context': user,
+        'href': 'https://example.com/verify',
+        'support_email': 'support@example.com',
+    }
+
+
+def _recipients():
+    return [_principal('benchmark.user', 'benchmark.user@example.com')]
+
+
+def _create_email(request):
+    return create_simple_html_text_email(TEMPLATE,
+                                         subject='Welcome',
+                                         recipients=_recipients(),
+                                         template_args=_template_args(),
+                                         package=PACKAGE,
+                                         request=request)
+
+
+def _batch_recipients():
+    # Each recipient gets a different link, so each message is
+    # rendered (and inlined) separately.
+    return [(_principal('user%d' % i, 'user%d@example.com' % i),
+             {'href': 'https://example.com/verify/%d' % i})
+            for i in range(BATCH_SIZE)]
+
+
+def _create_emails_one_by_one(request, recipients_and_args):
+    for recipient, args in recipients_and_args:
+        template_args = _template_args()
+        template_args.update(args)
+        create_simple_html_text_email(TEMPLATE,
+                                      subject='Welcome',
+                                      recipients=[recipient],
+                                      template_args=template_args,
+                                      package=PACKAGE,
+                                      request=request)
+
+
+def _create_emails_batch(request, recipients_and_args):
+    for _ in create_html_text_emails(TEMPLATE,
+                                     recipients_and_args,
+                                     subject='Welcome',
+                                     template_args=_template_args(),
+                                     package=PACKAGE,
+                                     request=request):
+        pass
+
+
+def _create_emails_merge(request, recipients_and_args):
+    for _ in create_html_text_emails(TEMPLATE,
+                                     recipients_and_args,
+                                     subject='Welcome',
+                                     template_args=_template_args(),
+                                     package=PACKAGE,
+                                     request=request,
+                                     merge_fields={'href': 'url'}):
+        pass
+
+
+def _render_templates(request):
+    # What create_simple_html_text_email does, minus the CSS inlining.
+    return [_render('nti.mailer:' + TEMPLATE + extension,
+                    _make_template_args(request, None, extension, '.txt', _template_args()),
+                    request,
+                    None)
+            for extension in ('.pt', '.txt')]
+
+
+def _timed(func, *args):
+    # Make a pyperf time function out of one that does one thing.
+    def bench(loops):
+        t0 = pyperf.perf_counter()
+        for _ in range(loops):
+            func(*args)
+        return pyperf.perf_counter() - t0
+    return bench
+
+
+def bench_create_email(loops, request):
+    return _timed(_create_email, request)(loops)
+
+
+def bench_create_emails(loops, request, create):
+    def run(recipients_and_args):
+        # Earlier loops would otherwise have inlined all the messages.
+        css_inline_cache.clear()
+        create(request, recipients_and_args)
+    return _timed(run, _batch_recipients())(loops)
+
+
+def bench_create_emails_process_pool(loops, request):
+    # Forked workers have our components.
+    with ProcessPoolRenderer(chunksize=10,
+                             mp_context=multiprocessing.get_context('fork'),
+                             templates=[PACKAGE + ':' + TEMPLATE]) as renderer:
+        runs = itertools.count()
+
+        def run():
+            # The workers' inlining caches outlive each run, so each
+            # run's links differ.
+            run_number = next(runs)
+            recipients_and_args = [(recipient, {'href': '%s/%d' % (args['href'], run_number)})
+                                   for recipient, args in _batch_recipients()]
+            for _ in renderer.create_html_text_emails(TEMPLATE,
+                                                      recipients_and_args,
+                                                      subject='Welcome',
+                                                      template_args=_template_args(),
+                                                      package=PACKAGE,
+                                                      request=request,
+                                                      ordered=False):
+                pass
+        # Start the workers before timing.
+        run()
+        return _timed(run)(loops)
+
+
+def bench_render_templates(loops, request):
+    return _timed(_render_templates, request)(loops)
+
+
+def bench_premailer_transform(loops, html):
+    return _timed(transform, html)(loops)
+
+
+def bench_make_template_args(loops, request):
+    args = _template_args()
+    return _timed(_make_template_args, request, None, '.pt', '.txt', args)(loops)
+
+
+def bench_verp_from_recipients(loops, request):
+    return _timed(verp_from_recipients, SENDER, _recipients(), request)(loops)
+
+
+def bench_principal_ids_from_verp(loops, request):
+    verp = verp_from_recipients(SENDER, _recipients(), request)
+    return _timed(principal_ids_from_verp, verp, request)(loops)
+
+
+def bench_pyramid_message_to_message(loops, request, pyramid_message):
+    recipients = _recipients()
+    return _timed(_pyramid_message_to_message, pyramid_message, recipients, request)(loops)
+
+
+def bench_encode_message(loops, request, pyramid_message):
+    message = _pyramid_message_to_message(pyramid_message, _recipients(), request)
+    return _timed(encode_message, message)(loops)
+
+
+def bench_queue_drain(loops, message, latency=0, concurrency=1, endpoint_url=None):
+    """
+    Time sending :data:`QUEUE_SIZE` queued copies of *message*.
+    """
+    # pylint:disable=too-many-positional-arguments
+    tmp = tempfile.mkdtemp()
+    try:
+        queue_path = os.path.join(tmp, 'queue')
+        maildir = Maildir(queue_path, create=True)
+        mailer = SESMailer(max_concurrency=concurrency, endpoint_url=endpoint_url)
+        if endpoint_url is None:
+            mailer.client = _FakeSESClient(latency)
+        elapsed = 0
+        for _ in range(loops):
+            for _ in range(QUEUE_SIZE):
+                message.replace_header('To', 'benchmark.user@example.com')
+                maildir.add(message).commit()
+            processor = MailQueueProcessor(mailer, queue_path,
+                                           Maildir=lambda *_args, **_kw: maildir,
+                                           concurrency=concurrency)
+            t0 = pyperf.perf_counter()
+            processor.send_messages()
+            elapsed += pyperf.perf_counter() - t0
+            assert not list(maildir), "Messages left in queue"
+        mailer.close()
+        return elapsed
+    finally:
+        shutil.rmtree(tmp)
+
+
+def _queued_message(request, pyramid_message):
+    message = _pyramid_message_to_message(pyramid_message, _recipients(), request)
+    # As repoze.sendmail's QueuedMailDelivery would leave it.
+    queued = _EmailMessage()
+    for name, value in message.items():
+        queued[name] = value
+    queued['X-Actually-From'] = SENDER
+    queued['X-Actually-To'] = 'benchmark.user@example.com'
+    queued.set_payload(message.get_payload())
+    return queued
+
+
+def _add_cmdline_args(cmd, args):
+    # Pass our options on to the worker processes.
+    for name in args.benchmark:
+        cmd.extend(('--benchmark', name))
+
+
+def main():
+    runner = pyperf.Runner(add_cmdline_args=_add_cmdline_args)
+    runner.metadata['description'] = "nti.mailer send pipeline"
+    runner.argparser.add_argument('-b', '--benchmark', action='append', default=[],
+                                  help='Run only the named benchmark (may be repeated).')
+    options = runner.parse_args()
+
+    def bench(name, func, *args):
+        if not options.benchmark or name in options.benchmark:
+            runner.bench_time_func(name, func, *args)
+
+    _set_up_components()
+    request = _Request()
+    pyramid_message = _create_email(request)
+    assert isinstance(pyramid_message, Message)
+    html, _ = _render_templates(request)
+
+    bench('create_simple_html_text_email', bench_create_email, request)
+    bench('create_emails_%d_one_by_one' % BATCH_SIZE, bench_create_emails,
+          request, _create_emails_one_by_one)
+    bench('create_emails_%d_batch' % BATCH_SIZE, bench_create_emails,
+          request, _create_emails_batch)
+    bench('create_emails_%d_merge' % BATCH_SIZE, bench_create_emails,
+          request, _create_emails_merge)
+    bench('create_emails_%d_process_pool' % BATCH_SIZE, bench_create_emails_process_pool,
+          request)
+    bench('render_templates', bench_render_templates, request)
+    bench('premailer_transform', bench_premailer_transform, html)
+    bench('make_template_args', bench_make_template_args, request)
+    bench('verp_from_recipients', bench_verp_from_recipients, request)
+    bench('principal_ids_from_verp', bench_principal_ids_from_verp, request)
+    bench('pyramid_message_to_message', bench_pyramid_message_to_message,
+          request, pyramid_message)
+    bench('encode_message', bench_encode_message, request, pyramid_message)
+
+    queued = _queued_message(request, pyramid_message)
+    bench('queue_drain_%d' % QUEUE_SIZE, bench_queue_drain, queued)
+    bench('queue_drain_%d_latency' % QUEUE_SIZE, bench_queue_drain, queued, SES_LATENCY)
+    bench('queue_drain_%d_latency_c8' % QUEUE_SIZE, bench_queue_drain,
+          queued, SES_LATENCY, 8)
+
+    os.environ.update(FakeSESServer.environ)
+    with FakeSESServer(sink=lambda _message: None) as server:
+        bench('queue_drain_%d_http_c8' % QUEUE_SIZE, bench_queue_drain,
+              queued, 0, 8, server.endpoint_url)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Mail delivery (:class:`repoze.sendmail.interfaces.IMailDelivery`)
+for the processes that queue mail, as opposed to those
+in :mod:`nti.mailer.queue` that send it.
+
+"""
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+import os
+import socket
+
+from zope import interface
+
+from repoze.sendmail.delivery import QueuedMailDelivery
+
+from repoze.sendmail.interfaces import IMailDelivery
+
+logger = __import__('logging').getLogger(__name__)
+
+__all__ = (
+    'DEFAULT_PRIORITY',
+    'lane_path',
+    'QUEUED_AT_HEADER',
+    'TEMPLATE_HEADER',
+    'PRIORITY_HEADER',
+    'TRACKING_HEADERS',
+    'RENDER_JOB_HEADER',
+    'WAKEUP_SOCKET_NAME',
+    'wakeup_socket_path',
+    'wake_queue_processor',
+    'NotifyingQueuedMailDelivery',
+)
+
+#: The priority of mail queued without one. Its lane is the
+#: queue directory itself.
+DEFAULT_PRIORITY = 'default'
+
+
+def lane_path(queue_path, priority=None):
+    """
+    The maildir in which mail of *priority* is queued for the queue
+    at *queue_path*.
+
+    Each priority but :data:`DEFAULT_PRIORITY` has its own maildir,
+    a Maildir++ style folder (``.<priority>``) inside the queue, so
+    that the queue processor can send the mail in each separately,
+    in order of priority.
+    """
+    if not priority or priority == DEFAULT_PRIORITY:
+        return queue_path
+    return os.path.join(queue_path, '.' + priority)
+
+
+#: The header recording when (as from :func:`time.time`) a message
+#: was queued. Like the others in :data:`TRACKING_HEADERS`, the queue
+#: processor removes it before sending, using it to measure how long
+#: messages take to be sent.
+QUEUED_AT_HEADER = 'X-NTI-Mailer-Queued-At'
+#: The header recording the template a message was created from.
+TEMPLATE_HEADER = 'X-NTI-Mailer-Template'
+#: The header recording the priority a message was queued with.
+PRIORITY_HEADER = 'X-NTI-Mailer-Priority'
+
+#: The headers we add to messages queued with a
+#: :class:`NotifyingQueuedMailDelivery` for our own use, which are
+#: never sent.
+TRACKING_HEADERS = (QUEUED_AT_HEADER, TEMPLATE_HEADER, PRIORITY_HEADER)
+
+#: The header marking a queued message as a job for the queue
+#: processor to render, rather than a message to send; its value is
+#: the version of the job format. See
+#: :func:`nti.mailer._batch.render_job`.
+RENDER_JOB_HEADER = 'X-NTI-Mailer-Render-Job'
+
+
+#: The name of the Unix datagram socket, in the top level of a maildir,
+#: on which a :class:`nti.mailer.queue.MailerWatcher` listens for
+#: notifications that mail has been queued.
+WAKEUP_SOCKET_NAME = 'wakeup.sock'
+
+#: The datagram sent to ask for mail to be sent right away.
+WAKEUP_URGENT = b'urgent'
+#: The datagram sent to say that mail can be sent when convenient.
+WAKEUP_NORMAL = b'normal'
+
+
+def wakeup_socket_path(queue_path):
+    return os.path.join(queue_path, WAKEUP_SOCKET_NAME)
+
+
+def wake_queue_processor(queue_path, urgent=False):
+    """
+    Tell the queue processor watching *queue_path*, if any, that
+    mail has been added to the queue.
+
+    If *urgent* is true, it will send the mail right away; otherwise,
+    it may wait to send it along with other mail.
+
+    This never raises an exception: if no one is listening, or the
+    message cannot be sent, the queue processor will still find the mail
+    the next time it looks.
+
+    :return: Whether the notification was sent.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.setblocking(False)
+        sock.sendto(WAKEUP_URGENT if urgent else WAKEUP_NORMAL,
+                    wakeup_socket_path(queue_path))
+    except OSError as ex:
+        logger.debug("Failed to notify queue processor for %s: %s", queue_path, ex)
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+@interface.implementer(IMailDelivery)
+class NotifyingQueuedMailDelivery(QueuedMailDelivery):
+    """
+    A :class:`repoze.sendmail.delivery.QueuedMailDelivery` that, each
+    time a transaction that queued a message commits, tells the queue
+    processor (using :func:`wake_queue_processor`) that there is
+    new mail.
+
+    Register this as the :class:`~.IMailDelivery` utility, using
+    *urgent* for mail (such as password resets) that people are
+    waiting for.
+
+    If *priority* is given, mail is queued in that priority's lane
+    (see :func:`lane_path`) of the queue at *queuePath*. Register
+    such deliveries as named utilities, with the priority as the
+    name, to have them used by
+    :func:`~nti.mailer.interfaces.ITemplatedMailer.queue_simple_html_text_email`
+    when it is given that *priority*.
+
+    .. versionadded:: 1.0.1
+    """
+
+    def __init__(self, queuePath, transaction_manager=None, urgent=False, priority=None):
+        # pylint:disable=too-many-positional-arguments
+        super().__init__(lane_path(queuePath, priority), transaction_manager)
+        #: The queue whose processor we notify.
+        self.wakeupPath = queuePath
+        self.urgent = urgent
+        self.priority = priority
+
+    def createDataManager(self, fromaddr, toaddrs, message):
+        data_manager = super().createDataManager(fromaddr, toaddrs, message)
+        commit = data_manager.callable
+
+        def commit_and_notify(*args):
+            commit(*args)
+            wake_queue_processor(self.wakeupPath, self.urgent)
+        data_manager.callable = commit_and_notify
+        return data_manager
@@ -27,6 +27,9 @@ __all__ = (
     'IVERP',
     'IMailerPolicy',
     'IMailerTemplateArgsUtility',
+    'IVolatileMailerTemplateArgsUtility',
+    'IRawMessageMailer',
+    'IBackgroundRenderPool',
 )
 
 # pylint:disable=inherit-non-class,no-self-argument,no-method-argument
@@ -34,6 +37,7 @@ __all__ = (
 
 from pyramid_mailer.interfaces import IMailer
 from repoze.sendmail.interfaces import IMailDelivery
+from repoze.sendmail.interfaces import IMailer as _ISendmailMailer
 from nti.schema.field import TextLine
 
 
@@ -122,7 +126,10 @@ class ITemplatedMailer(interface.Interface):
                                      package=None,
                                      text_template_extension='.txt',
                                      message_factory=None,
-                                     context=None):
+                                     context=None,
+                                     priority=None,
+                                     deferred=False,
+                                     background=False):
         """
         Transactionally queues an email for sending. The email has both a
         plain text and an HTML version.
@@ -154,10 +161,20 @@ class ITemplatedMailer(interface.Interface):
                 of templates to create a text and html part. Defaults to
                 :meth:`create_simple_html_text_email`. This argument is deprecated;
                 if you need it, please file an issue explaining your use-case.
-
+        :keyword priority: The name of the :class:`.IMailDelivery` utility that
+                should queue the message, such as ``'transactional'`` or ``'bulk'``.
+                If there is no such utility, the default (unnamed) utility is used.
+                See :func:`nti.mailer.delivery.lane_path`.
+        :keyword deferred: If true, queue a job to render the message instead of
+                rendering it now; the queue processor renders it just before sending
+                it. The template arguments must be JSON serializable, and there can
+                be no attachments. The subject is still translated now.
+        :keyword background: If true, and an :class:`IBackgroundRenderPool` is
+                registered, render and queue the message in the pool once the
+                current transaction commits, instead of now.
 
         :return: The :class:`pyramid_mailer.message.Message` we sent, if we sent one,
-                otherwise None.
+                otherwise None (including when it will be sent in the background).
 
         .. versionchanged:: 0.0.1
            Now, if the *subject* is a :class:`zope.i18nmessageid.Message`, it will
@@ -168,6 +185,8 @@ class ITemplatedMailer(interface.Interface):
            value of ``request.context`` will be used. As a last resort, ``template_args['context']
            will be used. (If both *context* or ``request.context`` and a template argument value
            are given, they should all be the same object.)
+        .. versionchanged:: 1.0.1
+           Added the *priority*, *deferred* and *background* arguments.
         """
 
     def create_simple_html_text_email(base_template,
@@ -185,6 +204,72 @@ class ITemplatedMailer(interface.Interface):
         but without the actual transactional delivery.
         """
 
+    def create_html_text_emails(base_template,
+                                recipients_and_args,
+                                subject='',
+                                request=None,
+                                template_args=None,
+                                reply_to=None,
+                                attachments=(),
+                                package=None,
+                                text_template_extension='.txt',
+                                context=None,
+                                merge_fields=None):
+        """
+        Create one message for each recipient from the same templates.
+
+        :param recipients_and_args: An iterable of ``(recipient, template_args)``
+                pairs. Each *recipient* is as for the *recipients* of
+                :meth:`queue_simple_html_text_email`, and its *template_args*
+                (which may be None) are combined with the shared
+                *template_args* to render its message.
+        :keyword merge_fields: If given, a dictionary naming the only template
+                arguments that may differ between recipients, each mapped to
+                its type, ``'text'`` or ``'url'`` (the name may also be a dotted
+                path into an argument, such as ``'profile.realname'``). The
+                templates are then rendered just once, and each recipient's
+                message is made by substituting (and escaping) its values for
+                these arguments; values not in a recipient's *template_args*
+                come from the shared *template_args*. Templates can only
+                interpolate merge fields, not test or transform them.
+                See :mod:`nti.mailer._merge`.
+
+        The work that doesn't depend on the recipient, such as finding
+        the templates and translating the subject, is done once. The
+        recipients are consumed lazily, so any number of them can be
+        handled in constant memory.
+
+        :return: An iterator of :class:`pyramid_mailer.message.Message`,
+                skipping recipients without a valid address.
+
+        .. versionadded:: 1.0.1
+        """
+
+    def queue_html_text_emails(base_template,
+                               recipients_and_args,
+                               subject='',
+                               request=None,
+                               template_args=None,
+                               reply_to=None,
+                               attachments=(),
+                               package=None,
+                               text_template_extension='.txt',
+                               context=None,
+                               priority=None,
+                               merge_fields=None):
+        """
+        Like :meth:`create_html_text_emails`, but transactionally queue each
+        message as it is created, as :meth:`queue_simple_html_text_email` does.
+
+        :keyword priority: As for :meth:`queue_simple_html_text_email`.
+        :keyword merge_fields: As for :meth:`create_html_text_emails`; only
+                the template arguments it names may differ between recipients.
+
+        :return: The number of messages queued.
+
+        .. versionadded:: 1.0.1
+        """
+
     def do_html_text_templates_exist(base_template,
                                      text_template_extension='.txt',
                                      package=None):
@@ -285,9 +370,83 @@ class IMailerPolicy(interface.Interface):
 class IMailerTemplateArgsUtility(interface.Interface):
     """
     A utility that can supplement mail template args.
+
+    The args are assumed to depend only on the request, so each
+    utility is asked for them at most once per request (and site
+    manager); the same args are used for every message created during
+    that request. Utilities for which that isn't true should provide
+    :class:`IVolatileMailerTemplateArgsUtility`.
     """
 
-    def get_template_args():
+    def get_template_args(request):
         """
         Returns a (possibly empty) dict of supplemental template args.
         """
+
+
+class IVolatileMailerTemplateArgsUtility(IMailerTemplateArgsUtility):
+    """
+    An :class:`IMailerTemplateArgsUtility` whose args can differ each
+    time it is asked, even during the same request, so that they must
+    not be cached.
+
+    Utilities are still registered as providing
+    :class:`IMailerTemplateArgsUtility`; they only need to provide
+    this too.
+
+    .. versionadded:: 1.0.1
+    """
+
+
+class IRawMessageMailer(_ISendmailMailer):
+    """
+    A :mod:`repoze.sendmail` mailer whose ``send`` method also
+    accepts the message as :class:`bytes`, already encoded for
+    sending (as :func:`repoze.sendmail.encoding.encode_message`
+    would), and sends it unchanged.
+
+    Queue processors give such mailers the bytes of queued messages
+    without parsing them.
+
+    .. versionadded:: 1.0.1
+    """
+
+
+class IBackgroundRenderPool(interface.Interface):
+    """
+    A bounded pool of workers that does work, such as rendering and
+    queuing a message, once the transaction that asked for it has
+    committed, so that the request asking doesn't wait for it.
+
+    Register one as a utility to let
+    :meth:`ITemplatedMailer.queue_simple_html_text_email` render in
+    the background.
+
+    .. versionadded:: 1.0.1
+    """
+
+    def submit_after_commit(function):
+        """
+        Arrange for *function* to be called (with no arguments) by a
+        worker if and when the current transaction commits.
+
+        :return: True if it will be, or False if the pool is full or
+                closed, in which case the caller should do the work
+                itself.
+        """
+
+    def flush(timeout=None):
+        """
+        Wait for the work submitted so far to be done, at most
+        *timeout* seconds if given.
+
+        :return: True if it is all done.
+        """
+
+    def close(timeout=None):
+        """
+        Stop accepting work, and :meth:`flush` the pool before
+        stopping its workers.
+
+        :return: True if all the work was done.
+        """
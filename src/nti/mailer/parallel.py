@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Rendering many messages in parallel, in a pool of processes.
+
+Rendering templates and inlining their CSS is CPU bound, so one
+process can only render a few messages a second, however many
+threads it has. A :class:`ProcessPoolRenderer` spreads the messages
+for many recipients over a :class:`concurrent.futures.ProcessPoolExecutor`,
+so that large sends scale with the number of cores::
+
+    with ProcessPoolRenderer(setup='myapp.mail.configure') as renderer:
+        for message in renderer.create_html_text_emails(
+                'myapp:templates/digest', recipients_and_args,
+                subject=_('Your weekly digest'), request=request,
+                ordered=False):
+            queue(message)
+
+The work that needs the request is done in the calling process, as
+for a deferred render job (see :mod:`nti.mailer._deferred`): the
+subject is translated, the
+:class:`~nti.mailer.interfaces.IMailerTemplateArgsUtility` utilities
+are asked for their arguments, and the request's preferred languages
+and URLs are sent to the workers with the (shared and per-recipient)
+template arguments, which must therefore be picklable.
+
+Each worker process must have the components needed to render
+registered. Forked workers inherit them; otherwise, give a *setup*
+function to register them. The *templates* that will be used can
+also be compiled when each worker starts, instead of for its first
+message.
+"""
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+import os
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+from itertools import islice
+
+from zope.dottedname import resolve as dottedname
+
+from nti.mailer._batch import _job_email_factory
+from nti.mailer._batch import _render_job_args
+from nti.mailer._compat import _marker
+from nti.mailer._default_template_mailer import _as_recipient_list
+from nti.mailer._default_template_mailer import _renderer_helper
+from nti.mailer._default_template_mailer import _resolve_templates
+
+logger = __import__('logging').getLogger(__name__)
+
+__all__ = (
+    'ProcessPoolRenderer',
+)
+
+
+def _warm_up(setup, templates, text_template_extension):
+    if isinstance(setup, str):
+        setup = dottedname.resolve(setup)
+    if setup is not None:
+        setup()
+    for template in templates:
+        specs, _ = _resolve_templates(template, text_template_extension, None, None, level=2)
+        for spec, package, _ in specs:
+            renderer = _renderer_helper(spec, package).renderer
+            # Compile the page templates now, if the renderer lets us.
+            template_file = getattr(renderer, 'implementation', lambda: None)()
+            cook = getattr(template_file, 'cook_check', None)
+            if cook is not None:
+                cook()
+
+
+def _render_chunk(job, attachments, chunk):
+    create = _job_email_factory(job, attachments)
+    return [create(recipients, args) for recipients, args in chunk]
+
+
+def _next_done(pending, ordered):
+    """
+    Wait for the first of the *pending* futures (any of them, unless
+    *ordered*), returning a list of those done and a list of those
+    still pending.
+    """
+    if ordered:
+        return pending[:1], pending[1:]
+    done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+    return list(done), list(not_done)
+
+
+def _rendered_messages(done):
+    return [message for future in done for message in future.result() if message]
+
+
+class ProcessPoolRenderer(object):
+    """
+    Renders messages in a pool of *workers* processes (by default,
+    one for each CPU).
+
+    :param setup: A function (or the dotted name of one) called with
+        no arguments when each worker starts, before anything is
+        rendered, to register the components rendering needs, such as
+        renderer factories and translation domains.
+    :param templates: The absolute asset specs of the templates (as
+        given to :meth:`create_html_text_emails`) to compile in each
+        worker when it starts.
+    :param int chunksize: The number of recipients sent to a worker
+        at a time. Larger chunks have less overhead; smaller ones
+        begin returning messages sooner.
+    :param mp_context: The :mod:`multiprocessing` context of the
+        workers.
+    """
+
+    def __init__(self, workers=None, setup=None, templates=(), chunksize=50,
+                 mp_context=None, text_template_extension='.txt'):
+        # pylint:disable=too-many-positional-arguments
+        self.workers = workers or os.cpu_count() or 1
+        self.chunksize = chunksize
+        self._executor = ProcessPoolExecutor(self.workers,
+                                             mp_context=mp_context,
+                                             initializer=_warm_up,
+                                             initargs=(setup, tuple(templates),
+                                                       text_template_extension))
+
+    def _chunks(self, recipients_and_args):
+        recipients_and_args = iter(recipients_and_args)
+        while True:
+            pairs = list(islice(recipients_and_args, self.chunksize))
+            if not pairs:
+                break
+            chunk = []
+            for recipient, args in pairs:
+                # Recipients are found here, where the adapters for
+                # them are, and only their addresses are sent.
+                recipients = _as_recipient_list(recipient)
+                if recipients:
+                    chunk.append((recipients, args))
+                else:
+                    logger.info("Not creating email for recipient without a valid address: %r",
+                                recipient)
+            if chunk:
+                yield chunk
+
+    def create_html_text_emails(self, base_template, recipients_and_args,
+                                subject='',
+                                request=None,
+                                template_args=None,
+                                reply_to=None,
+                                attachments=(),
+                                package=None,
+                                text_template_extension='.txt',
+                                context=_marker,
+                                ordered=True,
+                                _level=3):
+        """
+        Like :func:`~nti.mailer.interfaces.ITemplatedMailer.create_html_text_emails`,
+        but rendering in the worker processes.
+
+        The recipients are consumed lazily, with only a few chunks for
+        each worker sent at a time, and messages are returned as their
+        chunks are rendered: in the order of *recipients_and_args* if
+        *ordered*, otherwise as soon as possible.
+
+        The *context* is only used to translate the subject; a template
+        that needs it must be given it in the *template_args*.
+        """
+        # pylint:disable=too-many-positional-arguments,too-many-locals
+        if not subject:
+            raise ValueError("A subject is required")
+        job = _render_job_args(base_template, subject, request, template_args, reply_to,
+                               package, text_template_extension, context, level=_level)
+        return self._results(job, tuple(attachments), self._chunks(recipients_and_args),
+                             ordered)
+
+    def _results(self, job, attachments, chunks, ordered):
+        # Keep all the workers busy, without taking more recipients
+        # than they need.
+        limit = self.workers * 2
+        pending = []
+        try:
+            for chunk in chunks:
+                if len(pending) >= limit:
+                    done, pending = _next_done(pending, ordered)
+                    yield from _rendered_messages(done)
+                pending.append(self._executor.submit(_render_chunk, job, attachments, chunk))
+            while pending:
+                done, pending = _next_done(pending, ordered)
+                yield from _rendered_messages(done)
+        finally:
+            # If we're abandoned, don't render what nobody wants.
+            for future in pending:
+                future.cancel()
+
+    def close(self):
+        """
+        Stop the workers, after they finish what they are rendering.
+        """
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
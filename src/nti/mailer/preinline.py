@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Inlining the CSS of HTML templates ahead of time.
+
+:func:`~nti.mailer.interfaces.ITemplatedMailer.create_simple_html_text_email`
+inlines the CSS of each HTML message it renders with :mod:`premailer`,
+which is slow. For templates whose CSS doesn't depend on what they
+render, that can be done once, to the template itself: for each
+``name.pt``, :func:`preinline_template` writes ``name.inlined.pt``, and
+when that exists (and is newer than ``name.pt``), messages are rendered
+from it and not inlined again.
+
+Run this at build or deploy time, using the API or the
+``nti_mailer_preinline`` command::
+
+    nti_mailer_preinline src/mypackage/templates
+
+Templates that set ``class`` or ``style`` attributes dynamically (with
+``tal:attributes``), or whose stylesheets are themselves generated,
+must still be inlined after rendering; don't pre-inline those (or
+delete their ``.inlined.pt`` files).
+
+.. versionadded:: 1.0.1
+"""
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+import os
+import re
+import sys
+import logging
+import argparse
+
+from premailer import Premailer
+
+logger = __import__('logging').getLogger(__name__)
+
+__all__ = (
+    'INLINED_SUFFIX',
+    'inlined_name',
+    'is_inlined_name',
+    'preinline_source',
+    'preinline_template',
+    'preinline_templates',
+    'main',
+)
+
+#: The suffix, before the ``.pt`` extension, of pre-inlined templates.
+INLINED_SUFFIX = '.inlined'
+
+_TEMPLATE_EXTENSION = '.pt'
+
+# premailer serializes the document with lxml, which drops the doctype.
+_DOCTYPE = re.compile(r'^\s*(<!DOCTYPE[^>]*>)', re.IGNORECASE)
+
+
+def inlined_name(name):
+    """
+    The name (file name, path or asset spec) of the pre-inlined
+    variant of the template *name*.
+    """
+    base, extension = os.path.splitext(name)
+    return base + INLINED_SUFFIX + extension
+
+
+def is_inlined_name(name):
+    """
+    Is *name* that of a pre-inlined template?
+    """
+    return os.path.splitext(os.path.splitext(name)[0])[1] == INLINED_SUFFIX
+
+
+def preinline_source(source, **kwargs):
+    """
+    Inline the CSS of the template text *source*, returning the
+    text of the new template. *kwargs* are passed to
+    :class:`premailer.Premailer`.
+
+    Template markup (TAL, METAL and i18n attributes, and ``${}``
+    expressions) passes through untouched.
+    """
+    kwargs.setdefault('cssutils_logging_level', logging.CRITICAL)
+    result = Premailer(source, **kwargs).transform()
+    doctype = _DOCTYPE.match(source)
+    if doctype is not None and not _DOCTYPE.match(result):
+        result = doctype.group(1) + '\n' + result
+    return result
+
+
+def preinline_template(path, force=False, **kwargs):
+    """
+    Write the pre-inlined variant of the template at *path*, unless
+    it's already up to date (newer than *path*) and *force* is false.
+    *kwargs* are passed to :func:`preinline_source`.
+
+    :return: The path of the variant if we wrote it, otherwise None.
+    """
+    target = inlined_name(path)
+    if not force and _is_up_to_date(path, target):
+        return None
+    with open(path, encoding='utf-8') as f:
+        source = f.read()
+    result = preinline_source(source, **kwargs)
+    # Replace it atomically, in case messages are being sent from it.
+    tmp = target + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(result)
+    os.replace(tmp, target)
+    logger.info("Wrote %s", target)
+    return target
+
+
+def _is_up_to_date(path, target):
+    try:
+        return os.path.getmtime(target) >= os.path.getmtime(path)
+    except OSError:
+        return False
+
+
+def _templates_in(path):
+    if not os.path.isdir(path):
+        yield path
+        return
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith(_TEMPLATE_EXTENSION) and not is_inlined_name(filename):
+                yield os.path.join(dirpath, filename)
+
+
+def preinline_templates(paths, force=False, **kwargs):
+    """
+    Pre-inline the templates at each of *paths*, which may be
+    template files or directories to search for ``.pt`` files.
+    *force* and *kwargs* are as for :func:`preinline_template`.
+
+    :return: The paths of the variants we wrote.
+    """
+    written = []
+    for path in paths:
+        for template in _templates_in(path):
+            target = preinline_template(template, force=force, **kwargs)
+            if target is not None:
+                written.append(target)
+    return written
+
+
+def main(argv=None, stdout=None):
+    """
+    The ``nti_mailer_preinline`` command. The summary is written to
+    *stdout* (by default, :data:`sys.stdout`).
+    """
+    parser = argparse.ArgumentParser(
+        description='Write a copy of each HTML (.pt) template with its CSS inlined '
+        '(name.inlined.pt), which is used instead of inlining each message.')
+    parser.add_argument('paths',
+                        help='Templates, or directories to search for them',
+                        nargs='+')
+    parser.add_argument('-f', '--force',
+                        help='Rewrite variants even if they are up to date',
+                        action='store_true',
+                        default=False)
+    parser.add_argument('-v', '--verbose',
+                        help='Say what we wrote',
+                        action='store_true',
+                        default=False)
+    arguments = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stderr,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        level=logging.INFO if arguments.verbose else logging.WARN)
+    written = preinline_templates(arguments.paths, force=arguments.force)
+    print('Wrote %d pre-inlined templates' % len(written), file=stdout or sys.stdout)
+    return 0
@@ -4,97 +4,53 @@
 Processors for :mod:`repoze.sendmail`, intended as a drop-in replacement
 for the ``qp`` command line, using Amazon SES.
 
+:class:`~nti.mailer._ses.SESMailer`,
+:class:`~nti.mailer._processor.MailQueueProcessor` and
+:class:`~nti.mailer._metrics.QueueMetrics` can be imported from here.
+
 """
 
 from __future__ import print_function, absolute_import, division
 __docformat__ = "restructuredtext en"
 
-
 import os
+import time
+import signal
+import socket
 import argparse
+import contextlib
+import functools
 import sys
 import logging
-from email.message import Message
 
 import gevent
 
-from zope import interface
 from zope import deprecation
+from zope.dottedname import resolve as dottedname
 from zope.cachedescriptors.property import Lazy
 
-import boto3
-
-from botocore.config import Config
-
-from repoze.sendmail.encoding import encode_message
-
-from repoze.sendmail.interfaces import IMailer
-
 from repoze.sendmail.maildir import Maildir
 
 from repoze.sendmail.queue import ConsoleApp as _ConsoleApp
-from repoze.sendmail.queue import QueueProcessor
-
 
-logger = __import__('logging').getLogger(__name__)
-
-@interface.implementer(IMailer)
-class SESMailer(object):
-    """
-    This object does not handle throttling or quata actions;
-    see also :mod:`nti.app.bulkemail.process`.
-    """
+from nti.mailer.delivery import DEFAULT_PRIORITY
+from nti.mailer.delivery import WAKEUP_URGENT
+from nti.mailer.delivery import lane_path
+from nti.mailer.delivery import wakeup_socket_path
 
-    def __init__(self, region='us-east-1'):
-        self.region = region
+from nti.mailer._processor import MailQueueProcessor
+from nti.mailer._ses import SESMailer
 
-    @property
-    def _ses_config(self):
-        return Config(region_name=self.region)
-
-    @Lazy
-    def client(self):
-        client = boto3.client('ses', config=self._ses_config)
-        assert client
-        return client
-
-    def close(self): # pragma: no cover
-        pass
-
-    def send(self, fromaddr, toaddrs, message):
-        if not isinstance(message, Message):  # pragma: no cover
-            raise ValueError('Message must be instance of email.message.Message')
-
-        message = encode_message(message)
-
-        # Send the mail using SES, transforming SESError and known
-        # subclasses into something the SMTP-based queue processor
-        # knows how to deal with. NOTE: now that we're here, we have
-        # the opportunity to de-VERP the fromaddr found in the
-        # message, but still use the VERP form in the fromaddr we pass
-        # to SES. In this way we can handle bounces with the recipient
-        # none-the-wiser. See also :mod:`nti.app.bulkemail.process`
-        # NOTE: Each recipient (To, CC, BCC) counts as a distinct
-        # message for purposes of the quota limits. There are a
-        # maximum of 50 dests per address.
-        # (http://docs.aws.amazon.com/ses/latest/APIReference/API_SendRawEmail.html)
-        #
-        # NOTE: It is recommended to send an email to individuals:
-        # http://docs.aws.amazon.com/ses/latest/DeveloperGuide/sending-email.html
-        # "When you send an email to multiple recipients (recipients
-        # are "To", "CC", and "BCC" addresses) and the call to Amazon
-        # SES fails, the entire email is rejected and none of the
-        # recipients will receive the intended email. We therefore
-        # recommend that you send an email to one recipient at a time."
-
-        # QQQ: The docs for SendRawEmail say that destinations is not required,
-        # so how does that interact with what's in the message body?
-        # Boto will accept either a string, a list of strings, or None
-        # pylint:disable=no-member
-        self.client.send_raw_email(RawMessage={'Data': message},
-                                   Source=fromaddr,
-                                   Destinations=toaddrs)
+from nti.mailer._inotify import InotifyWatcher
+from nti.mailer._inotify import inotify_available
+from nti.mailer._maildir import ClaimingMaildir
+from nti.mailer._maildir import PriorityMaildir
+from nti.mailer._maildir import default_worker_id
+from nti.mailer._metrics import QueueMetrics
+from nti.mailer._metrics import serve_metrics
+from nti.mailer._throttle import SendQuota
 
+logger = __import__('logging').getLogger(__name__)
 
 class ConsoleApp(_ConsoleApp):
 
@@ -106,36 +62,127 @@ class ConsoleApp(_ConsoleApp):
         self.mailer = SESMailer()
         getattr(self.mailer, 'client')
 
+    def main(self):
+        if self._error:
+            return
+        # Not the superclass's plain QueueProcessor, which would send
+        # our tracking headers and render jobs as they are.
+        MailQueueProcessor(self.mailer, self.queue_path).send_messages()
+
 
 class _AbstractMailerProcess(object):
+    """
+    If *worker_id* is given, we claim each message before sending it
+    (see :class:`nti.mailer._maildir.ClaimingMaildir`), so that any
+    number of processes, each with a different *worker_id*, can
+    process the same queue.
+
+    Messages that fail to send are retried as described for
+    :class:`~nti.mailer._processor.MailQueueProcessor`, using
+    :attr:`max_attempts`, :attr:`retry_delay` and :attr:`max_retry_delay`.
+
+    If *lanes* is given, it is a sequence of priorities, highest
+    first, whose lanes (see :func:`nti.mailer.delivery.lane_path`)
+    we process together (see :class:`nti.mailer._maildir.PriorityMaildir`):
+    strictly in order of priority, or, if *lane_weights* are given,
+    by weighted round robin. The default is to process only the
+    queue directory itself.
+
+    If *metrics* (a :class:`nti.mailer._metrics.QueueMetrics`) is
+    given, we record what we do in it, and it measures our queue.
+    """
 
     _exit = False
 
-    def __init__(self, mailer_factory, queue_path, sleep_seconds=120):  # pylint: disable=unused-argument
+    max_attempts = 10
+    retry_delay = 60
+    max_retry_delay = 3600
+
+    def __init__(self, mailer_factory, queue_path, sleep_seconds=120, # pylint: disable=unused-argument
+                 concurrency=1, worker_id=None, lanes=None, lane_weights=None,
+                 metrics=None):
+        # pylint:disable=too-many-positional-arguments,too-many-arguments
         self.mailer_factory = mailer_factory
         self.sleep_seconds = sleep_seconds
         self.queue_path = queue_path
-        self.mail_dir = Maildir(self.queue_path, create=True)
+        self.concurrency = concurrency
+        self.worker_id = worker_id
+        self.lanes = tuple(lanes) if lanes else (DEFAULT_PRIORITY,)
+        self.lane_paths = [lane_path(queue_path, lane) for lane in self.lanes]
+        maildirs = [self._make_maildir(path) for path in self.lane_paths]
+        if len(maildirs) == 1 and self.lane_paths[0] == queue_path:
+            self.mail_dir = maildirs[0]
+        else:
+            self.mail_dir = PriorityMaildir(maildirs, lane_weights)
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.track(self)
+
+    def _make_maildir(self, path):
+        if self.worker_id:
+            return ClaimingMaildir(path, self.worker_id, create=True)
+        return Maildir(path, create=True)
 
     def _maildir_factory(self, *_args, **_kwargs):
         return self.mail_dir
 
-    def _do_process_queue(self):
+    @Lazy
+    def mailer(self):
+        """
+        The mailer we use to send mail. It's created by the
+        *mailer_factory* when first needed, and reused (along with
+        its connections) until :meth:`close`.
+        """
         mailer = self.mailer_factory()
         assert mailer
-        try:
-            processor = QueueProcessor(mailer,
+        return mailer
+
+    def _close_mailer(self):
+        mailer = self.__dict__.pop('mailer', None)
+        close = getattr(mailer, 'close', None)
+        if close is not None:
+            close()
+
+    def _do_process_queue(self):
+        processor = MailQueueProcessor(self.mailer,
                                        # Note this gets ignored by the Maildir factory we send
                                        self.queue_path,
-                                       Maildir=self._maildir_factory)
-            logger.info('Processing messages %s' % (processor.maildir.path))
+                                       Maildir=self._maildir_factory,
+                                       concurrency=self.concurrency,
+                                       max_attempts=self.max_attempts,
+                                       retry_delay=self.retry_delay,
+                                       max_retry_delay=self.max_retry_delay,
+                                       metrics=self.metrics)
+        logger.info('Processing messages %s (concurrency %d)',
+                    processor.maildir.path, processor.concurrency)
+        with (self.metrics.drain_duration.time() if self.metrics is not None
+              else contextlib.nullcontext()):
             processor.send_messages()
-        finally:
-            try:
-                mailer.close()
-            except AttributeError:
-                pass
-            mailer = None
+        if processor.not_ready:
+            self._mailer_not_ready()
+        elif processor.paused:
+            self._quota_exhausted()
+        if processor.next_retry is not None:
+            self._retry_scheduled(processor.next_retry)
+
+    def _quota_exhausted(self):
+        """
+        Called when processing stopped because we've run out
+        of quota. Subclasses should arrange to try again later.
+        """
+
+    def _mailer_not_ready(self):
+        """
+        Called when processing stopped because the mailer couldn't
+        get ready to send. Subclasses should arrange to try again later.
+        """
+
+    def _retry_scheduled(self, when):
+        """
+        Called when messages were left in the queue to be retried
+        at *when* (as from :func:`time.time`). Subclasses should
+        arrange to process the queue then.
+        """
 
     def close(self):
         raise NotImplementedError
@@ -144,6 +191,9 @@ class _AbstractMailerProcess(object):
 class LoopingMailerProcess(_AbstractMailerProcess):
     """
     A mailer processor that dumps the queue on a provided interval.
+
+    If we run out of send quota, we simply try again at the next
+    interval.
     """
 
     # Hook for testing.
@@ -157,6 +207,7 @@ class LoopingMailerProcess(_AbstractMailerProcess):
 
     def close(self):
         self._exit = True
+        self._close_mailer()
 
 def _stat_modified_time(attrs):
     """
@@ -195,56 +246,276 @@ def _stat_watcher_modified(watcher):
     # the configuration. This is easily observed on GitHub Actions
     # with both watchers; our writing process has to sleep to allow
     # the modification times to appear to change.
-    # XXX: Moreover, the very act of processing the queue will probably cause
-    # the watcher to fire. We should probably stop the watcher while
+    # Note that the very act of processing the queue will cause
+    # the watcher to fire, so MailerWatcher stops the watcher while
     # processing the queue.
     return _stat_modified_time(watcher.prev) != _stat_modified_time(watcher.attr)
 
 
+def _socket_is_listening(path):
+    """
+    Is some process bound to the Unix datagram socket at *path*?
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        # Doesn't exist, or nobody's home.
+        return False
+    finally:
+        sock.close()
+    return True
+
+
 _MINIMUM_DEBOUNCE_INTERVAL_SECONDS = 10
 
 
-class MailerWatcher(_AbstractMailerProcess):
+class MailerWatcher(_AbstractMailerProcess): # pylint:disable=too-many-instance-attributes
     """
-    A Mailer processor that watches for changes in the mail directory
-    using gevent stat watchers.
+    A Mailer processor that watches for changes in the mail directory.
+
+    On Linux, we use inotify (see :mod:`nti.mailer._inotify`) to be
+    told as soon as messages arrive in the ``new`` directory. If that's
+    not available, or :attr:`use_inotify` is false, we fall back
+    to polling the directory with a gevent stat watcher.
+
+    We also listen on a Unix datagram socket in the maildir (see
+    :func:`nti.mailer.delivery.wake_queue_processor`) for
+    notifications that mail has been queued. Urgent notifications
+    cause us to process the queue immediately, even if we recently did
+    so; others are debounced like any other change. Urgent
+    notifications that arrive while we are processing the queue result
+    in (at most) one more pass as soon as we finish.
+
+    If we run out of send quota, we stop processing the queue
+    (except to check the quota) until it frees up, checking every
+    :attr:`quota_pause_seconds` even if no new mail arrives.
+    Likewise, we process the queue when messages that failed to send
+    are due to be retried.
+
+    If we process several lanes, we watch the ``new`` directory
+    of each.
+
+    Processing the queue changes the ``new`` directory, which the stat
+    watcher would see as a reason to process the queue again. So we
+    stop watching while we process, and afterwards compare the
+    directory with what it held when we started; only if messages
+    arrived in the meantime do we schedule (exactly one) follow-up pass.
     """
     watcher = None
     debouncer = None
     debouncer_count = 0
+    draining = False
+    urgent_pending = False
+    quota_timer = None
+    retry_timer = None
+    wakeup_socket = None
+    wakeup_watcher = None
+    _wakeup_socket_stat = None
 
     max_process_frequency_seconds = _MINIMUM_DEBOUNCE_INTERVAL_SECONDS
+    quota_pause_seconds = 300
+    use_inotify = True
+    use_wakeup_socket = True
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        hub = gevent.get_hub()
-        to_watch = os.path.join(self.queue_path, 'new')
+        #: One watcher for the ``new`` directory of each lane.
+        self.watchers = [self._make_watcher(os.path.join(path, 'new'))
+                         for path in self.lane_paths]
+        #: The watcher for the highest priority lane.
+        self.watcher = self.watchers[0]
+        if self.use_wakeup_socket:
+            self.wakeup_socket = self._bind_wakeup_socket()
+        if self.wakeup_socket is not None:
+            self.wakeup_watcher = gevent.get_hub().loop.io(self.wakeup_socket.fileno(), 1)
+
+    def _bind_wakeup_socket(self):
+        path = wakeup_socket_path(self.queue_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            if _socket_is_listening(path):
+                # Another worker on this queue has it; we'll
+                # find out about mail from the directory.
+                logger.info("Another process is listening for wakeups at %s", path)
+                sock.close()
+                return None
+            try:
+                # Left over from a previous run.
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            sock.bind(path)
+            self._wakeup_socket_stat = os.stat(path)
+        except OSError:
+            logger.exception("Failed to listen for wakeups at %s", path)
+            sock.close()
+            return None
+        sock.setblocking(False)
+        return sock
+
+    def _make_watcher(self, to_watch):
+        if self.use_inotify and inotify_available():
+            try:
+                return InotifyWatcher(to_watch)
+            except OSError: # pragma: no cover
+                logger.exception("Failed to watch %s with inotify; polling instead", to_watch)
         # TODO: Do we need to get abspath() on to_watch? I (JAM)
         # suspect watchers and symlinks don't play well
-        self.watcher = hub.loop.stat(to_watch)
+        return gevent.get_hub().loop.stat(to_watch)
 
     def close(self):
         self._stop_watching()
+        self._close_mailer()
         # It's critical to close() watchers before we destroy them
         # (let them be GC'd). Otherwise, gevent can crash (mostly
         # under libuv). See
         # https://github.com/gevent/gevent/issues/1805
-        self.watcher.close()
+        for watcher in self.watchers:
+            watcher.close()
         if self.debouncer is not None:
             self.debouncer.stop()
             self.debouncer.close()
             self.debouncer = None
         self.debouncer_count = 0
+        self._stop_quota_timer()
+        self._stop_retry_timer()
+        if self.wakeup_watcher is not None:
+            self.wakeup_watcher.stop()
+            self.wakeup_watcher.close()
+            self.wakeup_watcher = None
+        if self.wakeup_socket is not None:
+            path = self.wakeup_socket.getsockname()
+            self.wakeup_socket.close()
+            self.wakeup_socket = None
+            try:
+                # Only if it's still ours, not one another
+                # worker bound after we stopped listening.
+                if os.path.samestat(os.stat(path), self._wakeup_socket_stat):
+                    os.unlink(path)
+            except OSError: # pragma: no cover
+                pass
+
+    def _stop_quota_timer(self):
+        if self.quota_timer is not None:
+            self.quota_timer.stop()
+            self.quota_timer.close()
+            self.quota_timer = None
+
+    def _quota_exhausted(self):
+        self._pause('Send quota exhausted')
+
+    def _mailer_not_ready(self):
+        self._pause('Mailer not ready to send')
+
+    def _pause(self, why):
+        if self.quota_timer is None:
+            logger.info('%s. Checking again in %i seconds',
+                        why, self.quota_pause_seconds)
+            self.quota_timer = gevent.get_hub().loop.timer(self.quota_pause_seconds)
+            self.quota_timer.start(self._quota_timer_fired)
+
+    def _quota_timer_fired(self):
+        self._stop_quota_timer()
+        # We've already waited; don't wait again for the quota's own
+        # refresh interval before asking SES whether we can send.
+        quota = getattr(self.mailer, 'quota', None)
+        if quota is not None:
+            quota.expire()
+        self._youve_got_mail()
+
+    def _stop_retry_timer(self):
+        if self.retry_timer is not None:
+            self.retry_timer.stop()
+            self.retry_timer.close()
+            self.retry_timer = None
+
+    def _retry_scheduled(self, when):
+        # One timer, for the earliest retry; processing the queue
+        # then will schedule the next.
+        self._stop_retry_timer()
+        delay = max(0, when - time.time())
+        logger.debug('Retrying failed messages in %i seconds', delay)
+        self.retry_timer = gevent.get_hub().loop.timer(delay)
+        self.retry_timer.start(self._retry_timer_fired)
+
+    def _retry_timer_fired(self):
+        self._stop_retry_timer()
+        self._youve_got_mail()
 
     def _start_watching(self):
         assert self.watcher
         logger.debug('Starting watcher for MailDir %s', self.watcher.path)
-        self.watcher.start(self._stat_change_observed)
+        self._start_file_watcher()
+        if self.wakeup_watcher is not None:
+            self.wakeup_watcher.start(self._wakeup_received)
+
+    def _start_file_watcher(self):
+        for watcher in self.watchers:
+            if isinstance(watcher, InotifyWatcher):
+                watcher.start(functools.partial(self._inotify_change_observed, watcher))
+            else:
+                watcher.start(functools.partial(self._stat_change_observed, watcher))
+
+    def _stop_file_watcher(self):
+        for watcher in self.watchers:
+            watcher.stop()
 
     def _stop_watching(self):
         assert self.watcher
         logger.debug('Stopping watcher for MailDir %s', self.watcher.path)
-        self.watcher.stop()
+        self._stop_file_watcher()
+        if self.wakeup_watcher is not None:
+            self.wakeup_watcher.stop()
+
+    def _new_messages(self):
+        messages = set()
+        for watcher in self.watchers:
+            new = watcher.path
+            try:
+                messages.update(os.path.join(new, name) for name in os.listdir(new)
+                                if not name.startswith('.'))
+            except OSError: # pragma: no cover
+                pass
+        return messages
+
+    def _do_process_queue(self):
+        self.draining = True
+        try:
+            self._drain_queue()
+            while self.urgent_pending:
+                # However many urgent wakeups came in, one more
+                # pass gets all their messages.
+                self.urgent_pending = False
+                logger.info('Processing mail queue again for urgent mail')
+                self._drain_queue()
+        finally:
+            self.draining = False
+
+    def _drain_queue(self):
+        watching = self.watcher.active
+        if watching:
+            self._stop_file_watcher()
+        before = self._new_messages()
+        try:
+            super()._do_process_queue()
+        finally:
+            if watching:
+                # Restart before we look, so that nothing
+                # can slip between the two.
+                self._start_file_watcher()
+        arrived = self._new_messages() - before
+        if arrived:
+            logger.debug('%d messages arrived while processing the queue', len(arrived))
+            self._messages_arrived_while_processing()
+
+    def _messages_arrived_while_processing(self):
+        if self.debouncer is not None and self.debouncer.active:
+            # One more pass when the timer fires; no matter how
+            # many arrived, one pass gets them all.
+            self.debouncer_count = max(self.debouncer_count, 1)
+        else:
+            self._youve_got_mail()
 
     def _youve_got_mail(self):
         # We've detected we have mail. We want to debounce
@@ -265,16 +536,62 @@ class MailerWatcher(_AbstractMailerProcess):
             self._do_process_queue()
         else:
             self.debouncer_count += 1
+            if self.metrics is not None:
+                self.metrics.debounce_deferrals.inc()
             logger.debug('Deferring queue processing because it was run recently')
 
-    def _stat_change_observed(self):
+    def _stat_change_observed(self, watcher=None):
         # On certain file systems we will see stat changes
         # for access times which we don't care about. We really
         # only care about modified times.
-        if _stat_watcher_modified(self.watcher):
+        if _stat_watcher_modified(watcher or self.watcher):
             logger.debug('Maildir watcher detected MailDir modification')
             self._youve_got_mail()
 
+    def _inotify_change_observed(self, watcher=None):
+        # Unlike the stat watcher, this only fires for new
+        # messages, not for everything else that happens in the directory.
+        # But the kernel keeps queuing events while we're stopped, so
+        # these may be messages we already sent, or already
+        # noticed arriving while we were processing.
+        watcher = watcher or self.watcher
+        names = watcher.names
+        new = watcher.path
+        if names and not any(os.path.exists(os.path.join(new, name)) for name in names):
+            logger.debug('Ignoring messages that have already been sent: %s', names)
+            return
+        logger.debug('Maildir watcher detected new messages: %s', names)
+        self._youve_got_mail()
+
+    def _wakeup_received(self):
+        # Take everything that's waiting, so a burst of
+        # notifications results in one pass over the queue.
+        urgent = False
+        while True:
+            try:
+                data = self.wakeup_socket.recv(64)
+            except BlockingIOError:
+                break
+            urgent = urgent or data == WAKEUP_URGENT
+        logger.debug('Received %s wakeup', 'urgent' if urgent else 'normal')
+        if urgent:
+            self._urgent_mail()
+        else:
+            self._youve_got_mail()
+
+    def _urgent_mail(self):
+        if self.draining:
+            # Sending yields to the hub, letting us get here; don't
+            # start another pass until this one is done.
+            self.urgent_pending = True
+        elif self.debouncer is not None and self.debouncer.active:
+            # Don't wait for the debouncer, but let it keep
+            # running to collect whatever else comes in.
+            logger.info('Processing mail queue for urgent mail')
+            self._do_process_queue()
+        else:
+            self._youve_got_mail()
+
     def _timer_fired(self):
         self.debouncer.stop()
         self.debouncer.close()
@@ -307,8 +624,99 @@ def _log_level_for_verbosity(verbosity=0):
     return _LOG_LEVELS[verbosity]
 
 
-def run_process(): # pragma: no cover
+def _send_rate(value):
+    if value == SESMailer.DISCOVER_SEND_RATE:
+        return value
+    try:
+        rate = float(value)
+    except ValueError:
+        rate = 0.0
+    if rate <= 0:
+        raise argparse.ArgumentTypeError('must be a positive number or %r'
+                                         % (SESMailer.DISCOVER_SEND_RATE,))
+    return rate
+
 
+class _WorkerSupervisor(object):
+    """
+    Forks *workers* child processes, each of which calls *target*
+    and exits when it returns, and replaces any that die until
+    we are asked to :meth:`stop` (which happens on SIGTERM or SIGINT).
+    """
+
+    #: Seconds to wait before replacing a worker that died, so
+    #: that one that can't start doesn't have us spinning.
+    respawn_delay = 5
+
+    # Hooks for testing.
+    _fork = staticmethod(os.fork)
+    _waitpid = staticmethod(os.waitpid)
+    _kill = staticmethod(os.kill)
+    _exit = staticmethod(os._exit) # pylint:disable=protected-access
+    _sleep = staticmethod(time.sleep)
+
+    def __init__(self, target, workers):
+        self.target = target
+        self.workers = workers
+        self.children = set()
+        self.stopping = False
+
+    def _spawn(self):
+        pid = self._fork()
+        if pid:
+            self.children.add(pid)
+            logger.info('Started worker %d', pid)
+            return pid
+
+        # In the child. Forget about the parent's signal handlers
+        # (and its children), and its gevent loop.
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        gevent.reinit()
+        code = 0
+        try:
+            self.target()
+        except BaseException: # pylint:disable=broad-except
+            logger.exception('Worker failed')
+            code = 1
+        self._exit(code)
+        return 0 # Only when testing.
+
+    def stop(self, *_args):
+        """
+        Stop all the workers, and don't replace them. Suitable for
+        use as a signal handler.
+        """
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                self._kill(pid, signal.SIGTERM)
+            except ProcessLookupError: # pragma: no cover
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _ in range(self.workers):
+            self._spawn()
+
+        while self.children:
+            try:
+                pid, status = self._waitpid(-1, 0)
+            except ChildProcessError: # pragma: no cover
+                break
+            if pid not in self.children: # pragma: no cover
+                continue
+            self.children.discard(pid)
+            if self.stopping:
+                continue
+            logger.warning('Worker %d exited with status %d; replacing it', pid, status)
+            self._sleep(self.respawn_delay)
+            if not self.stopping:
+                self._spawn()
+
+
+def _make_process_parser(): # pragma: no cover
     parser = argparse.ArgumentParser(
         description='Spawn a process that stays alive, periodically polling the mail queue '
         'and sending new mail using SES.')
@@ -317,6 +725,64 @@ def run_process(): # pragma: no cover
                         action='store')
     parser.add_argument('-r', '--sesregion',
                         help='The SES region to connect to.')
+    parser.add_argument('--max-send-rate',
+                        help=('The maximum number of messages (destinations) to send each '
+                              'second, or "auto" to ask SES. (default: no limit)'),
+                        action='store',
+                        type=_send_rate)
+    parser.add_argument('--adaptive',
+                        help=('Slow down when SES throttles us, and speed back up '
+                              '(to at most --max-send-rate and --concurrency) as sends succeed.'),
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--ignore-quota',
+                        help=("Don't track the SES 24-hour send quota. By default, "
+                              "we stop sending when it's used up, and resume when it isn't."),
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--quota-reserve',
+                        help=('Stop sending when this many messages (destinations) '
+                              'remain in the quota (default: %(default)s)'),
+                        action='store',
+                        type=int,
+                        default=0)
+    parser.add_argument('--poll',
+                        help=('Poll the maildir for changes instead of using inotify. '
+                              'This is the default on platforms without inotify.'),
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--connect-timeout',
+                        help='Seconds to wait for a connection to SES (default: boto3 default).',
+                        action='store',
+                        type=float)
+    parser.add_argument('--read-timeout',
+                        help='Seconds to wait for SES to respond (default: boto3 default).',
+                        action='store',
+                        type=float)
+    parser.add_argument('--retry-mode',
+                        help='The boto3 retry mode (default: boto3 default).',
+                        action='store',
+                        choices=('legacy', 'standard', 'adaptive'))
+    parser.add_argument('--max-attempts',
+                        help=('The maximum number of times boto3 tries each call '
+                              '(default: boto3 default).'),
+                        action='store',
+                        type=int)
+    parser.add_argument('--max-send-attempts',
+                        help=('The number of times to try sending a message before moving it '
+                              'to the "failed" maildir (default: %(default)s)'),
+                        action='store',
+                        default=_AbstractMailerProcess.max_attempts,
+                        type=int)
+    parser.add_argument('--retry-delay',
+                        help=('Seconds to wait before retrying a message that failed to send, '
+                              'doubled after each failure (default: %(default)s)'),
+                        action='store',
+                        default=_AbstractMailerProcess.retry_delay,
+                        type=int)
+    parser.add_argument('--endpoint-url',
+                        help='The URL to send SES requests to (default: the region\'s endpoint).',
+                        action='store')
     parser.add_argument('-v', '--verbose',
                         help='How verbose to log.',
                         action='count',
@@ -328,28 +794,115 @@ def run_process(): # pragma: no cover
                         action='store',
                         default=MailerWatcher.max_process_frequency_seconds,
                         type=int)
+    parser.add_argument('-c', '--concurrency',
+                        help=('The maximum number of messages to send at the same time '
+                              '(default: %(default)s)'),
+                        action='store',
+                        default=1,
+                        type=int)
+    parser.add_argument('--workers',
+                        help=('The number of worker processes to fork, each processing '
+                              'the queue with the given --concurrency (default: %(default)s)'),
+                        action='store',
+                        default=1,
+                        type=int)
+    parser.add_argument('--claim',
+                        help=('Claim messages before sending them, so that other processes '
+                              '(perhaps on other hosts) can process the same queue. '
+                              'This is implied by --workers.'),
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--lanes',
+                        help=('Comma-separated priorities whose lanes to process, highest '
+                              'first; %s is the queue directory itself '
+                              '(default: only that)' % DEFAULT_PRIORITY),
+                        action='store',
+                        type=lambda value: [lane.strip() for lane in value.split(',')])
+    parser.add_argument('--lane-weights',
+                        help=('Comma-separated weights, one for each of --lanes, for '
+                              'weighted round robin between them (default: strict priority)'),
+                        action='store',
+                        type=lambda value: [int(weight) for weight in value.split(',')])
 
+    parser.add_argument('--render-setup',
+                        help=('The dotted name of a function to call (with no arguments) '
+                              'in each worker before processing the queue, to register the '
+                              'templates and components needed to render deferred messages'),
+                        action='store')
+    parser.add_argument('--metrics-port',
+                        help=('Serve Prometheus metrics over HTTP on this port. With '
+                              '--workers, each worker uses the first free port of the '
+                              'as many that follow it (default: no metrics)'),
+                        action='store',
+                        type=int)
+    parser.add_argument('--metrics-host',
+                        help='The address to serve metrics on (default: %(default)s)',
+                        action='store',
+                        default='127.0.0.1')
+    return parser
+
+
+def run_process(): # pragma: no cover
+    parser = _make_process_parser()
     arguments = parser.parse_args()
+    if arguments.lane_weights and len(arguments.lane_weights) != len(arguments.lanes or ()):
+        parser.error('--lane-weights needs one weight for each of --lanes')
 
     log_level = _log_level_for_verbosity(arguments.verbose)
     logging.basicConfig(stream=sys.stderr,
                         format='%(asctime)s %(levelname)s %(message)s',
                         level=log_level)
 
-    _mailer_factory = SESMailer
+    mailer_kwargs = {
+        'max_send_rate': arguments.max_send_rate,
+        'adaptive': arguments.adaptive,
+        'max_concurrency': arguments.concurrency,
+        'connect_timeout': arguments.connect_timeout,
+        'read_timeout': arguments.read_timeout,
+        'retry_mode': arguments.retry_mode,
+        'max_attempts': arguments.max_attempts,
+        'endpoint_url': arguments.endpoint_url,
+    }
+    if not arguments.ignore_quota:
+        # Shared by all the mailers we create.
+        mailer_kwargs['quota'] = SendQuota(reserve=arguments.quota_reserve)
     if arguments.sesregion:
-        # pylint:disable=redefined-variable-type
-        # pylint:disable=unnecessary-lambda-assignment
-        _mailer_factory = lambda: SESMailer(arguments.sesregion)
-
-    app = MailerWatcher(_mailer_factory, arguments.queue_path)
-
-    if arguments.interval:
-        app.max_process_frequency_seconds = max(_MINIMUM_DEBOUNCE_INTERVAL_SECONDS,
-                                                arguments.interval)
-
-    logger.info('Using debounce interval of %i', app.max_process_frequency_seconds)
-    app.run()
+        mailer_kwargs['region'] = arguments.sesregion
+
+    factory = MailerWatcher
+    if arguments.poll:
+        factory = type('PollingMailerWatcher', (MailerWatcher,), {'use_inotify': False})
+
+    def run_worker():
+        if arguments.render_setup:
+            dottedname.resolve(arguments.render_setup)()
+        metrics = None
+        if arguments.metrics_port is not None:
+            metrics = QueueMetrics()
+            serve_metrics(metrics, arguments.metrics_host,
+                           arguments.metrics_port, arguments.workers)
+        _mailer_factory = functools.partial(SESMailer, metrics=metrics, **mailer_kwargs)
+        claim = arguments.claim or arguments.workers > 1
+        app = factory(_mailer_factory, arguments.queue_path,
+                      concurrency=arguments.concurrency,
+                      worker_id=default_worker_id() if claim else None,
+                      lanes=arguments.lanes,
+                      lane_weights=arguments.lane_weights,
+                      metrics=metrics)
+
+        app.max_attempts = arguments.max_send_attempts
+        app.retry_delay = arguments.retry_delay
+        if arguments.interval:
+            app.max_process_frequency_seconds = max(_MINIMUM_DEBOUNCE_INTERVAL_SECONDS,
+                                                    arguments.interval)
+
+        logger.info('Using debounce interval of %i', app.max_process_frequency_seconds)
+        app.run()
+
+    if arguments.workers > 1:
+        _WorkerSupervisor(run_worker, arguments.workers).run()
+    else:
+        run_worker()
 
 def run_console(): # pragma: no cover
     if '--help' in sys.argv:
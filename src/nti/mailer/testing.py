@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Support for testing code that sends mail.
+
+:class:`FakeSESServer` is a local stand-in for the parts of the Amazon
+SES HTTP API that :class:`nti.mailer._ses.SESMailer` uses. Point a
+mailer at it with the *endpoint_url* argument::
+
+    with FakeSESServer(latency=0.01, max_send_rate=14) as server:
+        with unittest.mock.patch.dict(os.environ, server.environ):
+            mailer = SESMailer(endpoint_url=server.endpoint_url)
+            ...
+        assert len(server.messages) == ...
+
+.. versionadded:: 1.0.1
+"""
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+import time
+import uuid
+import base64
+import random
+import threading
+from collections import deque
+from collections import namedtuple
+from urllib.parse import parse_qs
+from xml.sax.saxutils import escape
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+logger = __import__('logging').getLogger(__name__)
+
+__all__ = (
+    'SentMessage',
+    'FakeSESServer',
+)
+
+_NAMESPACE = 'http://ses.amazonaws.com/doc/2010-12-01/'
+
+#: A message accepted by :class:`FakeSESServer`. *data* is the raw
+#: message, as bytes.
+SentMessage = namedtuple('SentMessage', ('message_id', 'source', 'destinations', 'data'))
+
+
+class _SESError(Exception):
+
+    def __init__(self, status, code, message, fault='Sender'):
+        super().__init__(status, code, message)
+        self.status = status
+        self.code = code
+        self.message = message
+        self.fault = fault
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    # Keep connections open, as botocore expects.
+    protocol_version = 'HTTP/1.1'
+
+    server_version = 'FakeSES'
+
+    def log_message(self, format, *args): # pylint:disable=redefined-builtin
+        logger.debug(format, *args)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        params = {k: v[0] for k, v in parse_qs(body.decode('utf-8')).items()}
+        status, result = self.server.fake_ses.handle(params)
+        data = result.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+# Its configuration, and the counters tests inspect, are all
+# plain attributes.
+class FakeSESServer(object): # pylint:disable=too-many-instance-attributes
+    """
+    An HTTP server on localhost that answers the SES ``SendRawEmail``
+    and ``GetSendQuota`` actions (other actions get an error).
+
+    *latency* is how long to wait before answering each request: a
+    number of seconds, a callable returning one (for example,
+    ``lambda: random.expovariate(50)``), or a dictionary mapping
+    action names to either of those.
+
+    If *max_send_rate* is given, we throttle ``SendRawEmail`` calls
+    that would take the number of destinations sent to in the last
+    second above it, just as SES does. If *max_24_hour_send* is given,
+    we refuse to send to more than that many destinations in total,
+    with SES's "Daily message quota exceeded" error. Both values are
+    reported by ``GetSendQuota``.
+
+    *error_rate* is the fraction of requests (chosen at random, using
+    *seed* if given) that fail with an HTTP 500 ``InternalFailure``.
+
+    Each message we accept is passed, as a :class:`SentMessage`, to
+    *sink*; by default, they are collected in :attr:`messages`. Pass
+    a sink that discards them for long load tests.
+
+    Use an instance as a context manager, or call :meth:`start` and
+    :meth:`stop`. The server runs in daemon threads, one per connection.
+    """
+
+    #: Environment variables that give boto3 the (fake) credentials
+    #: and region it needs before it will talk to us.
+    environ = {
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+        'AWS_SESSION_TOKEN': 'testing',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+    }
+
+    _clock = staticmethod(time.monotonic)
+    _sleep = staticmethod(time.sleep)
+
+    def __init__(self, latency=0, max_send_rate=None, max_24_hour_send=None,
+                 error_rate=0, sink=None, seed=None, host='127.0.0.1', port=0):
+        # pylint:disable=too-many-positional-arguments,too-many-arguments
+        self.latency = latency
+        self.max_send_rate = max_send_rate
+        self.max_24_hour_send = max_24_hour_send
+        self.error_rate = error_rate
+        self.messages = []
+        self.sink = sink if sink is not None else self.messages.append
+        self.random = random.Random(seed)
+        self.host = host
+        self.port = port
+        #: The number of requests of each action we have answered.
+        self.requests = {}
+        #: The number of requests we throttled.
+        self.throttled = 0
+        #: The number of requests we failed at random.
+        self.errors = 0
+        self.sent_last_24_hours = 0
+        self._recent = deque() # (time, destination count)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def endpoint_url(self):
+        """
+        The URL to pass as :class:`~nti.mailer._ses.SESMailer`'s
+        *endpoint_url*.
+        """
+        return 'http://%s:%d' % (self.host, self.port)
+
+    def start(self):
+        server = ThreadingHTTPServer((self.host, self.port), _Handler)
+        server.daemon_threads = True
+        server.fake_ses = self
+        self.port = server.server_address[1]
+        self._server = server
+        self._thread = threading.Thread(target=server.serve_forever,
+                                        name='FakeSESServer',
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, t, v, tb):
+        self.stop()
+
+    def _latency_for(self, action):
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = latency.get(action, 0)
+        if callable(latency):
+            latency = latency()
+        return latency
+
+    def handle(self, params):
+        """
+        Answer the request with the form parameters *params*.
+
+        :return: The HTTP status and the XML body.
+        """
+        action = params.get('Action', '')
+        with self._lock:
+            self.requests[action] = self.requests.get(action, 0) + 1
+        delay = self._latency_for(action)
+        if delay:
+            self._sleep(delay)
+        try:
+            if self.error_rate and self.random.random() < self.error_rate:
+                with self._lock:
+                    self.errors += 1
+                raise _SESError(500, 'InternalFailure',
+                                'The request processing has failed.', 'Receiver')
+            handler = getattr(self, '_handle_' + action, None)
+            if handler is None:
+                raise _SESError(400, 'InvalidAction', 'Unknown action %s' % action)
+            result = handler(params)
+        except _SESError as ex:
+            return ex.status, (
+                '<ErrorResponse xmlns="%s"><Error><Type>%s</Type><Code>%s</Code>'
+                '<Message>%s</Message></Error><RequestId>%s</RequestId></ErrorResponse>'
+                % (_NAMESPACE, ex.fault, ex.code, escape(ex.message), uuid.uuid4())
+            )
+        return 200, (
+            '<%sResponse xmlns="%s"><%sResult>%s</%sResult>'
+            '<ResponseMetadata><RequestId>%s</RequestId></ResponseMetadata></%sResponse>'
+            % (action, _NAMESPACE, action, result, action, uuid.uuid4(), action)
+        )
+
+    def _handle_GetSendQuota(self, _params): # pylint:disable=invalid-name
+        return (
+            '<SentLast24Hours>%s</SentLast24Hours>'
+            '<Max24HourSend>%s</Max24HourSend>'
+            '<MaxSendRate>%s</MaxSendRate>'
+            % (float(self.sent_last_24_hours),
+               # SES uses -1 for unlimited.
+               float(self.max_24_hour_send if self.max_24_hour_send is not None else -1),
+               float(self.max_send_rate if self.max_send_rate is not None else -1))
+        )
+
+    def _handle_SendRawEmail(self, params): # pylint:disable=invalid-name
+        destinations = []
+        while 'Destinations.member.%d' % (len(destinations) + 1) in params:
+            destinations.append(params['Destinations.member.%d' % (len(destinations) + 1)])
+        count = len(destinations) or 1
+        with self._lock:
+            if (self.max_24_hour_send is not None
+                    and self.sent_last_24_hours + count > self.max_24_hour_send):
+                self.throttled += 1
+                raise _SESError(400, 'Throttling', 'Daily message quota exceeded.')
+            if self.max_send_rate is not None:
+                now = self._clock()
+                recent = self._recent
+                while recent and now - recent[0][0] >= 1:
+                    recent.popleft()
+                if sum(n for _, n in recent) + count > self.max_send_rate:
+                    self.throttled += 1
+                    raise _SESError(400, 'Throttling', 'Maximum sending rate exceeded.')
+                recent.append((now, count))
+            self.sent_last_24_hours += count
+
+        message_id = str(uuid.uuid4())
+        self.sink(SentMessage(message_id,
+                              params.get('Source'),
+                              tuple(destinations),
+                              base64.b64decode(params.get('RawMessage.Data', ''))))
+        return '<MessageId>%s</MessageId>' % message_id
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+import threading
+import unittest
+
+from hamcrest import assert_that
+from hamcrest import is_
+
+import transaction
+
+from zope.interface.verify import verifyObject
+
+from nti.mailer.background import BackgroundRenderPool
+from nti.mailer.interfaces import IBackgroundRenderPool
+
+
+class TestBackgroundRenderPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = BackgroundRenderPool(workers=2, max_pending=2, wait=0)
+        self.addCleanup(self.pool.close, 5)
+        self.done = []
+
+    def _submit(self, value='done'):
+        return self.pool.submit_after_commit(lambda: self.done.append(value))
+
+    def test_provides(self):
+        verifyObject(IBackgroundRenderPool, self.pool)
+
+    def test_after_commit(self):
+        transaction.begin()
+        self.assertTrue(self._submit())
+        # Nothing happens until the commit.
+        assert_that(self.pool.flush(0), is_(False))
+        assert_that(self.done, is_([]))
+        transaction.commit()
+        assert_that(self.pool.flush(5), is_(True))
+        assert_that(self.done, is_(['done']))
+        assert_that(self.pool.pending, is_(0))
+
+    def test_abort(self):
+        transaction.begin()
+        self._submit()
+        transaction.abort()
+        assert_that(self.pool.flush(5), is_(True))
+        assert_that(self.done, is_([]))
+
+    def test_commit_fails(self):
+        class FailingResource(object):
+            def sortKey(self):
+                return 'failing'
+
+            def abort(self, txn):
+                """Nothing to do."""
+
+            tpc_begin = tpc_abort = abort
+
+            def commit(self, txn):
+                raise ValueError
+
+        transaction.begin()
+        self._submit()
+        transaction.get().join(FailingResource())
+        with self.assertRaises(ValueError):
+            transaction.commit()
+        transaction.abort()
+        # Released once, not twice.
+        assert_that(self.pool.pending, is_(0))
+        assert_that(self.done, is_([]))
+
+    def test_full(self):
+        release = threading.Event()
+        transaction.begin()
+        self.assertTrue(self.pool.submit_after_commit(release.wait))
+        self.assertTrue(self._submit())
+        # Both are pending; the caller must do the next one itself.
+        self.assertFalse(self._submit('third'))
+        transaction.commit()
+        assert_that(self.pool.flush(0.01), is_(False))
+        release.set()
+        assert_that(self.pool.flush(5), is_(True))
+        assert_that(self.done, is_(['done']))
+        # There's room again.
+        transaction.begin()
+        self.assertTrue(self._submit())
+        transaction.abort()
+
+    def test_errors(self):
+        transaction.begin()
+        self.pool.submit_after_commit(lambda: 1 / 0)
+        self._submit()
+        transaction.commit()
+        assert_that(self.pool.flush(5), is_(True))
+        assert_that(self.pool.errors, is_(1))
+        assert_that(self.done, is_(['done']))
+
+    def test_work_is_transactional(self):
+        def work():
+            transaction.get().addAfterCommitHook(self.done.append)
+        transaction.begin()
+        self.pool.submit_after_commit(work)
+        transaction.commit()
+        self.pool.flush(5)
+        assert_that(self.done, is_([True]))
+
+    def test_close(self):
+        transaction.begin()
+        self._submit()
+        transaction.commit()
+        assert_that(self.pool.close(5), is_(True))
+        assert_that(self.done, is_(['done']))
+        transaction.begin()
+        self.assertFalse(self._submit())
+        transaction.abort()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, absolute_import, division
+
+# disable: too many methods
+# pylint: disable=R0904
+import unittest
+from unittest.mock import patch as Patch
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import is_not
+from hamcrest import assert_that
+from hamcrest import contains_string
+from hamcrest import has_length
+from hamcrest import contains_exactly
+
+from repoze.sendmail.interfaces import IMailDelivery
+
+from zope import component
+
+from zope.i18nmessageid import MessageFactory
+
+from nti.mailer._compat import parseaddr
+from nti.mailer.delivery import NotifyingQueuedMailDelivery
+
+from nti.mailer.tests.test_default_template_mailer import MSG_DOMAIN
+from nti.mailer.tests.test_default_template_mailer import PyramidMailerLayer
+from nti.mailer.tests.test_default_template_mailer import Request
+from nti.mailer.tests.test_default_template_mailer import TestEmailAddressablePrincipal
+from nti.mailer.tests.test_default_template_mailer import _Principal
+from nti.mailer.tests.test_default_template_mailer import _Profile
+from nti.mailer.tests.test_default_template_mailer import _User
+
+_ = MessageFactory(MSG_DOMAIN)
+
+
+class TestBatch(unittest.TestCase):
+
+    layer = PyramidMailerLayer
+
+    @Patch('nti.mailer._batch._template_args_from_utilities',
+           autospec=True)
+    def test_create_html_text_emails(self, utility_args):
+        from nti.mailer._batch import create_html_text_emails
+        utility_args.return_value = {'support_email': 'help@nextthought.com'}
+        consumed = []
+
+        def recipients():
+            for name in 'Mickey Mouse', 'Minnie Mouse':
+                consumed.append(name)
+                yield name.split()[0].lower() + '@nextthought.com', {'profile': _Profile(name)}
+            consumed.append('invalid')
+            yield TestEmailAddressablePrincipal(_Principal('invalid'), is_valid=False), None
+
+        messages = create_html_text_emails(
+            'templates/test_new_user_created', # Relative to our package
+            recipients(),
+            subject='Hi there',
+            template_args={'user': _User('the_user'),
+                           'profile': _Profile('Nobody'),
+                           'href': 'url_to_verify_email'},
+            request=Request())
+        # Nothing is rendered until it's asked for.
+        assert_that(consumed, is_([]))
+        first = next(messages)
+        assert_that(consumed, is_(['Mickey Mouse']))
+        assert_that(first.recipients, is_(['mickey@nextthought.com']))
+        assert_that(first.subject, is_('Hi there'))
+        assert_that(first.html, contains_string('>Mickey Mouse<'))
+        assert_that(first.html, contains_string('mailto:help@nextthought.com'))
+        assert_that(first.body, contains_string('Mickey Mouse'))
+
+        rest = list(messages)
+        assert_that(consumed, is_(['Mickey Mouse', 'Minnie Mouse', 'invalid']))
+        assert_that(rest, has_length(1))
+        assert_that(rest[0].html, contains_string('>Minnie Mouse<'))
+        assert_that(rest[0].html, is_not(contains_string('Mickey')))
+        # The shared work was done once.
+        assert_that(utility_args.call_count, is_(1))
+
+    def test_create_html_text_emails_merge(self):
+        from nti.mailer._batch import create_html_text_emails
+        from nti.mailer._default_template_mailer import css_inline_cache
+
+        def create(recipients_and_args, **kwargs):
+            return list(create_html_text_emails(
+                'tests/templates/test_new_user_created',
+                recipients_and_args,
+                subject='Hi there',
+                template_args={'user': _User('the_user'),
+                               'profile': _Profile('Nobody'),
+                               'href': 'url_to_verify_email',
+                               'support_email': 'support_email'},
+                package='nti.mailer',
+                request=Request(),
+                **kwargs))
+
+        recipients_and_args = [
+            ('mickey@nextthought.com', {'profile': _Profile('Mickey <Mouse>'),
+                                        'href': 'https://example.com/?u=mickey&v=1'}),
+            ('minnie@nextthought.com', {'profile': _Profile('Minnie Mouse')}),
+        ]
+        css_inline_cache.clear()
+        self.addCleanup(css_inline_cache.clear)
+        merged = create(recipients_and_args,
+                        merge_fields={'profile.realname': 'text', 'href': 'url'})
+        # Inlining was done once, and not cached.
+        assert_that((css_inline_cache.hits, css_inline_cache.misses), is_((0, 0)))
+        # The messages are just as if they had been rendered.
+        rendered = create(recipients_and_args)
+        assert_that(merged, has_length(2))
+        for merged_message, rendered_message in zip(merged, rendered):
+            assert_that(merged_message.html, is_(rendered_message.html))
+            assert_that(merged_message.body, is_(rendered_message.body))
+        assert_that(merged[0].html, contains_string('>Mickey &lt;Mouse&gt;<'))
+        assert_that(merged[0].html, contains_string('?u=mickey&amp;v=1'))
+        assert_that(merged[1].body, contains_string('url_to_verify_email'))
+
+        # Only merge fields can vary.
+        with self.assertRaises(ValueError):
+            create([('mickey@nextthought.com', {'user': _User('mickey')})],
+                   merge_fields={'profile.realname': 'text'})
+
+    @Patch('nti.mailer._verp._brand_name', autospec=True)
+    def test_queue_deferred(self, brand_name):
+        from nti.mailer._default_template_mailer import queue_simple_html_text_email
+        from nti.mailer._batch import render_job
+        from nti.mailer.delivery import RENDER_JOB_HEADER
+        brand_name.return_value = None
+
+        from nti.mailer._batch import job_recipients
+
+        class MailDelivery(object):
+            message = toaddrs = None
+            def send(self, _fromaddr, toaddrs, message):
+                message['Message-Id'] = '<job@nextthought.com>'
+                self.toaddrs = toaddrs
+                self.message = message
+
+        delivery = MailDelivery()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(delivery, IMailDelivery)
+        self.addCleanup(gsm.unregisterUtility, delivery, IMailDelivery)
+
+        template_args = {'user': {'username': 'the_user'},
+                         'profile': {'realname': 'Mickey Mouse'},
+                         'href': 'url_to_verify_email',
+                         'support_email': 'support_email'}
+        queue_simple_html_text_email('tests/templates/test_new_user_created',
+                                     subject=_('Hi there'),
+                                     recipients=['mickey@nextthought.com'],
+                                     bcc=['hidden@nextthought.com'],
+                                     template_args=template_args,
+                                     reply_to='help@nextthought.com',
+                                     request=Request(),
+                                     package='nti.mailer',
+                                     deferred=True)
+        job = delivery.message
+        assert_that(job[RENDER_JOB_HEADER], is_('1'))
+        # Only something that renders the job can find its recipients.
+        assert_that(delivery.toaddrs, is_(()))
+        assert_that(job['To'], is_(none()))
+        assert_that(job['Bcc'], is_(none()))
+        assert_that(job_recipients(job), is_(('mickey@nextthought.com',
+                                              'hidden@nextthought.com')))
+        assert_that(job.is_multipart(), is_(False))
+        assert_that(job.get_payload(), is_not(contains_string('<html')))
+        # The subject was translated for the request.
+        assert_that(job['Subject'], is_('[[nti.mailer.tests][Hi there]]'))
+
+        message = render_job(job)
+        assert_that(message['Subject'], is_(job['Subject']))
+        assert_that(message['From'], is_(job['From']))
+        assert_that(message['To'], is_('mickey@nextthought.com'))
+        assert_that(message['Reply-To'], is_('help@nextthought.com'))
+        assert_that(message['Message-Id'], is_('<job@nextthought.com>'))
+        assert_that(message['Bcc'], is_(none()))
+        assert_that(message[RENDER_JOB_HEADER], is_(none()))
+        parts = {part.get_content_type(): part.get_payload(decode=True).decode('utf-8')
+                 for part in message.walk() if not part.is_multipart()}
+        html, text = parts['text/html'], parts['text/plain']
+        assert_that(text, contains_string('Hi Mickey Mouse'))
+        assert_that(html, contains_string('>Mickey Mouse<'))
+        assert_that(html, contains_string('href="foo"')) # The request's application_url
+        assert_that(html, contains_string('style="')) # CSS was inlined
+
+        # Only JSON can be deferred.
+        with self.assertRaises(TypeError):
+            queue_simple_html_text_email('tests/templates/test_new_user_created',
+                                         subject='Hi there',
+                                         recipients=['mickey@nextthought.com'],
+                                         template_args={'user': _User('the_user')},
+                                         request=Request(),
+                                         package='nti.mailer',
+                                         deferred=True)
+        with self.assertRaises(ValueError):
+            queue_simple_html_text_email('tests/templates/test_new_user_created',
+                                         subject='Hi there',
+                                         recipients=['mickey@nextthought.com'],
+                                         attachments=[object()],
+                                         request=Request(),
+                                         package='nti.mailer',
+                                         deferred=True)
+
+    def test_process_pool_renderer(self):
+        import multiprocessing
+        from nti.mailer.parallel import ProcessPoolRenderer
+        template_args = {'profile': _Profile('Mickey'),
+                         'href': 'url_to_verify_email',
+                         'support_email': 'support_email'}
+        recipients = [('user%d@nextthought.com' % i, {'user': _User('user%d' % i)})
+                      for i in range(7)]
+        recipients.insert(3, ('', None))
+
+        # Forked workers have the components registered by the layer.
+        with ProcessPoolRenderer(workers=2, chunksize=2,
+                                 mp_context=multiprocessing.get_context('fork'),
+                                 templates=['nti.mailer:tests/templates/test_new_user_created'],
+                                 ) as renderer:
+            def create(ordered):
+                return list(renderer.create_html_text_emails(
+                    'tests/templates/test_new_user_created',
+                    recipients,
+                    subject=_('Hi there'),
+                    request=Request(),
+                    template_args=template_args,
+                    package='nti.mailer',
+                    ordered=ordered))
+
+            messages = create(True)
+            assert_that([m.recipients for m in messages],
+                        is_([['user%d@nextthought.com' % i] for i in range(7)]))
+            message = messages[5]
+            # Translated here, for the request's languages.
+            assert_that(message.subject, is_('[[nti.mailer.tests][Hi there]]'))
+            assert_that(message.body, contains_string('Mickey'))
+            assert_that(message.html, contains_string('user5'))
+            assert_that(message.html, contains_string('href="foo"'))
+
+            messages = create(False)
+            assert_that(sorted(m.recipients[0] for m in messages),
+                        is_(['user%d@nextthought.com' % i for i in range(7)]))
+
+            with self.assertRaises(ValueError):
+                renderer.create_html_text_emails('test_new_user_created', recipients)
+
+    def test_create_html_text_emails_requires_subject(self):
+        from nti.mailer._batch import create_html_text_emails
+        with self.assertRaises(ValueError):
+            create_html_text_emails('tests/templates/test_new_user_created', (),
+                                    package='nti.mailer')
+
+    @Patch('nti.mailer._verp._brand_name', autospec=True)
+    def test_queue_html_text_emails(self, brand_name):
+        from nti.mailer._batch import queue_html_text_emails
+        brand_name.return_value = None
+
+        class MailDelivery(NotifyingQueuedMailDelivery):
+            def __init__(self): # pylint:disable=super-init-not-called
+                self.sent = []
+            def send(self, fromaddr, toaddrs, message):
+                self.sent.append((fromaddr, toaddrs, message))
+
+        delivery = MailDelivery()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(delivery, IMailDelivery, name='bulk')
+        self.addCleanup(gsm.unregisterUtility, delivery, IMailDelivery, name='bulk')
+
+        users = [_Principal('mickey'), _Principal('minnie')]
+        count = queue_html_text_emails(
+            'tests/templates/test_new_user_created',
+            ((user, {'user': user}) for user in users),
+            subject='Hi there',
+            template_args={'profile': _Profile('Mickey Mouse'),
+                           'href': 'url_to_verify_email',
+                           'support_email': 'support_email'},
+            package='nti.mailer',
+            priority='bulk',
+            request=Request())
+        assert_that(count, is_(2))
+        assert_that(delivery.sent, has_length(2))
+        for user, (fromaddr, toaddrs, message) in zip(users, delivery.sent):
+            assert_that(toaddrs, is_({user.email}))
+            assert_that(message['X-NTI-Mailer-Priority'], is_('bulk'))
+            assert_that(parseaddr(fromaddr),
+                        contains_exactly('NextThought', contains_string('no-reply+')))
+        # Each message has its own VERP address.
+        assert_that({sent[0] for sent in delivery.sent}, has_length(2))
@@ -6,15 +6,19 @@ from __future__ import print_function, absolute_import, division
 # disable: accessing protected members, too many methods
 # pylint: disable=W0212,R0904
 import unittest
+from unittest.mock import Mock
 from unittest.mock import patch as Patch
 
 
 from hamcrest import is_
 from hamcrest import none
+from hamcrest import is_not
+from hamcrest import same_instance
 from hamcrest import not_none
 from hamcrest import assert_that
 from hamcrest import has_property
 from hamcrest import contains_string
+from hamcrest import has_length
 
 from pyramid.testing import setUp as psetUp
 from pyramid.testing import tearDown as ptearDown
@@ -148,6 +152,13 @@ class _Profile(object):
         self.realname = realname
 
 
+@interface.implementer(IPrincipal, IEmailAddressable)
+class _Principal(object):
+    def __init__(self, username):
+        self.username = self.id = username
+        self.email = username + '@nextthought.com'
+
+
 _NotGiven = object()
 
 class TestEmail(unittest.TestCase):
@@ -267,6 +278,70 @@ class TestEmail(unittest.TestCase):
                             request=request)
         assert_that(msg, none())
 
+    @Patch('nti.mailer._verp._brand_name', autospec=True)
+    def test_create_email_inlines_css_once(self, brand_name):
+        from .._default_template_mailer import css_inline_cache
+        brand_name.return_value = None
+        css_inline_cache.clear()
+        self.addCleanup(css_inline_cache.clear)
+
+        first = self._create_simple_email(Request())
+        second = self._create_simple_email(Request())
+        assert_that(second.html, is_(first.html))
+        assert_that((css_inline_cache.hits, css_inline_cache.misses), is_((1, 1)))
+
+    def _copy_templates(self):
+        # So that we don't write to those in the package.
+        import os
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        templates = os.path.join(os.path.dirname(__file__), 'templates')
+        for extension in '.pt', '.txt':
+            shutil.copy2(os.path.join(templates, 'test_new_user_created' + extension),
+                         tmpdir)
+        return os.path.join(tmpdir, 'test_new_user_created')
+
+    @Patch('nti.mailer._verp._brand_name', autospec=True)
+    def test_create_email_preinlined(self, brand_name):
+        import os
+        from nti.mailer.preinline import preinline_template
+        from .._default_template_mailer import _clear_renderer_cache
+        from .._default_template_mailer import css_inline_cache
+        brand_name.return_value = None
+        css_inline_cache.clear()
+        self.addCleanup(css_inline_cache.clear)
+        _clear_renderer_cache()
+        self.addCleanup(_clear_renderer_cache)
+
+        base_template = self._copy_templates()
+        template = base_template + '.pt'
+
+        self._create_simple_email(Request(), base_template=base_template)
+        assert_that(css_inline_cache.misses, is_(1))
+
+        variant = preinline_template(template, force=True)
+        # Until the cache is cleared, we don't notice the variant.
+        self._create_simple_email(Request(), base_template=base_template)
+        assert_that(css_inline_cache.hits, is_(1))
+
+        _clear_renderer_cache()
+        msg = self._create_simple_email(Request(), base_template=base_template)
+        assert_that((css_inline_cache.hits, css_inline_cache.misses), is_((1, 1)))
+        assert_that(msg.html, contains_string('font-weight:bold'))
+        assert_that(msg.html, contains_string('>Mickey Mouse<'))
+        assert_that(msg.html, contains_string('href="url_to_verify_email"'))
+        # Unlike inlining at runtime, the doctype is preserved.
+        assert_that(msg.html, contains_string('<!DOCTYPE html'))
+
+        # Once the template is changed, the variant is out of date and ignored.
+        stat = os.stat(variant)
+        os.utime(template, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        _clear_renderer_cache()
+        self._create_simple_email(Request(), base_template=base_template)
+        assert_that(css_inline_cache.hits, is_(2))
+
     @Patch('nti.mailer._verp._brand_name', autospec=True)
     def test_create_email_with_mako(self, brand_name):
         brand_name.return_value = None
@@ -291,9 +366,32 @@ class TestEmail(unittest.TestCase):
                                         text_template_extension=".mak")
         assert_that(msg, is_(not_none()))
 
+    def test_renderer_cache(self):
+        from pyramid.threadlocal import get_current_registry
+        from .._default_template_mailer import _clear_renderer_cache
+        from .._default_template_mailer import _renderer_helper
+        spec = 'nti.mailer:tests/templates/test_new_user_created.txt'
+        helper = _renderer_helper(spec, None)
+        assert_that(_renderer_helper(spec, None), is_(same_instance(helper)))
+        # Templates that don't exist aren't cached.
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                _renderer_helper('nti.mailer:tests/templates/missing.txt', None)
+
+        _clear_renderer_cache()
+        assert_that(_renderer_helper(spec, None), is_not(same_instance(helper)))
+
+        # Reloading templates disables the cache.
+        registry = get_current_registry()
+        self.addCleanup(setattr, registry, 'settings', registry.settings)
+        registry.settings = {'pyramid.reload_templates': 'true'}
+        helper = _renderer_helper(spec, None)
+        assert_that(_renderer_helper(spec, None), is_not(same_instance(helper)))
+
     def _create_simple_email(self,
                              request,
                              *,
+                             base_template='tests/templates/test_new_user_created',
                              user=None,
                              profile=None,
                              text_template_extension=".txt",
@@ -311,7 +409,7 @@ class TestEmail(unittest.TestCase):
             kwargs['reply_to'] = reply_to
 
         msg = create_simple_html_text_email(
-            'tests/templates/test_new_user_created',
+            base_template,
             subject=subject,
             recipients=['jason.madden@nextthought.com'],
             template_args={'user': user,
@@ -379,9 +477,71 @@ class TestEmail(unittest.TestCase):
         msg = self._create_simple_email(Request(), reply_to='foo@bar.com')
         assert_that(msg.extra_headers, is_({'Reply-To': 'foo@bar.com'}))
 
+    @Patch('nti.mailer._verp._brand_name', autospec=True)
+    def test_queue_background(self, brand_name):
+        import transaction
+        from nti.mailer.background import BackgroundRenderPool
+        from nti.mailer.interfaces import IBackgroundRenderPool
+        from .._default_template_mailer import queue_simple_html_text_email
+        brand_name.return_value = None
+
+        class MailDelivery(object):
+            def __init__(self):
+                self.messages = []
+            def send(self, _fromaddr, _toaddrs, message):
+                self.messages.append(message)
+
+        delivery = MailDelivery()
+        pool = BackgroundRenderPool(workers=1)
+        self.addCleanup(pool.close, 5)
+        gsm = component.getGlobalSiteManager()
+        for utility, iface in (delivery, IMailDelivery), (pool, IBackgroundRenderPool):
+            gsm.registerUtility(utility, iface)
+            self.addCleanup(gsm.unregisterUtility, utility, iface)
+
+        def queue():
+            # The template is found relative to this package, as usual.
+            return queue_simple_html_text_email('test_new_user_created',
+                                                subject='Hi there',
+                                                recipients=['mickey@nextthought.com'],
+                                                template_args={'user': _User('the_user'),
+                                                               'profile': _Profile('Mickey'),
+                                                               'href': 'url_to_verify_email',
+                                                               'support_email': 'support'},
+                                                request=Request(),
+                                                background=True)
+
+        transaction.begin()
+        assert_that(queue(), is_(none()))
+        transaction.abort()
+        assert_that(pool.flush(5), is_(True))
+        assert_that(delivery.messages, is_([]))
+
+        transaction.begin()
+        assert_that(queue(), is_(none()))
+        transaction.commit()
+        assert_that(pool.flush(5), is_(True))
+        assert_that(pool.errors, is_(0))
+        assert_that(delivery.messages, has_length(1))
+        message = delivery.messages[0]
+        assert_that(message['To'], is_('mickey@nextthought.com'))
+        assert_that(message.as_string(), contains_string('Mickey'))
+
+        # Without the pool, it's done now.
+        gsm.unregisterUtility(pool, IBackgroundRenderPool)
+        transaction.begin()
+        assert_that(queue(), is_(not_none()))
+        transaction.abort()
+
 
 class TestFunctions(CleanUp, unittest.TestCase):
 
+    def test_provides(self):
+        from zope.interface.verify import verifyObject
+        from nti.mailer import _default_template_mailer
+        from nti.mailer.interfaces import ITemplatedMailer
+        verifyObject(ITemplatedMailer, _default_template_mailer)
+
     def test_get_renderer_spec_and_package_no_colon_no_slash_no_package(self):
         from nti.mailer import tests
         from .._default_template_mailer import _get_renderer_spec_and_package
@@ -400,15 +560,14 @@ class TestFunctions(CleanUp, unittest.TestCase):
         assert_that(template, is_('subdir/no_colon.txt'))
         assert_that(package, is_(tests))
 
-    @Patch('nti.mailer._default_template_mailer.get_renderer')
-    def test__get_renderer(self, fake_get_renderer):
+    @Patch('nti.mailer._default_template_mailer._renderer_helper')
+    def test__get_renderer(self, fake_renderer_helper):
         from nti.mailer import tests
         from .._default_template_mailer import _get_renderer
-        fake_get_renderer.side_effect = lambda *args, **kwargs: (args, kwargs)
+        fake_renderer_helper.side_effect = lambda *args: Mock(renderer=args)
 
-        args, kwargs = _get_renderer('no_colon', '.txt', level=2)
-        assert_that(args, is_(('templates/no_colon.txt',)))
-        assert_that(kwargs, is_({'package': tests}))
+        args = _get_renderer('no_colon', '.txt', level=2)
+        assert_that(args, is_(('templates/no_colon.txt', tests)))
 
     @Patch('nti.mailer._default_template_mailer._get_renderer')
     def test_do_html_text_templates_exist(self, fake__get_renderer):
@@ -486,6 +645,54 @@ class TestFunctions(CleanUp, unittest.TestCase):
             'C': 3
         }))
 
+    def test__template_args_from_utilities_cached(self):
+        from ..interfaces import IMailerTemplateArgsUtility
+        from ..interfaces import IVolatileMailerTemplateArgsUtility
+        from .._default_template_mailer import _template_args_from_utilities
+
+        class Args(object):
+            def __init__(self, name):
+                self.name = name
+                self.calls = 0
+
+            def get_template_args(self, _request):
+                self.calls += 1
+                return {self.name: self.calls}
+
+        stable = Args('stable')
+        volatile = Args('volatile')
+        interface.alsoProvides(volatile, IVolatileMailerTemplateArgsUtility)
+        component.provideUtility(stable, IMailerTemplateArgsUtility)
+        component.provideUtility(volatile, IMailerTemplateArgsUtility, 'volatile')
+
+        request = Request()
+        assert_that(_template_args_from_utilities(request),
+                    is_({'stable': 1, 'volatile': 1}))
+        # The same request gets the same args, except from the volatile utility.
+        assert_that(_template_args_from_utilities(request),
+                    is_({'stable': 1, 'volatile': 2}))
+        # Other requests are asked again.
+        assert_that(_template_args_from_utilities(Request()),
+                    is_({'stable': 2, 'volatile': 3}))
+        # As is anything when there's no request.
+        assert_that(_template_args_from_utilities(None),
+                    is_({'stable': 3, 'volatile': 4}))
+
+        # New utilities are noticed.
+        component.provideUtility(Args('new'), IMailerTemplateArgsUtility, 'new')
+        assert_that(_template_args_from_utilities(request),
+                    is_({'stable': 4, 'volatile': 5, 'new': 1}))
+        assert_that(_template_args_from_utilities(request),
+                    is_({'stable': 4, 'volatile': 6, 'new': 1}))
+
+        # As is a different site manager.
+        from zope.component.globalregistry import BaseGlobalComponents
+        site_manager = BaseGlobalComponents('site', bases=(component.getGlobalSiteManager(),))
+        site_manager.registerUtility(Args('local'), IMailerTemplateArgsUtility, 'local')
+        with Patch.object(component, 'getSiteManager', return_value=site_manager):
+            assert_that(_template_args_from_utilities(request),
+                        is_({'stable': 5, 'volatile': 7, 'new': 2, 'local': 1}))
+
     def test__get_from_address_not_found(self):
         from .._default_template_mailer import _get_from_address
 
@@ -539,6 +746,34 @@ class TestFunctions(CleanUp, unittest.TestCase):
         self.assertIs(delivery.to, MockPyramidMailMessage.send_to)
         self.assertIs(delivery.email_message, MockPyramidMailMessage.email_message)
 
+    def test__send_mail_with_priority(self):
+        from .._default_template_mailer import _send_mail
+
+        class MailDelivery(object):
+            sent = False
+            def send(self, *_args):
+                self.sent = True
+
+        class MockPyramidMailMessage(object):
+            sender = 'from@nextthought.com'
+            send_to = 'to@nextthought.com'
+
+            def to_message(self):
+                return object()
+
+        default = MailDelivery()
+        bulk = MailDelivery()
+        component.provideUtility(default, IMailDelivery)
+        component.provideUtility(bulk, IMailDelivery, name='bulk')
+
+        _send_mail(MockPyramidMailMessage(), priority='bulk')
+        self.assertTrue(bulk.sent)
+        self.assertFalse(default.sent)
+
+        # Unknown priorities use the default
+        _send_mail(MockPyramidMailMessage(), priority='digest')
+        self.assertTrue(default.sent)
+
     def test__send_mail_with_IMailer(self):
         from .._default_template_mailer import _send_mail
 
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+from email.message import Message
+
+import transaction
+
+from hamcrest import assert_that
+from hamcrest import is_
+from hamcrest import has_length
+
+from repoze.sendmail.maildir import Maildir
+
+from nti.mailer.delivery import NotifyingQueuedMailDelivery
+from nti.mailer.delivery import lane_path
+from nti.mailer.delivery import wake_queue_processor
+from nti.mailer.delivery import wakeup_socket_path
+
+
+class TestNotifyingQueuedMailDelivery(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.queue_dir = os.path.join(self.dir, 'queue')
+        self.maildir = Maildir(self.queue_dir, True)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(self.sock.close)
+        self.sock.bind(wakeup_socket_path(self.queue_dir))
+        self.sock.settimeout(5)
+
+    def _send(self, delivery):
+        message = Message()
+        message['Subject'] = 'Pants'
+        message.set_payload('Nice pants, mister!')
+        delivery.send('foo@bar.foo', ['bar@foo.bar'], message)
+
+    def test_notifies_after_commit(self):
+        delivery = NotifyingQueuedMailDelivery(self.queue_dir, urgent=True)
+        transaction.manager.begin()
+        self._send(delivery)
+        transaction.manager.commit()
+        assert_that(tuple(self.maildir), has_length(1))
+        assert_that(self.sock.recv(64), is_(b'urgent'))
+
+        delivery = NotifyingQueuedMailDelivery(self.queue_dir)
+        transaction.manager.begin()
+        self._send(delivery)
+        transaction.manager.commit()
+        assert_that(self.sock.recv(64), is_(b'normal'))
+
+    def test_priority_lane(self):
+        delivery = NotifyingQueuedMailDelivery(self.queue_dir, priority='bulk')
+        assert_that(delivery.queuePath, is_(os.path.join(self.queue_dir, '.bulk')))
+        transaction.manager.begin()
+        self._send(delivery)
+        transaction.manager.commit()
+        assert_that(tuple(self.maildir), has_length(0))
+        assert_that(tuple(Maildir(lane_path(self.queue_dir, 'bulk'))), has_length(1))
+        # The queue's processor is the one told.
+        assert_that(self.sock.recv(64), is_(b'normal'))
+
+    def test_lane_path(self):
+        assert_that(lane_path('/q'), is_('/q'))
+        assert_that(lane_path('/q', 'default'), is_('/q'))
+        assert_that(lane_path('/q', 'bulk'), is_('/q/.bulk'))
+
+    def test_no_notification_on_abort(self):
+        delivery = NotifyingQueuedMailDelivery(self.queue_dir)
+        transaction.manager.begin()
+        self._send(delivery)
+        transaction.manager.abort()
+        assert_that(tuple(self.maildir), has_length(0))
+        self.sock.setblocking(False)
+        with self.assertRaises(BlockingIOError):
+            self.sock.recv(64)
+
+    def test_nobody_listening(self):
+        self.assertTrue(wake_queue_processor(self.queue_dir))
+        self.sock.close()
+        self.assertFalse(wake_queue_processor(self.queue_dir))
+        self.assertFalse(wake_queue_processor(os.path.join(self.dir, 'missing')))
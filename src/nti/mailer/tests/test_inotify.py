@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import gevent
+
+from hamcrest import assert_that
+from hamcrest import is_
+
+from nti.mailer._inotify import InotifyWatcher
+from nti.mailer._inotify import inotify_available
+
+
+@unittest.skipUnless(inotify_available(), "Requires inotify")
+class TestInotifyWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.tmp = os.path.join(self.dir, 'tmp')
+        self.new = os.path.join(self.dir, 'new')
+        os.mkdir(self.tmp)
+        os.mkdir(self.new)
+
+    def _makeOne(self):
+        watcher = InotifyWatcher(self.new)
+        self.addCleanup(watcher.close)
+        return watcher
+
+    def test_missing_directory(self):
+        with self.assertRaises(OSError):
+            InotifyWatcher(os.path.join(self.dir, 'missing'))
+
+    def test_arrivals(self):
+        watcher = self._makeOne()
+        seen = []
+        watcher.start(lambda: seen.extend(watcher.names))
+        self.assertTrue(watcher.active)
+
+        # Things that aren't arrivals are ignored...
+        with open(os.path.join(self.new, '.sending-foo'), 'w', encoding='utf-8') as f:
+            f.write('hi')
+        os.mkdir(os.path.join(self.new, 'subdir'))
+        gevent.sleep(0.05)
+        assert_that(seen, is_([]))
+
+        # ...while renaming in, or writing in place, count.
+        with open(os.path.join(self.tmp, 'msg1'), 'w', encoding='utf-8') as f:
+            f.write('hi')
+        os.rename(os.path.join(self.tmp, 'msg1'), os.path.join(self.new, 'msg1'))
+        with open(os.path.join(self.new, 'msg2'), 'w', encoding='utf-8') as f:
+            f.write('hi')
+
+        while len(seen) < 2:
+            gevent.sleep(0.01)
+        assert_that(seen, is_(['msg1', 'msg2']))
+        assert_that(watcher.names, is_(()))
+
+        watcher.stop()
+        self.assertFalse(watcher.active)
+        watcher.close()
+        self.assertFalse(watcher.active)
+        # Idempotent
+        watcher.stop()
+        watcher.close()
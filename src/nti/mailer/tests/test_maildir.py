@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from email.message import Message
+
+from hamcrest import assert_that
+from hamcrest import is_
+from hamcrest import has_length
+from hamcrest import contains_exactly
+from hamcrest import starts_with
+from hamcrest import greater_than
+
+from repoze.sendmail.maildir import Maildir
+
+from nti.mailer._maildir import ClaimingMaildir
+from nti.mailer._maildir import PriorityMaildir
+from nti.mailer._maildir import default_worker_id
+from nti.mailer._maildir import retry_filename
+from nti.mailer._maildir import retry_state
+
+
+class TestRetryState(unittest.TestCase):
+
+    def test_round_trip(self):
+        assert_that(retry_state('/q/new/123.456.host'), is_((0, 0)))
+        name = retry_filename('/q/new/123.456.host', 1, 1000)
+        assert_that(name, is_('/q/new/123.456.host:retry=1,1000'))
+        assert_that(retry_state(name), is_((1, 1000)))
+        # Replacing the state
+        name = retry_filename(name, 2, 2000)
+        assert_that(name, is_('/q/new/123.456.host:retry=2,2000'))
+        assert_that(retry_state(name), is_((2, 2000)))
+
+    def test_garbage(self):
+        assert_that(retry_state('/q/new/123:retry=x,y'), is_((0, 0)))
+
+
+class TestClaimingMaildir(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.dir = os.path.join(tmp, 'queue')
+        self.maildir = Maildir(self.dir, create=True)
+
+    def _add(self, mtime=None):
+        message = Message()
+        message.set_payload('hi')
+        tx = self.maildir.add(message)
+        tx.commit()
+        if mtime is not None:
+            os.utime(tx._committed_path, (mtime, mtime))
+        return os.path.basename(tx._committed_path)
+
+    def _makeOne(self, worker_id):
+        return ClaimingMaildir(self.dir, worker_id)
+
+    def _dead_worker_id(self):
+        # A pid that can't exist.
+        return '%s.%d' % (ClaimingMaildir._hostname(), 2 ** 30)
+
+    def test_default_worker_id(self):
+        assert_that(default_worker_id(), is_(ClaimingMaildir(self.dir).worker_id))
+        self.assertTrue(default_worker_id().endswith('.%d' % os.getpid()))
+
+    def test_claims_oldest_first(self):
+        second = self._add(mtime=2000)
+        first = self._add(mtime=1000)
+        worker = self._makeOne('w1')
+        claimed = list(worker)
+        assert_that([os.path.basename(p) for p in claimed], contains_exactly(first, second))
+        for path in claimed:
+            assert_that(os.path.dirname(path), is_(worker.lease_path))
+        # Nothing left for anyone else.
+        assert_that(list(self._makeOne('w2')), is_([]))
+        assert_that(list(self.maildir), is_([]))
+        # But unsent messages are ours to retry.
+        assert_that(sorted(worker), is_(sorted(claimed)))
+
+    def test_claims_only_accepted(self):
+        from nti.mailer._maildir import claimable_messages
+        first = self._add(mtime=1000)
+        second = self._add(mtime=2000)
+        worker = self._makeOne('w1')
+        claimed = list(claimable_messages(worker, lambda path: path.endswith(second)))
+        assert_that([os.path.basename(p) for p in claimed], is_([second]))
+        # The other is left for anyone.
+        assert_that([os.path.basename(p) for p in self.maildir], is_([first]))
+        # Including ones we've already claimed.
+        assert_that(list(claimable_messages(worker, lambda path: False)), is_([]))
+        assert_that(list(claimable_messages(worker)), has_length(2))
+
+    def test_workers_split_the_queue(self):
+        for _ in range(4):
+            self._add()
+        w1 = iter(self._makeOne('w1'))
+        w2 = iter(self._makeOne('w2'))
+        # Interleave them, as concurrent processes would.
+        claimed = [next(w1), next(w2), next(w1), next(w2)]
+        assert_that(set(claimed), has_length(4))
+        assert_that(list(w1) + list(w2), is_([]))
+
+    def test_claim_lost_race(self):
+        self._add()
+        worker = self._makeOne('w1')
+        assert_that(worker._claim(os.path.join(self.dir, 'new', 'gone')), is_(None))
+
+    def test_recover_dead_worker(self):
+        dead = self._makeOne(self._dead_worker_id())
+        name = self._add()
+        claimed, = list(dead)
+        rejected = os.path.join(dead.lease_path, '.rejected-old')
+        with open(rejected, 'wb'):
+            pass
+
+        worker = self._makeOne('w1')
+        assert_that(worker.recover_stale_leases(), is_(1))
+        self.assertFalse(os.path.exists(claimed))
+        self.assertFalse(os.path.exists(dead.lease_path))
+        # The record of the rejected message is kept.
+        self.assertTrue(os.path.exists(os.path.join(self.dir, 'cur', '.rejected-old')))
+        assert_that([os.path.basename(p) for p in worker], is_([name]))
+
+    def test_live_worker_not_recovered(self):
+        live = self._makeOne(default_worker_id())
+        self._add()
+        list(live)
+        assert_that(self._makeOne('w1').recover_stale_leases(), is_(0))
+        assert_that(list(live), has_length(1))
+
+    def test_remote_worker_recovered_after_timeout(self):
+        remote = self._makeOne('elsewhere.example.com.1234')
+        self._add()
+        list(remote)
+        worker = self._makeOne('w1')
+        assert_that(worker.recover_stale_leases(), is_(0))
+
+        old = time.time() - worker.lease_timeout - 1
+        os.utime(os.path.join(remote.lease_path, '.heartbeat'), (old, old))
+        assert_that(worker.recover_stale_leases(), is_(1))
+
+    def test_heartbeat_while_iterating(self):
+        worker = self._makeOne('w1')
+        worker.heartbeat_interval = 0
+        self._add()
+        self._add()
+        heartbeat = os.path.join(worker.lease_path, '.heartbeat')
+        claimed = iter(worker)
+        next(claimed)
+        old = int(time.time()) - worker.lease_timeout - 1
+        os.utime(heartbeat, (old, old))
+        # Still draining, we're still alive.
+        next(claimed)
+        assert_that(os.path.getmtime(heartbeat), is_(greater_than(old)))
+
+        # But not more often than asked.
+        worker.heartbeat_interval = 3600
+        self._add()
+        self._add()
+        claimed = iter(worker)
+        next(claimed)
+        os.utime(heartbeat, (old, old))
+        next(claimed)
+        assert_that(os.path.getmtime(heartbeat), is_(old))
+
+    def test_message_being_sent_not_recovered(self):
+        dead = self._makeOne(self._dead_worker_id())
+        self._add()
+        self._add()
+        sending, other = list(dead)
+        os.link(sending, os.path.join(dead.lease_path, '.sending-' + os.path.basename(sending)))
+
+        worker = self._makeOne('w1')
+        assert_that(worker.recover_stale_leases(), is_(1))
+        self.assertTrue(os.path.exists(sending))
+        self.assertFalse(os.path.exists(other))
+
+        # Once it's been sent, the lease is cleaned up.
+        os.unlink(sending)
+        assert_that(worker.recover_stale_leases(), is_(0))
+        self.assertFalse(os.path.exists(dead.lease_path))
+
+
+class TestPriorityMaildir(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.lanes = [Maildir(os.path.join(tmp, name), create=True)
+                      for name in ('high', 'low')]
+
+    def _add(self, lane, text):
+        message = Message()
+        message.set_payload(text)
+        tx = self.lanes[lane].add(message)
+        tx.commit()
+        return tx._committed_path
+
+    def _payloads(self, filenames):
+        result = []
+        for filename in filenames:
+            with open(filename, encoding='utf-8') as f:
+                result.append(f.read().strip())
+            # As the queue processor would.
+            os.unlink(filename)
+        return result
+
+    def test_strict(self):
+        for i in range(3):
+            self._add(1, 'low%d' % i)
+        self._add(0, 'high0')
+        maildir = PriorityMaildir(self.lanes)
+        assert_that(maildir.path, is_(self.lanes[0].path))
+        filenames = iter(maildir)
+        assert_that(self._payloads([next(filenames)]), is_(['high0']))
+        assert_that(self._payloads([next(filenames)]), contains_exactly(starts_with('low')))
+        # Mail arriving in a higher lane goes next.
+        self._add(0, 'high1')
+        assert_that(self._payloads([next(filenames)]), is_(['high1']))
+        assert_that(list(filenames), has_length(2))
+
+    def test_weighted(self):
+        for _ in range(4):
+            self._add(0, 'high')
+            self._add(1, 'low')
+        maildir = PriorityMaildir(self.lanes, weights=(2, 1))
+        assert_that(self._payloads(maildir),
+                    is_(['high', 'high', 'low', 'high', 'high', 'low', 'low', 'low']))
+
+    def test_each_message_once(self):
+        self._add(0, 'high')
+        # Not removed, as if it failed to send.
+        assert_that(list(PriorityMaildir(self.lanes)), has_length(1))
+        assert_that(list(PriorityMaildir(self.lanes, (1, 1))), has_length(1))
+
+    def test_bad_weights(self):
+        with self.assertRaises(ValueError):
+            PriorityMaildir(self.lanes, (1,))
+        with self.assertRaises(ValueError):
+            PriorityMaildir(self.lanes, (1, 0))
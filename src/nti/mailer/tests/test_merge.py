@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+import unittest
+
+from hamcrest import assert_that
+from hamcrest import is_
+from hamcrest import has_length
+from hamcrest import starts_with
+
+from nti.mailer._merge import MergeTemplate
+
+
+class _Profile(object):
+    def __init__(self, realname):
+        self.realname = realname
+
+
+class TestMergeTemplate(unittest.TestCase):
+
+    def _compile(self, fields):
+        template = MergeTemplate(fields)
+        args = template.placeholders()
+        html = '<p title="%s">Hi %s</p><a href="%s">x</a>' % (
+            args['profile'].realname, args['profile']['realname'], args['href'])
+        text = 'Hi %s, see %s' % (args['profile'].realname, args['href'])
+        template.compile(html, text)
+        return template
+
+    def test_placeholders(self):
+        template = MergeTemplate({'profile.realname': 'text', 'profile.links.home': 'url',
+                                  'href': 'url'})
+        args = template.placeholders()
+        assert_that(args['href'], starts_with('nti-merge-'))
+        assert_that(args['profile'].realname, starts_with('nti-merge-'))
+        assert_that(args['profile'].links.home, starts_with('nti-merge-'))
+        assert_that({args['href'], args['profile'].realname, args['profile'].links.home},
+                    has_length(3))
+        # Nothing but the fields is there.
+        with self.assertRaises(AttributeError):
+            getattr(args['profile'], 'email')
+        with self.assertRaises(AttributeError):
+            getattr(args['profile'], '__html__')
+
+        for fields in {'profile': 'text', 'profile.realname': 'text'}, \
+                      {'profile.realname': 'text', 'profile': 'text'}:
+            with self.assertRaises(ValueError):
+                MergeTemplate(fields).placeholders()
+        with self.assertRaises(ValueError):
+            MergeTemplate({'profile': 'html'})
+
+    def test_fill(self):
+        template = self._compile({'profile.realname': 'text', 'href': 'url'})
+        html, text = template.fill({'profile': _Profile('Tom & "Jerry" <3'),
+                                    'href': 'https://example.com/?a=1&b=2'})
+        assert_that(html, is_(
+            '<p title="Tom &amp; &quot;Jerry&quot; &lt;3">Hi Tom &amp; &quot;Jerry&quot; &lt;3</p>'
+            '<a href="https://example.com/?a=1&amp;b=2">x</a>'))
+        assert_that(text, is_('Hi Tom & "Jerry" <3, see https://example.com/?a=1&b=2'))
+
+        # Values can also be found by item.
+        html, text = template.fill({'profile': {'realname': 'Tom'}, 'href': '/home'})
+        assert_that(text, is_('Hi Tom, see /home'))
+
+    def test_fill_checks(self):
+        template = self._compile({'profile.realname': 'text', 'href': 'url'})
+        with self.assertRaises(ValueError):
+            template.fill({'profile': _Profile('Tom'), 'href': 'javascript:alert(1)'})
+        with self.assertRaises(KeyError):
+            template.fill({'profile': _Profile('Tom')})
+        with self.assertRaises(ValueError):
+            MergeTemplate({'href': 'url'}).fill({'href': '/'})
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+from unittest.mock import Mock
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from hamcrest import assert_that
+from hamcrest import is_
+from hamcrest import contains_string
+from hamcrest import none
+from hamcrest import is_not
+
+from nti.mailer._metrics import CONTENT_TYPE
+from nti.mailer._metrics import MetricsRegistry
+from nti.mailer._metrics import MetricsServer
+from nti.mailer._metrics import QueueMetrics
+from nti.mailer._metrics import serve_metrics
+
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def test_counter(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('sent_total', 'Sent.', ('error',))
+        counter.inc(error='Throttling')
+        counter.inc(2, error='Say "hi"\n')
+        assert_that(counter.value(error='Throttling'), is_(1))
+        with self.assertRaises(ValueError):
+            counter.inc(reason='Throttling')
+        assert_that(registry.exposition(), is_(
+            '# HELP sent_total Sent.\n'
+            '# TYPE sent_total counter\n'
+            'sent_total{error="Say \\"hi\\"\\n"} 2.0\n'
+            'sent_total{error="Throttling"} 1.0\n'
+        ))
+
+    def test_gauge(self):
+        registry = MetricsRegistry()
+        registry.gauge('depth', 'Depth.').set(3)
+        registry.gauge('computed', 'Computed.', ('lane',),
+                       lambda: [({'lane': 'bulk'}, 7)])
+        registry.gauge('broken', 'Broken.', function=lambda: 1 / 0)
+        registry.gauge('unknown', 'Unknown.', function=lambda: None)
+        assert_that(registry.exposition(), is_(
+            '# HELP depth Depth.\n'
+            '# TYPE depth gauge\n'
+            'depth 3.0\n'
+            '# HELP computed Computed.\n'
+            '# TYPE computed gauge\n'
+            'computed{lane="bulk"} 7.0\n'
+            '# HELP broken Broken.\n'
+            '# TYPE broken gauge\n'
+            '# HELP unknown Unknown.\n'
+            '# TYPE unknown gauge\n'
+        ))
+
+    def test_histogram(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram('latency_seconds', 'Latency.', buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        with histogram.time():
+            pass
+        assert_that(histogram.count(), is_(4))
+        assert_that(registry.exposition(), contains_string(
+            'latency_seconds_bucket{le="0.1"} 2.0\n'
+            'latency_seconds_bucket{le="1.0"} 3.0\n'
+            'latency_seconds_bucket{le="+Inf"} 4.0\n'
+            'latency_seconds_sum 5.55'
+        ))
+        assert_that(registry.exposition(), contains_string('latency_seconds_count 4.0\n'))
+
+    def test_summary(self):
+        registry = MetricsRegistry()
+        summary = registry.summary('latency_seconds', 'Latency.', ('lane',),
+                                   quantiles=(0.5, 1), max_samples=4)
+        assert_that(summary.quantile(0.5, lane='bulk'), is_(none()))
+        for value in 100, 1, 2, 3, 4:
+            summary.observe(value, lane='bulk')
+        # The oldest fell out of the window.
+        assert_that(summary.quantile(0.5, lane='bulk'), is_(2))
+        assert_that(summary.quantile(1, lane='bulk'), is_(4))
+        assert_that(registry.exposition(), is_(
+            '# HELP latency_seconds Latency.\n'
+            '# TYPE latency_seconds summary\n'
+            'latency_seconds{lane="bulk",quantile="0.5"} 2.0\n'
+            'latency_seconds{lane="bulk",quantile="1.0"} 4.0\n'
+            'latency_seconds_sum{lane="bulk"} 110.0\n'
+            'latency_seconds_count{lane="bulk"} 5.0\n'
+        ))
+
+
+class TestMetricsServer(unittest.TestCase):
+
+    def test_serve(self):
+        registry = MetricsRegistry()
+        registry.counter('sent_total', 'Sent.').inc()
+        with MetricsServer(registry) as server:
+            with urlopen(server.url) as response:
+                assert_that(response.headers['Content-Type'], is_(CONTENT_TYPE))
+                assert_that(response.read().decode('utf-8'),
+                            is_(registry.exposition()))
+            with self.assertRaises(HTTPError) as exc:
+                with urlopen(server.url.replace('/metrics', '/other')):
+                    pass # pragma: no cover
+            exc.exception.close()
+            assert_that(exc.exception.code, is_(404))
+        server.stop()
+
+
+class TestQueueMetrics(unittest.TestCase):
+
+    def test_serve_metrics(self):
+        metrics = QueueMetrics()
+        first = metrics.serve('127.0.0.1', 0)
+        self.addCleanup(first.stop)
+        # The next port may be taken too, by someone else; serve
+        # on any free one in its place.
+        serve = metrics.serve
+        tried = []
+        def serve_next_anywhere(host, port):
+            tried.append(port)
+            return serve(host, port if port == first.port else 0)
+        metrics.serve = serve_next_anywhere
+        # Taken, so the next worker moves along...
+        second = serve_metrics(metrics, first.host, first.port, 2)
+        self.addCleanup(second.stop)
+        assert_that(tried, is_([first.port, first.port + 1]))
+        assert_that(second.port, is_not(first.port))
+        # ...unless there's nowhere to go.
+        assert_that(serve_metrics(metrics, first.host, first.port), is_(none()))
+
+    def test_scan_once(self):
+        tmp = mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        for subdir in 'new', 'cur':
+            os.mkdir(os.path.join(tmp, subdir))
+        metrics = QueueMetrics()
+        metrics.track(Mock(lanes=('default',), lane_paths=(tmp,), debouncer_count=0))
+        metrics._scan = Mock(side_effect=metrics._scan)
+        for _ in range(2):
+            exposition = metrics.registry.exposition()
+            assert_that(exposition, contains_string(
+                'nti_mailer_queue_oldest_message_age_seconds{lane="default"} 0.0\n'))
+        # Once for both gauges, each time.
+        assert_that(metrics._scan.call_count, is_(2))
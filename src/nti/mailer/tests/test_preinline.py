@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from hamcrest import assert_that
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import contains_string
+from hamcrest import is_not
+from hamcrest import starts_with
+
+from nti.mailer.preinline import inlined_name
+from nti.mailer.preinline import is_inlined_name
+from nti.mailer.preinline import main
+from nti.mailer.preinline import preinline_source
+from nti.mailer.preinline import preinline_template
+from nti.mailer.preinline import preinline_templates
+
+TEMPLATE = os.path.join(os.path.dirname(__file__), 'templates', 'test_new_user_created.pt')
+
+
+class TestPreinline(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def _copy_template(self, name='template.pt', subdir=''):
+        directory = os.path.join(self.tmpdir, subdir)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, name)
+        shutil.copyfile(TEMPLATE, path)
+        return path
+
+    def test_names(self):
+        assert_that(inlined_name('pkg:templates/foo.pt'), is_('pkg:templates/foo.inlined.pt'))
+        assert_that(is_inlined_name('/a/foo.inlined.pt'), is_(True))
+        assert_that(is_inlined_name('/a/foo.pt'), is_(False))
+        assert_that(is_inlined_name('/a.inlined/foo.pt'), is_(False))
+
+    def test_preinline_source(self):
+        with open(TEMPLATE, encoding='utf-8') as f:
+            result = preinline_source(f.read())
+        assert_that(result, starts_with('<!DOCTYPE html'))
+        assert_that(result, is_not(contains_string('<style>')))
+        assert_that(result, contains_string('font-weight:bold'))
+        # Template markup survives.
+        assert_that(result, contains_string('tal:content="options/profile/realname"'))
+        assert_that(result, contains_string('tal:attributes="href options/href"'))
+        assert_that(result, contains_string('i18n:translate=""'))
+
+    def test_preinline_template(self):
+        path = self._copy_template()
+        target = preinline_template(path)
+        assert_that(target, is_(os.path.join(self.tmpdir, 'template.inlined.pt')))
+        with open(target, encoding='utf-8') as f:
+            assert_that(f.read(), contains_string('font-weight:bold'))
+
+        # It's up to date, unless forced or the template changes.
+        assert_that(preinline_template(path), is_(none()))
+        assert_that(preinline_template(path, force=True), is_(target))
+        stat = os.stat(target)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        assert_that(preinline_template(path), is_(target))
+
+    def test_preinline_templates(self):
+        first = self._copy_template('a.pt')
+        second = self._copy_template('b.pt', 'sub')
+        with open(os.path.join(self.tmpdir, 'a.txt'), 'w', encoding='utf-8') as f:
+            f.write('Not HTML')
+
+        written = preinline_templates([self.tmpdir])
+        assert_that(written, is_([inlined_name(first), inlined_name(second)]))
+        # The variants themselves aren't pre-inlined.
+        assert_that(preinline_templates([self.tmpdir]), is_([]))
+        assert_that(preinline_templates([first], force=True), is_([inlined_name(first)]))
+
+    def test_main(self):
+        import io
+        path = self._copy_template()
+        stdout = io.StringIO()
+        assert_that(main([self.tmpdir], stdout=stdout), is_(0))
+        assert_that(os.path.exists(inlined_name(path)), is_(True))
+        assert_that(stdout.getvalue(), is_('Wrote 1 pre-inlined templates\n'))
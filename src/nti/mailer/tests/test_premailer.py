@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+import sys
+import unittest
+
+from hamcrest import assert_that
+from hamcrest import is_
+from hamcrest import contains_string
+from hamcrest import has_length
+
+from nti.mailer._premailer import TransformCache
+
+
+class TestTransformCache(unittest.TestCase):
+
+    def _makeOne(self, **kwargs):
+        calls = []
+        def transform(html):
+            calls.append(html)
+            return html.upper()
+        cache = TransformCache(transform, **kwargs)
+        return cache, calls
+
+    def test_hits_and_misses(self):
+        cache, calls = self._makeOne()
+        assert_that(cache('<p>a</p>'), is_('<P>A</P>'))
+        assert_that(cache('<p>a</p>'), is_('<P>A</P>'))
+        assert_that(cache('<p>b</p>'), is_('<P>B</P>'))
+        assert_that(calls, is_(['<p>a</p>', '<p>b</p>']))
+        assert_that((cache.hits, cache.misses), is_((1, 2)))
+        assert_that(len(cache), is_(2))
+
+        cache.clear()
+        assert_that((cache.hits, cache.misses, cache.nbytes, len(cache)), is_((0, 0, 0, 0)))
+
+    def test_max_entries(self):
+        cache, calls = self._makeOne(max_entries=2)
+        cache('a')
+        cache('b')
+        cache('a') # Now b is the least recently used...
+        cache('c') # ...so it goes.
+        cache('a')
+        cache('b')
+        assert_that(calls, is_(['a', 'b', 'c', 'b']))
+        assert_that(len(cache), is_(2))
+
+        cache, calls = self._makeOne(max_entries=0)
+        cache('a')
+        cache('a')
+        assert_that(calls, is_(['a', 'a']))
+
+    def test_max_bytes(self):
+        size = sys.getsizeof('A' * 100)
+        cache, calls = self._makeOne(max_bytes=size * 2)
+        for html in 'a' * 100, 'b' * 100, 'c' * 100:
+            cache(html)
+        assert_that(len(cache), is_(2))
+        assert_that(cache.nbytes, is_(size * 2))
+        cache('a' * 100)
+        assert_that(calls, has_length(4))
+
+        # Too big to keep at all.
+        cache('d' * 1000)
+        cache('d' * 1000)
+        assert_that(calls, has_length(6))
+        assert_that(cache.nbytes, is_(size * 2))
+
+    def test_premailer(self):
+        cache = TransformCache()
+        html = '<html><head><style>p { color: red }</style></head><body><p>Hi</p></body></html>'
+        assert_that(cache(html), contains_string('<p style="color:red">Hi</p>'))
+        assert_that(cache(html), contains_string('<p style="color:red">Hi</p>'))
+        assert_that(cache.hits, is_(1))
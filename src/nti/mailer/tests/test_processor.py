@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+import os
+import time
+
+from tempfile import mkdtemp
+
+import unittest
+from unittest.mock import Mock
+
+import email
+
+from hamcrest import assert_that
+from hamcrest import is_
+from hamcrest import has_length
+from hamcrest import none
+from hamcrest import contains_string
+from hamcrest import has_item
+from hamcrest import is_not
+
+from zope import interface
+
+from repoze.sendmail.delivery import QueuedMailDelivery
+from repoze.sendmail.queue import QueueProcessor
+
+# pylint:disable-next=import-private-name
+from repoze.sendmail.tests.test_delivery import _makeMailerStub
+
+from nti.mailer._ses import SESMailer
+
+from nti.mailer.tests.test_queue import MSG_STRING
+
+
+class TestMailQueueProcessor(unittest.TestCase):
+
+    def setUp(self):
+        import shutil
+        tmp = mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.queue_dir = os.path.join(tmp, 'queue')
+        self.message = email.message_from_string(MSG_STRING)
+        self.message['Bcc'] = 'hidden1@example.com,\n hidden2@example.com'
+        self.message['Subject'] = 'A long subject line that will need folding ' * 3
+
+        import transaction
+        transaction.manager.begin()
+        QueuedMailDelivery(self.queue_dir).send('from@example.com',
+                                                ['to@example.com', 'hidden1@example.com'],
+                                                self.message)
+        transaction.manager.commit()
+
+    def _process(self, mailer, now=None, **kwargs):
+        from nti.mailer._processor import MailQueueProcessor
+        processor = MailQueueProcessor(mailer, self.queue_dir, **kwargs)
+        if now is not None:
+            processor._time = lambda: now
+        processor.send_messages()
+        return processor
+
+    def _queued(self, subdir=None):
+        names = []
+        for sub in (subdir,) if subdir else ('new', 'cur'):
+            names.extend(os.path.join(sub, name)
+                         for name in os.listdir(os.path.join(self.queue_dir, sub))
+                         if not name.startswith('.'))
+        return names
+
+    def _failing_mailer(self, code='InternalFailure', status=500):
+        from botocore.exceptions import ClientError
+        mailer = Mock()
+        mailer.send.side_effect = ClientError(
+            {'Error': {'Code': code, 'Message': 'Failed'},
+             'ResponseMetadata': {'HTTPStatusCode': status}},
+            'SendRawEmail')
+        return mailer
+
+    def test_retry_with_backoff(self):
+        from nti.mailer._maildir import retry_state
+        mailer = self._failing_mailer()
+        processor = self._process(mailer, now=1000, retry_delay=10, max_attempts=3)
+        assert_that(mailer.send.call_count, is_(1))
+        # Moved out of new/, with the time it can be tried again.
+        assert_that(self._queued('new'), is_([]))
+        queued = self._queued('cur')
+        assert_that(queued, has_length(1))
+        assert_that(retry_state(queued[0]), is_((1, 1010)))
+        assert_that(processor.next_retry, is_(1010))
+
+        # Not tried again before then.
+        processor = self._process(mailer, now=1009, retry_delay=10, max_attempts=3)
+        assert_that(mailer.send.call_count, is_(1))
+        assert_that(processor.next_retry, is_(1010))
+
+        # But is afterwards, waiting twice as long the next time.
+        processor = self._process(mailer, now=1010, retry_delay=10, max_attempts=3)
+        assert_that(mailer.send.call_count, is_(2))
+        queued = self._queued()
+        assert_that(queued, has_length(1))
+        assert_that(retry_state(queued[0]), is_((2, 1030)))
+
+        # Until it runs out of attempts.
+        processor = self._process(mailer, now=1030, retry_delay=10, max_attempts=3)
+        assert_that(mailer.send.call_count, is_(3))
+        assert_that(self._queued(), is_([]))
+        assert_that(processor.next_retry, is_(none()))
+        failed, = os.listdir(os.path.join(self.queue_dir, 'failed', 'new'))
+        assert_that(retry_state(failed), is_((2, 1030)))
+
+    def test_permanent_error(self):
+        mailer = self._failing_mailer('MessageRejected', 400)
+        self._process(mailer)
+        assert_that(self._queued(), is_([]))
+        assert_that(os.listdir(os.path.join(self.queue_dir, 'failed', 'new')), has_length(1))
+
+    def test_unparseable(self):
+        from nti.mailer._processor import MailQueueProcessor
+        mailer = Mock()
+        processor = MailQueueProcessor(mailer, self.queue_dir)
+        processor._parse_message = Mock(side_effect=ValueError)
+        processor.send_messages()
+        mailer.send.assert_not_called()
+        assert_that(os.listdir(os.path.join(self.queue_dir, 'failed', 'new')), has_length(1))
+
+    def test_throttling_not_counted(self):
+        mailer = self._failing_mailer('Throttling', 400)
+        processor = self._process(mailer, now=1000, retry_delay=10)
+        assert_that(self._queued('new'), has_length(1))
+        # Tried again soon, but not counted as an attempt.
+        assert_that(processor.next_retry, is_(1010))
+        assert_that(self._dot_files(), is_([]))
+
+        # And it's sent the next time, not left for another worker.
+        mailer.send.side_effect = None
+        self._process(mailer)
+        assert_that(mailer.send.call_count, is_(2))
+        assert_that(self._queued(), is_([]))
+
+    def _dot_files(self):
+        return [name
+                for _, _, names in os.walk(self.queue_dir)
+                for name in names
+                if name.startswith('.')]
+
+    def test_failures_leave_no_marks(self):
+        mailer = self._failing_mailer()
+        self._process(mailer, now=1000, max_attempts=2)
+        assert_that(self._queued('cur'), has_length(1))
+        assert_that(self._dot_files(), is_([]))
+
+        self._process(mailer, now=5000, max_attempts=2)
+        assert_that(self._queued(), is_([]))
+        assert_that(os.listdir(os.path.join(self.queue_dir, 'failed', 'new')), has_length(1))
+        assert_that(self._dot_files(), is_([]))
+
+    def test_mailer_not_ready(self):
+        from botocore.exceptions import EndpointConnectionError
+        mailer = Mock()
+        mailer.prepare.side_effect = EndpointConnectionError(endpoint_url='https://ses')
+        processor = self._process(mailer)
+        # Nothing was tried, so nothing counts as a failure.
+        mailer.send.assert_not_called()
+        assert_that(processor.paused, is_(True))
+        assert_that(processor.not_ready, is_(True))
+        assert_that(self._queued('new'), has_length(1))
+
+        mailer.prepare.side_effect = None
+        self._process(mailer)
+        assert_that(self._queued(), is_([]))
+
+    def test_metrics(self):
+        from nti.mailer._metrics import QueueMetrics
+        metrics = QueueMetrics()
+        self._process(self._failing_mailer(), metrics=metrics)
+        assert_that(metrics.messages_failed.value(error='InternalFailure'), is_(1))
+        assert_that(metrics.messages_sent.value(), is_(0))
+
+        self._process(Mock(), now=time.time() + 3600, metrics=metrics)
+        assert_that(metrics.messages_sent.value(), is_(1))
+        assert_that(metrics.messages_failed.value(error='InternalFailure'), is_(1))
+
+    def _queue_tracked_message(self):
+        import transaction
+        from nti.mailer.delivery import PRIORITY_HEADER
+        from nti.mailer.delivery import QUEUED_AT_HEADER
+        from nti.mailer.delivery import TEMPLATE_HEADER
+        message = email.message_from_string(MSG_STRING)
+        message[QUEUED_AT_HEADER] = '1000.5'
+        message[TEMPLATE_HEADER] = 'welcome'
+        message[PRIORITY_HEADER] = 'bulk'
+        transaction.manager.begin()
+        QueuedMailDelivery(self.queue_dir).send('from@example.com', ['to@example.com'], message)
+        transaction.manager.commit()
+
+    def test_delivery_latency(self):
+        from nti.mailer.interfaces import IRawMessageMailer
+        from nti.mailer._metrics import QueueMetrics
+        self._queue_tracked_message()
+        metrics = QueueMetrics()
+        parsed = _makeMailerStub()
+        self._process(parsed, now=1010.5, metrics=metrics)
+        # One without the headers, one with.
+        assert_that(metrics.messages_sent.value(), is_(2))
+        assert_that(metrics.delivery_latency.quantile(0.5, template='welcome', priority='bulk'),
+                    is_(10.0))
+        assert_that(metrics.delivery_latency_by_priority.count(priority='bulk'), is_(1))
+        for _, _, message in parsed.sent_messages:
+            assert_that(message.keys(), is_not(has_item(contains_string('X-NTI-Mailer'))))
+
+        self.setUp()
+        self._queue_tracked_message()
+        raw = _makeMailerStub()
+        interface.alsoProvides(raw, IRawMessageMailer)
+        self._process(raw, now=1010.5, metrics=metrics)
+        assert_that(metrics.delivery_latency_by_priority.count(priority='bulk'), is_(2))
+        for _, _, message in raw.sent_messages:
+            self.assertNotIn(b'X-NTI-Mailer', message)
+
+    def _queue_render_job(self):
+        import shutil
+        import transaction
+        from nti.mailer.delivery import RENDER_JOB_HEADER
+        from nti.mailer.delivery import TEMPLATE_HEADER
+        # Only the job.
+        shutil.rmtree(self.queue_dir)
+        job = email.message.Message()
+        job['Subject'] = 'Job'
+        job[RENDER_JOB_HEADER] = '1'
+        job[TEMPLATE_HEADER] = 'welcome'
+        job.set_payload(self._job_text)
+        transaction.manager.begin()
+        # Without recipients, like all jobs.
+        QueuedMailDelivery(self.queue_dir).send('from@example.com', [], job)
+        transaction.manager.commit()
+
+    _job_text = ('{"version": 1, "recipients": ["to@example.com"],'
+                 ' "cc": [], "bcc": ["hidden@example.com"]}')
+
+    def _render_job(self, job):
+        from nti.mailer.delivery import RENDER_JOB_HEADER
+        from nti.mailer.delivery import TEMPLATE_HEADER
+        assert_that(job[RENDER_JOB_HEADER], is_('1'))
+        # The tracking headers are gone.
+        assert_that(job[TEMPLATE_HEADER], is_(none()))
+        assert_that(job.get_payload(), is_(self._job_text))
+        rendered = email.message_from_string(MSG_STRING)
+        rendered.replace_header('Subject', 'Rendered')
+        return rendered
+
+    def test_render_job(self):
+        from nti.mailer.interfaces import IRawMessageMailer
+        from nti.mailer._metrics import QueueMetrics
+        from nti.mailer._processor import MailQueueProcessor
+        for raw in False, True:
+            self._queue_render_job()
+            mailer = _makeMailerStub()
+            if raw:
+                interface.alsoProvides(mailer, IRawMessageMailer)
+            metrics = QueueMetrics()
+            processor = MailQueueProcessor(mailer, self.queue_dir, metrics=metrics)
+            processor.render_job = self._render_job
+            processor.send_messages()
+            (fromaddr, toaddrs, message), = mailer.sent_messages
+            assert_that(fromaddr, is_('from@example.com'))
+            assert_that(toaddrs, is_(('to@example.com', 'hidden@example.com')))
+            if raw:
+                assert_that(message, is_(bytes))
+                message = email.message_from_bytes(message)
+            assert_that(message['Subject'], is_('Rendered'))
+            assert_that(metrics.messages_sent.value(), is_(1))
+            assert_that(self._queued(), is_([]))
+
+    def test_render_job_not_sent_by_others(self):
+        self._queue_render_job()
+        mailer = _makeMailerStub()
+        QueueProcessor(mailer, self.queue_dir).send_messages()
+        # A processor that doesn't render jobs sends it to nobody.
+        (_, toaddrs, message), = mailer.sent_messages
+        assert_that(toaddrs, is_(('',)))
+        for name in 'To', 'Cc', 'Bcc':
+            assert_that(message[name], is_(none()))
+
+    def test_render_job_fails(self):
+        from nti.mailer._maildir import retry_state
+        from nti.mailer._processor import MailQueueProcessor
+        self._queue_render_job()
+        mailer = _makeMailerStub()
+        processor = MailQueueProcessor(mailer, self.queue_dir, retry_delay=10)
+        processor._time = lambda: 1000
+        processor.render_job = Mock(side_effect=LookupError)
+        processor.send_messages()
+        assert_that(mailer.sent_messages, is_([]))
+        # It's retried later, not failed.
+        queued = self._queued('cur')
+        assert_that(queued, has_length(1))
+        assert_that(retry_state(queued[0]), is_((1, 1010)))
+        self.assertFalse(os.path.exists(os.path.join(self.queue_dir, 'failed', 'new'))
+                         and os.listdir(os.path.join(self.queue_dir, 'failed', 'new')))
+
+    def test_parsed_message(self):
+        mailer = _makeMailerStub()
+        self.assertFalse(self._process(mailer).raw_messages)
+        (fromaddr, toaddrs, message), = mailer.sent_messages
+        assert_that(fromaddr, is_('from@example.com'))
+        assert_that(toaddrs, is_(('to@example.com', 'hidden1@example.com')))
+        assert_that(message, is_(email.message.Message))
+
+    def test_raw_message(self):
+        from repoze.sendmail.encoding import encode_message
+        from nti.mailer.interfaces import IRawMessageMailer
+        parsed = _makeMailerStub()
+        self._process(parsed)
+        _, _, expected = parsed.sent_messages[0]
+        del expected['Bcc']
+        expected = encode_message(expected)
+
+        # Again, with a mailer that takes bytes.
+        self.setUp()
+        mailer = _makeMailerStub()
+        interface.alsoProvides(mailer, IRawMessageMailer)
+        self.assertTrue(self._process(mailer).raw_messages)
+        (fromaddr, toaddrs, message), = mailer.sent_messages
+        assert_that(fromaddr, is_('from@example.com'))
+        assert_that(toaddrs, is_(('to@example.com', 'hidden1@example.com')))
+        self.assertNotIn(b'hidden', message)
+        self.assertNotIn(b'X-Actually', message)
+        # It's the same message, although re-encoding may
+        # fold headers differently.
+        def unfolded(msg):
+            from nti.mailer._processor import _split_raw_message
+            _, body = _split_raw_message(msg)
+            msg = email.message_from_bytes(msg)
+            return [(k, ' '.join(v.split())) for k, v in msg.items()], body
+        self.assertEqual(unfolded(message), unfolded(expected))
+
+        # Which SESMailer sends as is.
+        ses = SESMailer()
+        ses.client = Mock()
+        ses.send(fromaddr, toaddrs, message)
+        ses.client.send_raw_email.assert_called_once_with(RawMessage={'Data': message},
+                                                          Source=fromaddr,
+                                                          Destinations=toaddrs)
+
+
+class TestFunctions(unittest.TestCase):
+
+    def test_split_raw_message(self):
+        from nti.mailer._processor import _split_raw_message
+        assert_that(_split_raw_message(b'A: b\nC: d\n\nbody\n\nmore'),
+                    is_((b'A: b\nC: d\n', b'\nbody\n\nmore')))
+        assert_that(_split_raw_message(b'A: b\r\n\r\nbody'),
+                    is_((b'A: b\r\n', b'\r\nbody')))
+        assert_that(_split_raw_message(b'A: b\n'),
+                    is_((b'A: b\n', b'')))
+        # A bare blank line in the body of a CRLF message.
+        assert_that(_split_raw_message(b'A: b\r\n\r\nbody\n\nmore'),
+                    is_((b'A: b\r\n', b'\r\nbody\n\nmore')))
+
+    def test_strip_raw_headers(self):
+        from nti.mailer._processor import _strip_raw_headers
+        headers = (b'To: a@example.com\n'
+                   b'BCC: b@example.com,\n'
+                   b'\tc@example.com\n'
+                   b'Subject: hi\n'
+                   b' there\n')
+        assert_that(_strip_raw_headers(headers, {'bcc'}),
+                    is_(b'To: a@example.com\nSubject: hi\n there\n'))
@@ -7,6 +7,7 @@ __docformat__ = "restructuredtext en"
 # disable: accessing protected members, too many methods
 # pylint: disable=W0212,R0904
 import os
+import time
 
 from tempfile import mkdtemp
 
@@ -19,6 +20,9 @@ from hamcrest import assert_that
 from hamcrest import is_
 from hamcrest import has_length
 from hamcrest import none
+from hamcrest import contains_string
+from hamcrest import has_entries
+from hamcrest import is_not
 
 
 
@@ -102,6 +106,177 @@ class TestMailer(unittest.TestCase):
             return result
         self.assertEqual(prep_lines(sent_msg_str), prep_lines(MSG_STRING))
 
+    def test_client_config(self):
+        # Config sets its options dynamically; check what we gave it.
+        config = SESMailer()._ses_config
+        assert_that(config._user_provided_options,
+                    has_entries(max_pool_connections=10, tcp_keepalive=True))
+
+        mailer = SESMailer(max_concurrency=32,
+                           connect_timeout=1,
+                           read_timeout=2,
+                           retry_mode='standard',
+                           max_attempts=5)
+        config = mailer._ses_config
+        assert_that(config._user_provided_options,
+                    has_entries(max_pool_connections=32,
+                                connect_timeout=1,
+                                read_timeout=2,
+                                retries={'mode': 'standard', 'total_max_attempts': 5}))
+        assert_that(mailer.client.meta.config.max_pool_connections, is_(32))
+
+    def test_close(self):
+        mailer = SESMailer()
+        # Nothing to close
+        mailer.close()
+        client = mailer.client = Mock()
+        mailer.close()
+        client.close.assert_called_once_with()
+        self.assertIsNot(mailer.client, client)
+
+    def test_no_rate_limiter_by_default(self):
+        assert_that(SESMailer().rate_limiter, is_(none()))
+
+    def test_send_rate_limited(self):
+        mailer = SESMailer(max_send_rate=5)
+        mailer.client = Mock()
+        limiter = mailer.rate_limiter
+        assert_that(limiter.rate, is_(5.0))
+        limiter.acquire = Mock()
+
+        mailer.send('from', ('to1', 'to2', 'to3'), self.message)
+        limiter.acquire.assert_called_once_with(3)
+
+    def test_send_rate_discovered(self):
+        mailer = SESMailer(max_send_rate=SESMailer.DISCOVER_SEND_RATE)
+        mailer.client = Mock()
+        mailer.client.get_send_quota.return_value = {'MaxSendRate': 14.0}
+        mailer.prepare()
+        assert_that(mailer.rate_limiter.rate, is_(14.0))
+        assert_that(mailer.client.get_send_quota.call_count, is_(1))
+
+    def test_send_rate_discovered_unlimited(self):
+        mailer = SESMailer(max_send_rate=SESMailer.DISCOVER_SEND_RATE, adaptive=True)
+        mailer.client = Mock()
+        mailer.client.get_send_quota.return_value = {'MaxSendRate': -1.0}
+        mailer.prepare()
+        assert_that(mailer.rate_limiter, is_(none()))
+        mailer.send('from', ('to',), self.message)
+        mailer.client.send_raw_email.assert_called_once()
+
+    def test_send_adaptive(self):
+        from botocore.exceptions import ClientError
+        mailer = SESMailer(max_send_rate=8, adaptive=True, max_concurrency=4)
+        mailer.client = Mock()
+        mailer.send('from', ('to',), self.message)
+        controller = mailer.adaptive_controller
+        assert_that(controller.rate, is_(8.0))
+        assert_that(controller.concurrency, is_(4))
+
+        mailer.client.send_raw_email.side_effect = ClientError(
+            {'Error': {'Code': 'Throttling', 'Message': 'Maximum sending rate exceeded.'}},
+            'SendRawEmail')
+        with self.assertRaises(ClientError):
+            mailer.send('from', ('to',), self.message)
+        assert_that(controller.rate, is_(4.0))
+        assert_that(controller.concurrency, is_(2))
+        assert_that(mailer.concurrency_limiter.active, is_(0))
+
+        # Other errors don't count.
+        controller.cooldown = 0
+        mailer.client.send_raw_email.side_effect = ClientError(
+            {'Error': {'Code': 'MessageRejected'}}, 'SendRawEmail')
+        with self.assertRaises(ClientError):
+            mailer.send('from', ('to',), self.message)
+        assert_that(controller.throttle_count, is_(1))
+
+    def test_send_metrics(self):
+        from botocore.exceptions import ClientError
+        from nti.mailer.queue import QueueMetrics
+        metrics = QueueMetrics()
+        mailer = SESMailer(metrics=metrics)
+        mailer.client = Mock()
+        mailer.send('from', ('to',), self.message)
+        assert_that(metrics.ses_request_duration.count(), is_(1))
+
+        mailer.client.send_raw_email.side_effect = ClientError(
+            {'Error': {'Code': 'Throttling', 'Message': 'Maximum sending rate exceeded.'}},
+            'SendRawEmail')
+        with self.assertRaises(ClientError):
+            mailer.send('from', ('to',), self.message)
+        assert_that(metrics.ses_request_duration.count(), is_(2))
+        assert_that(metrics.throttled.value(), is_(1))
+
+        # Server errors slow us down too, but aren't throttling.
+        mailer.client.send_raw_email.side_effect = ClientError(
+            {'Error': {'Code': 'InternalFailure', 'Message': 'Failed'},
+             'ResponseMetadata': {'HTTPStatusCode': 500}},
+            'SendRawEmail')
+        with self.assertRaises(ClientError):
+            mailer.send('from', ('to',), self.message)
+        assert_that(metrics.throttled.value(), is_(1))
+
+    def test_is_throttling_error(self):
+        from botocore.exceptions import ClientError
+        from nti.mailer._ses import _is_throttling_error
+        def error(code, status=400):
+            return ClientError({'Error': {'Code': code},
+                                'ResponseMetadata': {'HTTPStatusCode': status}},
+                               'SendRawEmail')
+        self.assertTrue(_is_throttling_error(error('Throttling')))
+        self.assertTrue(_is_throttling_error(error('InternalFailure', 500)))
+        self.assertTrue(_is_throttling_error(error('ServiceUnavailable', 503)))
+        self.assertFalse(_is_throttling_error(error('MessageRejected')))
+        self.assertFalse(_is_throttling_error(ClientError({}, 'SendRawEmail')))
+
+    def test_quota(self):
+        from botocore.exceptions import ClientError
+        from nti.mailer._throttle import SendQuota
+        quota = SendQuota()
+        mailer = SESMailer(quota=quota)
+        mailer.client = Mock()
+        mailer.client.get_send_quota.return_value = {
+            'Max24HourSend': 3.0, 'SentLast24Hours': 0.0, 'MaxSendRate': 1.0
+        }
+        self.assertTrue(mailer.quota_available())
+        mailer.send('from', ('to1', 'to2'), self.message)
+        self.assertTrue(mailer.quota_available())
+        assert_that(mailer.client.get_send_quota.call_count, is_(1))
+        mailer.send('from', ('to',), self.message)
+        self.assertFalse(mailer.quota_available())
+
+        # If we can't refresh, we keep what we knew.
+        quota.refresh_interval = 0
+        mailer.client.get_send_quota.side_effect = ClientError({}, 'GetSendQuota')
+        self.assertFalse(mailer.quota_available())
+
+        # If SES says we're out, we're out
+        mailer.client.get_send_quota.side_effect = None
+        mailer.client.get_send_quota.return_value['Max24HourSend'] = 100.0
+        quota.refresh_interval = 300
+        quota.update(mailer.client.get_send_quota())
+        self.assertTrue(mailer.quota_available())
+        mailer.client.send_raw_email.side_effect = ClientError(
+            {'Error': {'Code': 'Throttling', 'Message': 'Daily message quota exceeded.'}},
+            'SendRawEmail')
+        with self.assertRaises(ClientError):
+            mailer.send('from', ('to',), self.message)
+        self.assertFalse(mailer.quota_available())
+
+    def test_no_quota(self):
+        self.assertTrue(SESMailer().quota_available())
+
+    def test_quota_exceeded_is_not_throttling(self):
+        from botocore.exceptions import ClientError
+        mailer = SESMailer(adaptive=True)
+        mailer.client = Mock()
+        mailer.client.send_raw_email.side_effect = ClientError(
+            {'Error': {'Code': 'Throttling', 'Message': 'Daily message quota exceeded.'}},
+            'SendRawEmail')
+        with self.assertRaises(ClientError):
+            mailer.send('from', ('to',), self.message)
+        assert_that(mailer.adaptive_controller.throttle_count, is_(0))
+
 
 class TestLoopingMailerProcess(unittest.TestCase):
 
@@ -153,6 +328,167 @@ class TestLoopingMailerProcess(unittest.TestCase):
         assert_that(tuple(self.maildir), has_length(0))
 
 
+    def test_mailer_reused_until_close(self):
+        mailers = []
+        def factory():
+            mailer = Mock()
+            mailers.append(mailer)
+            return mailer
+        proc = self._getFUT()(factory, self.queue_dir)
+        self.addCleanup(proc.close)
+        proc._do_process_queue()
+        proc._do_process_queue()
+        assert_that(mailers, has_length(1))
+        mailers[0].close.assert_not_called()
+        proc.close()
+        mailers[0].close.assert_called_once_with()
+        # A closed mailer isn't reused
+        proc._do_process_queue()
+        assert_that(mailers, has_length(2))
+
+    def test_delivery_concurrent(self):
+        import threading
+        self._queue_two_messages()
+        # Both messages must be in flight at once for either
+        # to finish.
+        barrier = threading.Barrier(2, timeout=5)
+        send = self.mailer.send
+        def send_concurrently(*args):
+            barrier.wait()
+            send(*args)
+        self.mailer.send = send_concurrently
+
+        proc = self._getFUT()(lambda: self.mailer, self.queue_dir, concurrency=2)
+        self.addCleanup(proc.close)
+        self._runOnce(proc)
+        assert_that(self.mailer.sent_messages, has_length(2))
+        assert_that(tuple(self.maildir), has_length(0))
+
+
+    def test_delivery_pauses_when_quota_exhausted(self):
+        self._queue_two_messages()
+        available = [True, False]
+        self.mailer.quota_available = lambda: available.pop(0)
+        proc = self._makeOne()
+        proc._quota_exhausted = Mock()
+        self._runOnce(proc)
+        # One sent, the other left alone.
+        assert_that(self.mailer.sent_messages, has_length(1))
+        assert_that(tuple(self.maildir), has_length(1))
+        proc._quota_exhausted.assert_called_once_with()
+
+    def test_delivery_pauses_when_mailer_not_ready(self):
+        self._queue_two_messages()
+
+        def prepare():
+            raise ValueError
+        self.mailer.prepare = prepare
+        proc = self._makeOne()
+        proc._quota_exhausted = Mock()
+        proc._mailer_not_ready = Mock()
+        self._runOnce(proc)
+        assert_that(self.mailer.sent_messages, has_length(0))
+        assert_that(tuple(self.maildir), has_length(2))
+        proc._mailer_not_ready.assert_called_once_with()
+        proc._quota_exhausted.assert_not_called()
+
+    def test_delivery_claiming(self):
+        self._queue_two_messages()
+        proc = self._getFUT()(lambda: self.mailer, self.queue_dir, worker_id='w1')
+        self.addCleanup(proc.close)
+        self._runOnce(proc)
+        assert_that(self.mailer.sent_messages, has_length(2))
+        assert_that(tuple(self.maildir), has_length(0))
+        assert_that(tuple(proc.mail_dir), has_length(0))
+
+    def test_delivery_claiming_only_what_is_sent(self):
+        self._queue_two_messages()
+        available = [True, False]
+        self.mailer.quota_available = lambda: available.pop(0)
+        proc = self._getFUT()(lambda: self.mailer, self.queue_dir, worker_id='w1')
+        self.addCleanup(proc.close)
+        proc._quota_exhausted = Mock()
+        self._runOnce(proc)
+        assert_that(self.mailer.sent_messages, has_length(1))
+        # The other is still in the queue for anyone, not in our lease.
+        assert_that(tuple(self.maildir), has_length(1))
+        assert_that([name for name in os.listdir(proc.mail_dir.lease_path)
+                     if not name.startswith('.')],
+                    is_([]))
+
+    def test_queue_metrics(self):
+        from nti.mailer.queue import QueueMetrics
+        self._queue_two_messages()
+        metrics = QueueMetrics()
+        assert_that(metrics.registry.exposition(),
+                    is_not(contains_string('nti_mailer_queue_messages{')))
+        proc = self._getFUT()(lambda: self.mailer, self.queue_dir, metrics=metrics)
+        self.addCleanup(proc.close)
+        metrics._time = lambda: time.time() + 10
+        exposition = metrics.registry.exposition()
+        assert_that(exposition, contains_string(
+            'nti_mailer_queue_messages{lane="default",state="new"} 2.0\n'
+            'nti_mailer_queue_messages{lane="default",state="cur"} 0.0\n'))
+        assert_that(exposition, contains_string(
+            'nti_mailer_queue_oldest_message_age_seconds{lane="default"} 1'))
+
+        self._runOnce(proc)
+        assert_that(metrics.messages_sent.value(), is_(2))
+        self.assertGreaterEqual(metrics.drain_duration.count(), 1)
+        exposition = metrics.registry.exposition()
+        assert_that(exposition, contains_string(
+            'nti_mailer_queue_messages{lane="default",state="new"} 0.0\n'))
+        assert_that(exposition, contains_string(
+            'nti_mailer_queue_oldest_message_age_seconds{lane="default"} 0.0\n'))
+        assert_that(exposition, contains_string('nti_mailer_debounce_pending 0.0\n'))
+
+    def test_delivery_lanes(self):
+        from email.message import Message
+        import transaction
+        from nti.mailer.delivery import lane_path
+        bulk = QueuedMailDelivery(lane_path(self.queue_dir, 'bulk'))
+        transaction.manager.begin()
+        for delivery, subject in (bulk, 'bulk'), (self.delivery, 'default'):
+            message = Message()
+            message['Subject'] = subject
+            message.set_payload('Nice pants, mister!')
+            delivery.send('foo@bar.foo', ['bar@foo.bar'], message)
+        transaction.manager.commit()
+
+        proc = self._getFUT()(lambda: self.mailer, self.queue_dir,
+                              lanes=('default', 'bulk'))
+        self.addCleanup(proc.close)
+        self._runOnce(proc)
+        assert_that([message['Subject'] for _, _, message in self.mailer.sent_messages],
+                    is_(['default', 'bulk']))
+        assert_that(tuple(self.maildir), has_length(0))
+        assert_that(tuple(Maildir(lane_path(self.queue_dir, 'bulk'))), has_length(0))
+
+    def test_delivery_lanes_failed(self):
+        from email.message import Message
+        import transaction
+        from botocore.exceptions import ClientError
+        from nti.mailer.delivery import lane_path
+        bulk_path = lane_path(self.queue_dir, 'bulk')
+        message = Message()
+        message['Subject'] = 'bulk'
+        message.set_payload('Nice pants, mister!')
+        transaction.manager.begin()
+        QueuedMailDelivery(bulk_path).send('foo@bar.foo', ['bar@foo.bar'], message)
+        transaction.manager.commit()
+
+        self.mailer.send = Mock(side_effect=ClientError(
+            {'Error': {'Code': 'MessageRejected', 'Message': 'Rejected'}},
+            'SendRawEmail'))
+        proc = self._getFUT()(lambda: self.mailer, self.queue_dir,
+                              lanes=('default', 'bulk'), worker_id='w1')
+        self.addCleanup(proc.close)
+        self._runOnce(proc)
+        # In the bulk lane, not the first.
+        assert_that(os.listdir(os.path.join(bulk_path, 'failed', 'new')), has_length(1))
+        self.assertFalse(os.path.exists(os.path.join(self.queue_dir, 'failed')))
+
+
 class TestMailerWatcher(TestLoopingMailerProcess):
 
     def _getFUT(self):
@@ -219,6 +555,149 @@ class TestMailerWatcher(TestLoopingMailerProcess):
         assert_that(mailer.debouncer, is_(none()))
         assert_that(mailer.debouncer_count, is_(0))
 
+    def test_watcher_type(self):
+        from nti.mailer._inotify import InotifyWatcher
+        from nti.mailer._inotify import inotify_available
+        mailer = self._makeOne()
+        self.assertEqual(isinstance(mailer.watcher, InotifyWatcher),
+                         mailer.use_inotify and inotify_available())
+
+    def test_urgent_wakeup_skips_debounce(self):
+        import gevent
+        from nti.mailer.delivery import wake_queue_processor
+        mailer = self._makeOne()
+        mailer.test_one_shot = False
+        mailer.max_process_frequency_seconds = 30
+        mailer._youve_got_mail()
+        assert_that(mailer.test_queue_proc_count, is_(1))
+        mailer._start_watching()
+
+        # Normal wakeups are debounced
+        wake_queue_processor(self.queue_dir)
+        while mailer.debouncer_count == 0:
+            gevent.sleep(0.01)
+        assert_that(mailer.test_queue_proc_count, is_(1))
+
+        # Urgent ones are not, and several at once are
+        # handled together.
+        wake_queue_processor(self.queue_dir, urgent=True)
+        wake_queue_processor(self.queue_dir, urgent=True)
+        while mailer.test_queue_proc_count == 1:
+            gevent.sleep(0.01)
+        gevent.sleep(0.05)
+        assert_that(mailer.test_queue_proc_count, is_(2))
+        # The debouncer keeps going.
+        self.assertTrue(mailer.debouncer.active)
+        assert_that(mailer.debouncer_count, is_(1))
+
+        # Without a debouncer, urgent mail just starts processing.
+        mailer.close()
+        mailer._urgent_mail()
+        assert_that(mailer.test_queue_proc_count, is_(3))
+        mailer.close()
+        self.assertFalse(os.path.exists(os.path.join(self.queue_dir, 'wakeup.sock')))
+
+    def test_urgent_wakeups_while_processing_coalesce(self):
+        mailer = self._makeOne()
+        mailer.test_one_shot = False
+        drains = []
+        def drain():
+            drains.append(mailer.draining)
+            if len(drains) == 1:
+                # Sending yields to the hub, where several
+                # urgent wakeups arrive.
+                mailer._urgent_mail()
+                mailer._urgent_mail()
+        mailer._drain_queue = drain
+        mailer._youve_got_mail()
+        # Just one more pass, once the first was done.
+        assert_that(drains, is_([True, True]))
+        self.assertFalse(mailer.draining)
+        self.assertFalse(mailer.urgent_pending)
+        assert_that(mailer.test_queue_proc_count, is_(1))
+        mailer.close()
+
+    def test_no_wakeup_socket(self):
+        # Something that's in the way and can't be removed.
+        os.mkdir(os.path.join(self.queue_dir, 'wakeup.sock'))
+        mailer = self._makeOne()
+        assert_that(mailer.wakeup_socket, is_(none()))
+        mailer._start_watching()
+        mailer.close()
+
+    def test_wakeup_socket_not_stolen(self):
+        first = self._makeOne()
+        self.assertIsNotNone(first.wakeup_socket)
+        # A second worker on the same queue leaves it alone...
+        second = self._makeOne()
+        assert_that(second.wakeup_socket, is_(none()))
+        second.close()
+        first.close()
+        # ...and so can take over once the first is gone.
+        third = self._makeOne()
+        self.assertIsNotNone(third.wakeup_socket)
+        # Closing doesn't remove a socket that isn't ours.
+        path = third.wakeup_socket.getsockname()
+        third._wakeup_socket_stat = os.stat(self.queue_dir)
+        third.close()
+        self.assertTrue(os.path.exists(path))
+
+    def test_retry_timer(self):
+        mailer = self._makeOne()
+        mailer.test_one_shot = False
+        mailer._retry_scheduled(time.time() + 60)
+        first = mailer.retry_timer
+        self.assertTrue(first.active)
+        # Replaced by a later schedule
+        mailer._retry_scheduled(time.time() - 1)
+        self.assertFalse(first.active)
+        self.assertTrue(mailer.retry_timer.active)
+        mailer._retry_timer_fired()
+        assert_that(mailer.retry_timer, is_(none()))
+        assert_that(mailer.test_queue_proc_count, is_(1))
+        mailer._retry_scheduled(time.time() + 60)
+        mailer.close()
+        assert_that(mailer.retry_timer, is_(none()))
+
+    def test_follow_up_only_when_mail_arrives(self):
+        import transaction
+        mailer = self._makeOne()
+        mailer.test_one_shot = False
+        mailer.max_process_frequency_seconds = 30
+        mailer._start_watching()
+
+        self._queue_two_messages()
+        mailer._youve_got_mail()
+        assert_that(mailer.test_queue_proc_count, is_(1))
+        assert_that(tuple(self.maildir), has_length(0))
+        # Our own changes don't count.
+        assert_that(mailer.debouncer_count, is_(0))
+        self.assertTrue(mailer.watcher.active)
+
+        # But a message arriving while we work does
+        self._queue_two_messages()
+        send = self.mailer.send
+        def send_and_queue(*args):
+            self.mailer.send = send
+            send(*args)
+            transaction.manager.begin()
+            self.delivery.send('foo@bar.foo', ['bar@foo.bar'], args[2])
+            transaction.manager.commit()
+        self.mailer.send = send_and_queue
+        mailer._do_process_queue()
+        assert_that(tuple(self.maildir), has_length(1))
+        assert_that(mailer.debouncer_count, is_(1))
+        self.assertTrue(mailer.watcher.active)
+
+    def test_inotify_ignores_sent_messages(self):
+        from nti.mailer._inotify import InotifyWatcher
+        mailer = self._makeOne()
+        if not isinstance(mailer.watcher, InotifyWatcher):
+            self.skipTest("Requires inotify")
+        mailer.watcher.names = ('already-sent',)
+        mailer._inotify_change_observed()
+        assert_that(mailer.test_queue_proc_count, is_(0))
+
     def test_debouncer_basic(self):
         # This isn't a very functional test, it doesn't prove
         # much beyond the code as written interacts roughly as
@@ -251,6 +730,124 @@ class TestMailerWatcher(TestLoopingMailerProcess):
         assert_that(mailer.test_queue_proc_count, is_(2))
         assert_that(mailer.test_timer_fired_count, is_(1))
 
+    def test_quota_exhausted_retries_later(self):
+        import gevent
+        from nti.mailer._throttle import SendQuota
+        self.mailer.quota = SendQuota()
+        self.mailer.quota.update({'Max24HourSend': 1.0, 'SentLast24Hours': 1.0})
+        mailer = self._makeOne()
+        mailer.test_one_shot = False
+        mailer.max_process_frequency_seconds = 0.01
+        mailer.quota_pause_seconds = 0.01
+        mailer._quota_exhausted()
+        timer = mailer.quota_timer
+        self.assertTrue(timer.active)
+        # Only one at a time
+        mailer._quota_exhausted()
+        self.assertIs(mailer.quota_timer, timer)
+
+        while mailer.test_queue_proc_count == 0:
+            gevent.sleep(0.01)
+        assert_that(mailer.quota_timer, is_(none()))
+        # Having waited, we ask SES again right away.
+        self.assertTrue(self.mailer.quota.needs_refresh())
+
+        mailer._quota_exhausted()
+        mailer.close()
+        assert_that(mailer.quota_timer, is_(none()))
+
+    def test_mailer_not_ready_retries_later(self):
+        import gevent
+        mailer = self._makeOne()
+        mailer.test_one_shot = False
+        mailer.max_process_frequency_seconds = 0.01
+        mailer.quota_pause_seconds = 0.01
+        mailer._mailer_not_ready()
+        self.assertTrue(mailer.quota_timer.active)
+
+        while mailer.test_queue_proc_count == 0:
+            gevent.sleep(0.01)
+        assert_that(mailer.quota_timer, is_(none()))
+        mailer.close()
+
+
+
+class TestPollingMailerWatcher(TestMailerWatcher):
+
+    def _getFUT(self):
+        class FUT(super()._getFUT()):
+            use_inotify = False
+        return FUT
+
+
+class TestWorkerSupervisor(unittest.TestCase):
+
+    def _makeOne(self, workers=2, exits=()):
+        import signal
+        from nti.mailer.queue import _WorkerSupervisor
+        for sig in signal.SIGTERM, signal.SIGINT:
+            self.addCleanup(signal.signal, sig, signal.getsignal(sig))
+
+        exits = list(exits)
+        class FUT(_WorkerSupervisor):
+            next_pid = 100
+            killed = ()
+            slept = 0
+            def _fork(self):
+                self.next_pid += 1
+                return self.next_pid
+            def _waitpid(self, pid, options):
+                assert_that((pid, options), is_((-1, 0)))
+                if exits:
+                    return exits.pop(0), 1
+                # Nothing else dies on its own; stop, and collect
+                # the workers that kills.
+                if not self.stopping:
+                    self.stop()
+                return min(self.children), 0
+            def _kill(self, pid, sig):
+                self.killed += ((pid, sig),)
+            def _sleep(self, seconds):
+                self.slept += seconds
+        return FUT(Mock(), workers)
+
+    def test_replaces_dead_workers(self):
+        import signal
+        supervisor = self._makeOne(exits=[101])
+        supervisor.run()
+        # Two to start, one replacement.
+        assert_that(supervisor.next_pid, is_(103))
+        assert_that(supervisor.slept, is_(supervisor.respawn_delay))
+        assert_that(sorted(supervisor.killed),
+                    is_([(102, signal.SIGTERM), (103, signal.SIGTERM)]))
+        assert_that(supervisor.children, is_(set()))
+        supervisor.target.assert_not_called()
+
+    def test_stop_on_signal(self):
+        import signal
+        supervisor = self._makeOne()
+        supervisor.run()
+        assert_that(signal.getsignal(signal.SIGTERM), is_(supervisor.stop))
+        assert_that(signal.getsignal(signal.SIGINT), is_(supervisor.stop))
+
+    def test_child(self):
+        import signal
+        supervisor = self._makeOne()
+        supervisor._fork = lambda: 0
+        supervisor._exit = Mock()
+        with unittest.mock.patch('gevent.reinit') as reinit:
+            supervisor._spawn()
+        reinit.assert_called_once_with()
+        supervisor.target.assert_called_once_with()
+        supervisor._exit.assert_called_once_with(0)
+        assert_that(signal.getsignal(signal.SIGTERM), is_(signal.SIG_DFL))
+
+        supervisor.target.side_effect = Exception
+        supervisor._exit.reset_mock()
+        with unittest.mock.patch('gevent.reinit'):
+            supervisor._spawn()
+        supervisor._exit.assert_called_once_with(1)
+        assert_that(supervisor.children, is_(set()))
 
 
 class TestFunctions(unittest.TestCase):
@@ -282,6 +879,21 @@ class TestFunctions(unittest.TestCase):
         Watcher.prev.st_mtime = 36
         self.assertTrue(_stat_watcher_modified(Watcher()))
 
+    def test_count_destinations(self):
+        from nti.mailer._ses import _count_destinations
+        assert_that(_count_destinations('to'), is_(1))
+        assert_that(_count_destinations(()), is_(1))
+        assert_that(_count_destinations(('a', 'b')), is_(2))
+
+    def test_send_rate(self):
+        import argparse
+        from nti.mailer.queue import _send_rate
+        assert_that(_send_rate('auto'), is_('auto'))
+        assert_that(_send_rate('2.5'), is_(2.5))
+        for bad in ('0', '-1', 'fast'):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                _send_rate(bad)
+
     def test_log_level_for_verbosity(self):
         import logging
         from nti.mailer.queue import _log_level_for_verbosity as FUT
@@ -302,3 +914,24 @@ class TestConsoleApp(unittest.TestCase):
         args = ['console', tempfile.gettempdir()]
         app = ConsoleApp(args)
         assert_that(app.mailer, is_(SESMailer))
+
+    def test_main(self):
+        import shutil
+        import transaction
+        from nti.mailer.delivery import QUEUED_AT_HEADER
+        from nti.mailer.queue import ConsoleApp
+        tmp = mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        queue_dir = os.path.join(tmp, 'queue')
+        message = email.message_from_string(MSG_STRING)
+        message[QUEUED_AT_HEADER] = '1000.5'
+        transaction.manager.begin()
+        QueuedMailDelivery(queue_dir).send('from@example.com', ['to@example.com'], message)
+        transaction.manager.commit()
+
+        app = ConsoleApp(['console', queue_dir])
+        app.mailer = _makeMailerStub()
+        app.main()
+        # Sent by our queue processor, which removes our headers.
+        (_, _, sent), = app.mailer.sent_messages
+        assert_that(sent[QUEUED_AT_HEADER], is_(none()))
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+import os
+import email
+import unittest
+from unittest.mock import patch
+
+from botocore.exceptions import ClientError
+
+from hamcrest import assert_that
+from hamcrest import is_
+from hamcrest import has_length
+from hamcrest import contains_string
+
+from nti.mailer._ses import _is_throttling_error
+from nti.mailer._ses import _is_quota_exceeded_error
+from nti.mailer._throttle import SendQuota
+from nti.mailer.queue import SESMailer
+from nti.mailer.testing import FakeSESServer
+
+from nti.mailer.tests.test_queue import MSG_STRING
+
+
+class TestFakeSESServer(unittest.TestCase):
+
+    def setUp(self):
+        self.message = email.message_from_string(MSG_STRING)
+        env = patch.dict(os.environ, FakeSESServer.environ)
+        env.start()
+        self.addCleanup(env.stop)
+
+    def _makeOne(self, **kwargs):
+        server = FakeSESServer(**kwargs).start()
+        self.addCleanup(server.stop)
+        return server
+
+    def _makeMailer(self, server, **kwargs):
+        # Don't let boto retry; we want to see each answer.
+        mailer = SESMailer(endpoint_url=server.endpoint_url, max_attempts=1, **kwargs)
+        self.addCleanup(mailer.close)
+        return mailer
+
+    def _send_error(self, mailer):
+        with self.assertRaises(ClientError) as exc:
+            mailer.send('from@example.com', ('to@example.com',), self.message)
+        return exc.exception
+
+    def test_send(self):
+        server = self._makeOne()
+        mailer = self._makeMailer(server)
+        assert_that(mailer.client.meta.endpoint_url, is_(server.endpoint_url))
+        mailer.send('from@example.com', ('to1@example.com', 'to2@example.com'), self.message)
+
+        assert_that(server.messages, has_length(1))
+        sent = server.messages[0]
+        assert_that(sent.source, is_('from@example.com'))
+        assert_that(sent.destinations, is_(('to1@example.com', 'to2@example.com')))
+        assert_that(sent.data.decode('ascii'), contains_string('Subject: Welcome to NextThought'))
+        assert_that(server.requests, is_({'SendRawEmail': 1}))
+        assert_that(server.sent_last_24_hours, is_(2))
+
+    def test_sink(self):
+        sent = []
+        server = self._makeOne(sink=sent.append)
+        self._makeMailer(server).send('from@example.com', ('to@example.com',), self.message)
+        assert_that(sent, has_length(1))
+        assert_that(server.messages, is_([]))
+
+    def test_quota(self):
+        server = self._makeOne(max_send_rate=14, max_24_hour_send=2)
+        quota = SendQuota()
+        mailer = self._makeMailer(server, quota=quota, max_send_rate='auto')
+        self.assertTrue(mailer.quota_available())
+        assert_that(quota.remaining, is_(2))
+        assert_that(mailer.rate_limiter.rate, is_(14))
+
+        mailer.send('from@example.com', ('to1@example.com', 'to2@example.com'), self.message)
+        ex = self._send_error(mailer)
+        self.assertTrue(_is_quota_exceeded_error(ex))
+        assert_that(server.messages, has_length(1))
+        self.assertTrue(quota.exhausted)
+
+    def test_unlimited_quota(self):
+        server = self._makeOne()
+        quota = SendQuota()
+        self.assertTrue(self._makeMailer(server, quota=quota).quota_available())
+        assert_that(quota.remaining, is_(None))
+
+    def test_throttling(self):
+        server = self._makeOne(max_send_rate=2)
+        clock = [0]
+        server._clock = lambda: clock[0]
+        mailer = self._makeMailer(server, adaptive=True)
+        mailer.send('from@example.com', ('to1@example.com', 'to2@example.com'), self.message)
+
+        ex = self._send_error(mailer)
+        self.assertTrue(_is_throttling_error(ex))
+        self.assertFalse(_is_quota_exceeded_error(ex))
+        assert_that(mailer.adaptive_controller.throttle_count, is_(1))
+        assert_that(server.throttled, is_(1))
+
+        # A second later, there's room again.
+        clock[0] = 1
+        mailer.send('from@example.com', ('to1@example.com',), self.message)
+        assert_that(server.messages, has_length(2))
+
+    def test_errors(self):
+        server = self._makeOne(error_rate=1)
+        ex = self._send_error(self._makeMailer(server))
+        assert_that(ex.response['ResponseMetadata']['HTTPStatusCode'], is_(500))
+        assert_that(ex.response['Error']['Code'], is_('InternalFailure'))
+        self.assertTrue(_is_throttling_error(ex))
+        assert_that(server.errors, is_(1))
+        assert_that(server.messages, is_([]))
+
+    def test_error_rate_with_seed(self):
+        def outcomes(seed):
+            server = FakeSESServer(error_rate=0.5, seed=seed)
+            return [server.handle({'Action': 'GetSendQuota'})[0] for _ in range(20)]
+        assert_that(outcomes(42), is_(outcomes(42)))
+        self.assertIn(500, outcomes(42))
+        self.assertIn(200, outcomes(42))
+
+    def test_unknown_action(self):
+        status, body = FakeSESServer().handle({'Action': 'VerifyEmailIdentity'})
+        assert_that(status, is_(400))
+        assert_that(body, contains_string('<Code>InvalidAction</Code>'))
+
+    def test_latency(self):
+        server = FakeSESServer(latency={'SendRawEmail': lambda: 0.5})
+        slept = []
+        server._sleep = slept.append
+        server.handle({'Action': 'GetSendQuota'})
+        server.handle({'Action': 'SendRawEmail', 'Destinations.member.1': 'to@example.com'})
+        assert_that(slept, is_([0.5]))
+
+        server.latency = 0.25
+        server.handle({'Action': 'GetSendQuota'})
+        assert_that(slept, is_([0.5, 0.25]))
+
+    def test_queue_drain(self):
+        from repoze.sendmail.delivery import QueuedMailDelivery
+        from repoze.sendmail.maildir import Maildir
+        import tempfile
+        import shutil
+        import transaction
+        from nti.mailer.queue import MailQueueProcessor
+
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        queue_path = os.path.join(tmp, 'queue')
+        delivery = QueuedMailDelivery(queue_path)
+        transaction.manager.begin()
+        for i in range(10):
+            delivery.send('from@example.com', ['to%d@example.com' % i], self.message)
+        transaction.manager.commit()
+
+        server = self._makeOne(latency=0.01)
+        mailer = self._makeMailer(server, max_concurrency=4)
+        MailQueueProcessor(mailer, queue_path, concurrency=4).send_messages()
+        assert_that(server.messages, has_length(10))
+        assert_that(list(Maildir(queue_path)), is_([]))
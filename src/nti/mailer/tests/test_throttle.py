@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+# disable: accessing protected members, too many methods
+# pylint: disable=W0212,R0904
+
+import unittest
+
+from hamcrest import assert_that
+from hamcrest import is_
+from hamcrest import close_to
+from hamcrest import none
+
+from nti.mailer._throttle import AIMDController
+from nti.mailer._throttle import ConcurrencyLimiter
+from nti.mailer._throttle import SendQuota
+from nti.mailer._throttle import TokenBucket
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def _makeOne(self, rate, capacity=None):
+        clock = FakeClock()
+        class Bucket(TokenBucket):
+            _clock = clock
+            _sleep = clock.sleep
+        return Bucket(rate, capacity), clock
+
+    def test_invalid_rate(self):
+        with self.assertRaises(ValueError):
+            TokenBucket(0)
+
+    def test_default_capacity(self):
+        assert_that(TokenBucket(14).capacity, is_(14.0))
+        assert_that(TokenBucket(0.5).capacity, is_(1.0))
+
+    def test_burst_then_steady_rate(self):
+        bucket, clock = self._makeOne(10)
+        # One second's worth is available immediately.
+        for _ in range(10):
+            assert_that(bucket.acquire(), is_(0))
+        assert_that(clock.slept, is_([]))
+
+        # After that, each one waits its turn.
+        for _ in range(5):
+            bucket.acquire()
+        assert_that(clock.now, is_(0.5))
+
+    def test_waiters_line_up(self):
+        bucket, _ = self._makeOne(2, capacity=1)
+        assert_that(bucket.reserve(), is_(0))
+        # Nobody has slept, but each reservation waits longer.
+        assert_that(bucket.reserve(), is_(0.5))
+        assert_that(bucket.reserve(), is_(1.0))
+
+    def test_multiple_tokens(self):
+        bucket, clock = self._makeOne(10)
+        bucket.acquire(10)
+        bucket.acquire(50)
+        assert_that(clock.now, is_(5.0))
+
+    def test_refill_capped_at_capacity(self):
+        bucket, clock = self._makeOne(10)
+        clock.now = 100
+        bucket.acquire(10)
+        assert_that(bucket.reserve(), is_(0.1))
+
+    def test_repr(self):
+        assert_that(repr(TokenBucket(1)), is_('<TokenBucket rate=1.0 capacity=1.0>'))
+
+    def test_change_rate_credits_old_rate(self):
+        bucket, clock = self._makeOne(10)
+        bucket.acquire(10)
+        clock.now = 0.5
+        bucket.rate = 1
+        # We earned 5 tokens at the old rate
+        assert_that(bucket.reserve(5), is_(0))
+        assert_that(bucket.reserve(), is_(1.0))
+
+
+class TestConcurrencyLimiter(unittest.TestCase):
+
+    def test_limit(self):
+        import threading
+        limiter = ConcurrencyLimiter(0)
+        assert_that(limiter.limit, is_(1))
+        limiter.acquire()
+
+        acquired = threading.Event()
+        def acquire():
+            with limiter:
+                acquired.set()
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.05))
+        # Raising the limit lets it in.
+        limiter.limit = 2
+        self.assertTrue(acquired.wait(5))
+        thread.join(5)
+        assert_that(limiter.active, is_(1))
+        limiter.release()
+        assert_that(limiter.active, is_(0))
+
+
+class TestAIMDController(unittest.TestCase):
+
+    def _makeOne(self, rate=8, concurrency=8, **kwargs):
+        clock = FakeClock()
+        class Controller(AIMDController):
+            _clock = clock
+        controller = Controller(TokenBucket(rate), ConcurrencyLimiter(concurrency), **kwargs)
+        return controller, clock
+
+    def test_nothing_to_control(self):
+        controller = AIMDController()
+        controller.throttled()
+        controller.succeeded()
+        assert_that(controller.rate, is_(None))
+        assert_that(controller.concurrency, is_(None))
+        assert_that(controller.throttle_count, is_(1))
+
+    def test_decrease_with_cooldown(self):
+        controller, clock = self._makeOne()
+        controller.throttled()
+        assert_that(controller.rate, is_(4.0))
+        assert_that(controller.concurrency, is_(4))
+        # In-flight failures are ignored
+        controller.throttled()
+        assert_that(controller.rate, is_(4.0))
+        assert_that(controller.throttle_count, is_(2))
+
+        clock.now += 1
+        controller.throttled()
+        assert_that(controller.rate, is_(2.0))
+        assert_that(controller.concurrency, is_(2))
+
+        for _ in range(5):
+            clock.now += 1
+            controller.throttled()
+        assert_that(controller.rate, is_(1.0))
+        assert_that(controller.concurrency, is_(1))
+
+    def test_min_rate_not_above_max(self):
+        controller, _ = self._makeOne(rate=0.5)
+        assert_that(controller.min_rate, is_(0.5))
+
+    def test_additive_recovery(self):
+        controller, _ = self._makeOne()
+        controller.throttled()
+        # Four successes at concurrency four add one sender;
+        # four successes at about 4/s add about 1/s.
+        for _ in range(4):
+            controller.succeeded()
+        assert_that(controller.concurrency, is_(5))
+        assert_that(controller.rate, is_(close_to(4.9, 0.1)))
+
+        for _ in range(100):
+            controller.succeeded()
+        assert_that(controller.rate, is_(8.0))
+        assert_that(controller.concurrency, is_(8))
+
+
+class TestSendQuota(unittest.TestCase):
+
+    def _makeOne(self, **kwargs):
+        clock = FakeClock()
+        class Quota(SendQuota):
+            _clock = clock
+        return Quota(**kwargs), clock
+
+    def test_unknown(self):
+        quota, _ = self._makeOne()
+        self.assertTrue(quota.needs_refresh())
+        assert_that(quota.remaining, is_(none()))
+        self.assertFalse(quota.exhausted)
+
+    def test_unlimited(self):
+        quota, _ = self._makeOne()
+        quota.update({'Max24HourSend': -1.0, 'SentLast24Hours': 10.0})
+        assert_that(quota.remaining, is_(none()))
+        self.assertFalse(quota.exhausted)
+        # But if SES says otherwise, we believe it.
+        quota.mark_exhausted()
+        self.assertTrue(quota.exhausted)
+
+    def test_tracking(self):
+        quota, clock = self._makeOne(refresh_interval=60, reserve=5)
+        quota.update({'Max24HourSend': 200.0, 'SentLast24Hours': 150.0})
+        self.assertFalse(quota.needs_refresh())
+        assert_that(quota.remaining, is_(50))
+
+        quota.record(44)
+        self.assertFalse(quota.exhausted)
+        quota.record(1)
+        self.assertTrue(quota.exhausted)
+
+        clock.now = 60
+        self.assertTrue(quota.needs_refresh())
+        quota.update({'Max24HourSend': 200.0, 'SentLast24Hours': 100.0})
+        self.assertFalse(quota.exhausted)
+
+        quota.mark_exhausted()
+        assert_that(quota.remaining, is_(0))
+        self.assertTrue(quota.exhausted)
+
+    def test_expire(self):
+        quota, _ = self._makeOne()
+        quota.update({'Max24HourSend': 200.0, 'SentLast24Hours': 200.0})
+        self.assertFalse(quota.needs_refresh())
+        quota.expire()
+        self.assertTrue(quota.needs_refresh())
+        # What we knew still stands until we do.
+        self.assertTrue(quota.exhausted)
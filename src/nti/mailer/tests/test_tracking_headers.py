@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, absolute_import, division
+__docformat__ = "restructuredtext en"
+
+import unittest
+from unittest.mock import patch as Patch
+
+from hamcrest import assert_that
+from hamcrest import is_
+from hamcrest import none
+
+from pyramid_mailer.message import Message
+
+from repoze.sendmail.interfaces import IMailDelivery
+
+from zope import component
+
+from zope.testing.cleanup import CleanUp
+
+from nti.mailer.delivery import NotifyingQueuedMailDelivery
+
+from nti.mailer._default_template_mailer import _send_mail
+
+
+class PlainMailDelivery(object):
+
+    def __init__(self, *_args):
+        self.sent = []
+
+    def send(self, _fromaddr, _toaddrs, message):
+        self.sent.append(message)
+
+
+class MailDelivery(PlainMailDelivery, NotifyingQueuedMailDelivery):
+    pass
+
+
+def _message():
+    return Message(subject='Hi', sender='from@nextthought.com',
+                   recipients=['to@nextthought.com'], body='Hi')
+
+
+@Patch('nti.mailer._default_template_mailer.time')
+class TestTrackingHeaders(CleanUp, unittest.TestCase):
+
+    def test_only_for_our_queue_deliveries(self, fake_time):
+        fake_time.time.return_value = 1000.25
+        # Nothing else would remove them.
+        delivery = PlainMailDelivery()
+        component.provideUtility(delivery, IMailDelivery)
+        _send_mail(_message(), template='welcome')
+        message = delivery.sent[-1]
+        assert_that(message['X-NTI-Mailer-Queued-At'], is_(none()))
+
+    def test_stamped(self, fake_time):
+        fake_time.time.return_value = 1000.25
+        delivery = MailDelivery('/queue')
+        component.provideUtility(delivery, IMailDelivery)
+        _send_mail(_message(), template='welcome')
+        message = delivery.sent[-1]
+        assert_that(message['X-NTI-Mailer-Queued-At'], is_('1000.250000'))
+        assert_that(message['X-NTI-Mailer-Template'], is_('welcome'))
+        assert_that(message['X-NTI-Mailer-Priority'], is_('default'))
+
+        _send_mail(_message(), priority='bulk')
+        message = delivery.sent[-1]
+        assert_that(message['X-NTI-Mailer-Template'], is_(none()))
+        assert_that(message['X-NTI-Mailer-Priority'], is_('bulk'))